@@ -1,43 +1,79 @@
 #!/usr/bin/env python
 
 import codecs
-import zipfile
 
 from os import walk
 from os.path import join
 
-from jkEpubTools.obfuscation import get_obfuscation_key, get_files_to_obfuscate, xor_array
+from jkEpubTools.archive import EpubZipFile
+from jkEpubTools.compression import DEFAULT_POLICY
+from jkEpubTools.files import EpubMimeType
+from jkEpubTools.incremental import open_incremental_archive
+from jkEpubTools.obfuscation import get_obfuscation_key, get_files_to_obfuscate
+from jkEpubTools.profiling import NULL_PROFILE
+from jkEpubTools.reproducible import get_build_timestamp, get_zip_date_time
 
 
-def build(in_path, out_file):
-    # build obfuscation key
-    key = get_obfuscation_key(in_path)
+def build(in_path, out_file, incremental=False, compression=DEFAULT_POLICY, cache=None, profile=None, reproducible=False):
+    # With incremental=True, files that did not change since the last build
+    # of out_file are copied from the previous archive without recompressing
+    # them. compression is a CompressionPolicy from jkEpubTools.compression.
+    # cache is an optional jkEpubTools.cache.ResourceCache, which can be
+    # shared between books.
+    # profile is an optional jkEpubTools.profiling.BuildProfile.
+    # With reproducible=True, all entries get the same timestamp and
+    # permissions, see jkEpubTools.reproducible.
+    profile = profile or NULL_PROFILE
+    with profile.stage("build"):
+        _build(in_path, out_file, incremental, compression, cache, profile, reproducible)
+
+
+def _build(in_path, out_file, incremental, compression, cache, profile, reproducible):
+    with profile.stage("obfuscation key"):
+        # build obfuscation key
+        key = get_obfuscation_key(in_path)
+        
+        # read file names from encryption.xml; the files are obfuscated while
+        # they are streamed into the archive
+        obfuscated_files = set(get_files_to_obfuscate(in_path))
     
-    # read file names from encryption.xml
-    print "Obfuscating requested files ..."
-    obfuscated_files = {}
-    for f in get_files_to_obfuscate(in_path):
-        print "  Obfuscating \"%s\" ..." % f
-        with open(join(in_path, f), "rb") as in_file:
-            ba = bytearray(in_file.read())
-        obfuscated_files[f] = xor_array(ba, key)
-    #print "Obfuscated files:", obfuscated_files.keys()
-    print "... done."
+    date_time = None
+    if reproducible:
+        date_time = get_zip_date_time(get_build_timestamp())
     
     print "Adding files to epub file \"%s\" ..." % out_file
-    z = zipfile.ZipFile(out_file, "w")
-    for root, dirs, files in walk(in_path):
-        epub_root = root[len(in_path)+1:]
-        for f in files:
-            if not f.startswith("."):
-                print "  Adding file: \"%s\"" % join(epub_root, f),
-                if join(epub_root, f) in obfuscated_files:
-                    print "with obfuscation"
-                    z.writestr(join(epub_root, f), str(obfuscated_files[join(epub_root, f)]))
-                else:
-                    print "from disk"
-                    z.write(join(root, f), join(epub_root, f))
-    z.close()
+    if incremental:
+        z = open_incremental_archive(out_file, compression, cache=cache, profile=profile, date_time=date_time)
+    else:
+        z = EpubZipFile(out_file, "w", policy=compression, cache=cache, profile=profile, date_time=date_time)
+    
+    try:
+        # The mimetype file must be the first entry of the archive. It is
+        # generated, so the staging directory does not need to contain it.
+        print "  Adding file: \"mimetype\""
+        EpubMimeType().write_epub(z)
+    
+        with profile.stage("zip write"):
+            for root, dirs, files in walk(in_path):
+                # Add the files in a fixed order, independent of the file system
+                dirs.sort()
+                epub_root = root[len(in_path)+1:]
+                for f in sorted(files):
+                    if join(epub_root, f) == "mimetype":
+                        continue
+                    if not f.startswith("."):
+                        print "  Adding file: \"%s\"" % join(epub_root, f),
+                        if join(epub_root, f) in obfuscated_files:
+                            print "with obfuscation"
+                            z.write_file(join(root, f), join(epub_root, f), key)
+                        else:
+                            print "from disk"
+                            z.write_file(join(root, f), join(epub_root, f))
+        with profile.stage("close archive"):
+            z.close()
+    except:
+        z.abort()
+        raise
     print "... done."
 
 if __name__ == "__main__":
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+import time
+import zipfile
+import zlib
+
+from hashlib import sha1
+from io import BytesIO
+from os import remove, rename, stat
+from os.path import exists
+
+from jkEpubTools.obfuscation import iter_obfuscated
+from jkEpubTools.profiling import NULL_PROFILE, get_cpu_time
+
+
+# Size of the blocks in which files are copied into the archive
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_file_chunks(in_file, chunk_size=CHUNK_SIZE):
+    # Yield the contents of an open file in blocks of chunk_size bytes
+    while True:
+        chunk = in_file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def iter_buffered(chunks, size=CHUNK_SIZE):
+    # Join small chunks into blocks of at least size bytes, so that many
+    # tiny writes don't each go through the compressor
+    buf = []
+    n = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= size:
+            yield "".join(buf)
+            buf = []
+            n = 0
+    if buf:
+        yield "".join(buf)
+
+
+def get_compressor(compress_type, level=None):
+    # Return a raw deflate compressor for ZIP_DEFLATED, None for ZIP_STORED
+    if compress_type != zipfile.ZIP_DEFLATED:
+        return None
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+class PreparedEntry(object):
+    # The compressed (and possibly obfuscated) data of an archive entry,
+    # ready to be inserted into any archive
+    def __init__(self, compress_type, crc, file_size, data):
+        self.compress_type = compress_type
+        self.crc = crc
+        self.file_size = file_size
+        self.data = data
+    
+    def __len__(self):
+        return len(self.data)
+
+
+def prepare_entry(chunks, compress_type, level=None):
+    # Compress the chunks into a PreparedEntry
+    cmpr = get_compressor(compress_type, level)
+    crc = 0
+    file_size = 0
+    data = []
+    for chunk in chunks:
+        file_size += len(chunk)
+        crc = zlib.crc32(chunk, crc) & 0xffffffff
+        if cmpr is not None:
+            chunk = cmpr.compress(chunk)
+        data.append(chunk)
+    if cmpr is not None:
+        data.append(cmpr.flush())
+    return PreparedEntry(compress_type, crc, file_size, "".join(data))
+
+
+class EpubZipFile(zipfile.ZipFile):
+    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=False, policy=None, cache=None, prefetcher=None, profile=None, previous=None, manifest=None, final_path=None, date_time=None):
+        # policy is a CompressionPolicy that chooses the compression for each
+        # entry; without one, the compression argument applies to all entries.
+        # cache is a ResourceCache holding prepared entries of files that are
+        # shared between books.
+        # prefetcher is a jkEpubTools.prefetch.Prefetcher that supplies the
+        # source files.
+        # profile is a jkEpubTools.profiling.BuildProfile that records the
+        # bytes read and written and the time spent for each entry.
+        # For incremental builds, previous is the archive of the last build
+        # and manifest its BuildManifest. Entries that the manifest reports
+        # as unchanged are copied over from the previous archive without
+        # recompressing them. If final_path is given, the archive is renamed
+        # to it when it is closed.
+        # For reproducible archives, date_time is the timestamp of all
+        # entries, which also get the same permissions.
+        zipfile.ZipFile.__init__(self, file, mode, compression, allowZip64)
+        self.policy = policy
+        self.cache = cache
+        self.prefetcher = prefetcher
+        self.profile = profile or NULL_PROFILE
+        self.previous = previous
+        self.manifest = manifest
+        self.final_path = final_path
+        self.date_time = date_time
+    
+    def new_zinfo(self, arcname, date_time=None, mode=0o644):
+        # Return a ZipInfo for a new entry, by default with the current time
+        if self.date_time is not None:
+            zinfo = zipfile.ZipInfo(arcname, self.date_time)
+            # Unix, independent of the platform the archive is built on
+            zinfo.create_system = 3
+            mode = 0o644
+        else:
+            zinfo = zipfile.ZipInfo(arcname, date_time or time.localtime(time.time())[:6])
+        zinfo.external_attr = mode << 16
+        return zinfo
+    
+    def close(self):
+        if self.fp is None:
+            return
+        zipfile.ZipFile.close(self)
+        if self.previous is not None:
+            self.previous.close()
+        if self.final_path is not None:
+            rename(self.filename, self.final_path)
+            if self.manifest is not None:
+                self.manifest.save()
+    
+    def abort(self):
+        # Close the archive after a failed build. If the archive would have
+        # been renamed to final_path, it is removed instead, and the manifest
+        # is not saved.
+        final_path = self.final_path
+        self.final_path = None
+        try:
+            self.close()
+        finally:
+            if self.previous is not None:
+                self.previous.close()
+            if final_path is not None and exists(self.filename):
+                remove(self.filename)
+    
+    def copy_entry(self, source, name):
+        # Copy an entry from another open archive, without decompressing it
+        src_info = source.getinfo(name)
+        source.fp.seek(src_info.header_offset, 0)
+        header = struct.unpack(
+            zipfile.structFileHeader,
+            source.fp.read(zipfile.sizeFileHeader),
+        )
+        source.fp.seek(
+            header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH],
+            1,
+        )
+        
+        zinfo = self.new_zinfo(src_info.filename, src_info.date_time)
+        if self.date_time is None:
+            zinfo.external_attr = src_info.external_attr
+        zinfo.compress_type = src_info.compress_type
+        zinfo.CRC = src_info.CRC
+        zinfo.file_size = src_info.file_size
+        zinfo.compress_size = src_info.compress_size
+        self.write_raw(zinfo, self._iter_raw_data(source, src_info))
+    
+    def _iter_raw_data(self, source, src_info):
+        remaining = src_info.compress_size
+        while remaining > 0:
+            chunk = source.fp.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipfile("Truncated entry \"%s\"" % src_info.filename)
+            remaining -= len(chunk)
+            yield chunk
+    
+    def write_raw(self, zinfo, chunks):
+        # Write an entry whose data is compressed already. CRC, sizes and
+        # compress_type must be set in zinfo.
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.fp.tell()
+        
+        self._writecheck(zinfo)
+        self._didModify = True
+        
+        self.fp.write(zinfo.FileHeader(False))
+        for chunk in chunks:
+            self.fp.write(chunk)
+        
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+    
+    def write_prepared(self, zinfo, entry):
+        # Write a PreparedEntry
+        zinfo.compress_type = entry.compress_type
+        zinfo.CRC = entry.crc
+        zinfo.file_size = entry.file_size
+        zinfo.compress_size = len(entry.data)
+        self.write_raw(zinfo, [entry.data])
+    
+    def reuse_entry(self, name, unchanged):
+        # Copy an unchanged entry from the previous build, if possible.
+        # Returns True if the entry has been copied.
+        if unchanged and self.previous is not None and name in self.previous.NameToInfo:
+            self.copy_entry(self.previous, name)
+            self.profile.count("reused")
+            return True
+        return False
+    
+    def stat_source(self, src):
+        if self.prefetcher is not None:
+            return self.prefetcher.stat(src)
+        return stat(src)
+    
+    def source_exists(self, src):
+        if self.prefetcher is not None:
+            return self.prefetcher.exists(src)
+        return exists(src)
+    
+    def open_source(self, src):
+        if self.prefetcher is not None:
+            return self.prefetcher.open(src)
+        return open(src, "rb")
+    
+    def skip_source(self, src):
+        # Tell the prefetcher that src will not be opened
+        if self.prefetcher is not None:
+            self.prefetcher.skip(src)
+    
+    def get_compression(self, arcname, mime=None):
+        # Return the compression type and zlib level for an entry
+        if self.policy is None:
+            return self.compression, zlib.Z_DEFAULT_COMPRESSION
+        return self.policy.get_compression(arcname, mime)
+    
+    def write_contents(self, arcname, data, mime=None):
+        # Write generated contents (a byte string) into the archive
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        source = self._write_contents(arcname, data, mime)
+        self.profile.add_entry(
+            arcname,
+            source,
+            0,
+            self.NameToInfo[arcname].compress_size,
+            time.time() - start_wall,
+            get_cpu_time() - start_cpu,
+        )
+    
+    def _write_contents(self, arcname, data, mime):
+        if self.manifest is not None:
+            if self.reuse_entry(arcname, self.manifest.contents_unchanged(arcname, data)):
+                return "previous"
+        zinfo = self.new_zinfo(arcname)
+        compress_type, level = self.get_compression(arcname, mime)
+        self.write_chunks(zinfo, [data], compress_type, level)
+        return "generated"
+    
+    def write_content_chunks(self, arcname, get_chunks, mime=None):
+        # Write generated contents without holding them in memory at once.
+        # get_chunks is a callable that returns an iterable of byte strings.
+        # For incremental builds it is called twice if the contents changed:
+        # once to hash them, and once to write them.
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        source = self._write_content_chunks(arcname, get_chunks, mime)
+        self.profile.add_entry(
+            arcname,
+            source,
+            0,
+            self.NameToInfo[arcname].compress_size,
+            time.time() - start_wall,
+            get_cpu_time() - start_cpu,
+        )
+    
+    def _write_content_chunks(self, arcname, get_chunks, mime):
+        if self.manifest is not None:
+            h = sha1()
+            for chunk in get_chunks():
+                h.update(chunk)
+            if self.reuse_entry(arcname, self.manifest.update(arcname, {"sha1": h.hexdigest()})):
+                return "previous"
+        zinfo = self.new_zinfo(arcname)
+        compress_type, level = self.get_compression(arcname, mime)
+        self.write_chunks(zinfo, iter_buffered(get_chunks()), compress_type, level)
+        return "generated"
+    
+    def write_chunks(self, zinfo_or_arcname, chunks, compress_type=None, level=None):
+        # Write an entry whose contents are supplied as an iterable of byte
+        # strings. Only one chunk is held in memory at a time; the CRC and
+        # sizes are patched into the local file header afterwards.
+        if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo = zinfo_or_arcname
+        else:
+            zinfo = self.new_zinfo(zinfo_or_arcname)
+        
+        if compress_type is None:
+            compress_type, level = self.get_compression(zinfo.filename)
+        zinfo.compress_type = compress_type
+        zinfo.flag_bits = 0x00
+        zinfo.file_size = 0
+        zinfo.header_offset = self.fp.tell()
+        
+        self._writecheck(zinfo)
+        self._didModify = True
+        
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        self.fp.write(zinfo.FileHeader(False))
+        
+        self._write_compressed(zinfo, chunks, compress_type, level)
+        
+        # Seek back and rewrite the local file header with the final values
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset, 0)
+        self.fp.write(zinfo.FileHeader(False))
+        self.fp.seek(position, 0)
+        
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+    
+    def _write_compressed(self, zinfo, chunks, compress_type, level):
+        # Compress and write the chunks, and set the CRC and sizes of zinfo
+        cmpr = get_compressor(compress_type, level)
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        for chunk in chunks:
+            file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc) & 0xffffffff
+            if cmpr is not None:
+                chunk = cmpr.compress(chunk)
+            compress_size += len(chunk)
+            self.fp.write(chunk)
+        if cmpr is not None:
+            chunk = cmpr.flush()
+            compress_size += len(chunk)
+            self.fp.write(chunk)
+        
+        if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("Entry \"%s\" would require ZIP64 extensions" % zinfo.filename)
+        
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+    
+    def write_file(self, src, arcname, key=None, mime=None):
+        # Copy a file from disk into the archive in chunks. If an obfuscation
+        # key is given, the file is obfuscated on the way.
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        source, bytes_read = self._write_file(src, arcname, key, mime)
+        if key is not None and source == "disk":
+            self.profile.count("obfuscated_bytes", bytes_read)
+        self.profile.add_entry(
+            arcname,
+            source,
+            bytes_read,
+            self.NameToInfo[arcname].compress_size,
+            time.time() - start_wall,
+            get_cpu_time() - start_cpu,
+        )
+    
+    def _write_file(self, src, arcname, key, mime):
+        # Returns where the entry came from and the number of bytes read
+        st = self.stat_source(src)
+        if self.manifest is not None:
+            if self.reuse_entry(arcname, self.manifest.file_unchanged(arcname, src, key, st)):
+                self.skip_source(src)
+                return "previous", self.NameToInfo[arcname].compress_size
+        zinfo = self.new_zinfo(arcname, time.localtime(st.st_mtime)[:6], st.st_mode & 0xFFFF)
+        compress_type, level = self.get_compression(arcname, mime)
+        
+        if self.cache is not None and self.cache.accepts(st.st_size):
+            source, entry = self.prepare_source(src, key, compress_type, level, st)
+            self.write_prepared(zinfo, entry)
+            return source, 0 if source == "cache" else st.st_size
+        
+        with self.open_source(src) as in_file:
+            self.write_chunks(zinfo, self._iter_source(in_file, key), compress_type, level)
+        return "disk", st.st_size
+    
+    def prepare_source(self, src, key, compress_type, level, st):
+        # Return where the entry came from ("cache" or "disk") and a
+        # PreparedEntry of a source file, from the cache if possible
+        if self.cache is None or not self.cache.accepts(st.st_size):
+            with self.open_source(src) as in_file:
+                return "disk", prepare_entry(self._iter_source(in_file, key), compress_type, level)
+        
+        # Unless its hash is remembered, the file is read once, and hashed
+        # and compressed from memory
+        data = None
+        if not self.cache.has_file_hash(src, st):
+            with self.open_source(src) as in_file:
+                data = in_file.read()
+        cache_key = self.cache.get_key(src, key, compress_type, level, st, data)
+        entry = self.cache.get(cache_key)
+        if entry is not None:
+            if data is None:
+                self.skip_source(src)
+            self.profile.count("cache_hits")
+            return "cache", entry
+        self.profile.count("cache_misses")
+        if data is None:
+            in_file = self.open_source(src)
+        else:
+            in_file = BytesIO(data)
+        with in_file:
+            entry = prepare_entry(self._iter_source(in_file, key), compress_type, level)
+        self.cache.put(cache_key, entry)
+        return "disk", entry
+    
+    def _iter_source(self, in_file, key):
+        if key is None:
+            return iter_file_chunks(in_file)
+        return self._iter_obfuscated(in_file, key)
+    
+    def _iter_obfuscated(self, in_file, key):
+        # The time spent on the obfuscated head is counted separately, in
+        # seconds, as "obfuscation"
+        chunks = iter_obfuscated(in_file, key, CHUNK_SIZE)
+        start = time.time()
+        head = next(chunks)
+        self.profile.count("obfuscation", time.time() - start)
+        yield head
+        for chunk in chunks:
+            yield chunk
+
+
+class ArchiveGroup(object):
+    # Writes the same entries into several EpubZipFiles, which must use the
+    # same compression policy. Each entry is read and compressed only once,
+    # or taken from the resource cache of the first archive, and the
+    # compressed data is written into all archives. Incremental builds are
+    # not supported. A group can be
+    # used in place of an EpubZipFile by the write_epub methods of the
+    # document classes.
+    def __init__(self, archives):
+        self.archives = archives
+    
+    def __len__(self):
+        return len(self.archives)
+    
+    def source_exists(self, src):
+        return self.archives[0].source_exists(src)
+    
+    def skip_source(self, src):
+        self.archives[0].skip_source(src)
+    
+    def write_contents(self, arcname, data, mime=None):
+        self.write_content_chunks(arcname, lambda: [data], mime)
+    
+    def write_content_chunks(self, arcname, get_chunks, mime=None):
+        if len(self.archives) < 2:
+            for z in self.archives:
+                z.write_content_chunks(arcname, get_chunks, mime)
+            return
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        compress_type, level = self.archives[0].get_compression(arcname, mime)
+        entry = prepare_entry(iter_buffered(get_chunks()), compress_type, level)
+        for z in self.archives:
+            z.write_prepared(z.new_zinfo(arcname), entry)
+        self.archives[0].profile.add_entry(
+            arcname,
+            "generated",
+            0,
+            len(entry),
+            time.time() - start_wall,
+            get_cpu_time() - start_cpu,
+        )
+    
+    def write_file(self, src, arcname, key=None, mime=None):
+        if len(self.archives) < 2:
+            for z in self.archives:
+                z.write_file(src, arcname, key, mime)
+            return
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        first = self.archives[0]
+        st = first.stat_source(src)
+        compress_type, level = first.get_compression(arcname, mime)
+        source, entry = first.prepare_source(src, key, compress_type, level, st)
+        bytes_read = 0
+        if source == "disk":
+            bytes_read = st.st_size
+            if key is not None:
+                first.profile.count("obfuscated_bytes", bytes_read)
+        for z in self.archives:
+            z.write_prepared(
+                z.new_zinfo(arcname, time.localtime(st.st_mtime)[:6], st.st_mode & 0xFFFF),
+                entry,
+            )
+        first.profile.add_entry(
+            arcname,
+            source,
+            bytes_read,
+            len(entry),
+            time.time() - start_wall,
+            get_cpu_time() - start_cpu,
+        )
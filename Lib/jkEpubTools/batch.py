@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Build many epub files in parallel from book manifests.
+#
+# A manifest is a dict describing one book:
+#
+#   {
+#       "id": "de.kutilek.the-haunter-of-the-dark",
+#       "title": "The Haunter of the Dark",
+#       "output": "The Haunter of the Dark.epub",
+#       "base_path": "examples/The Haunter Of The Dark",
+#       "stylesheet": "style/stylesheet.css",
+#       "metadata": {...},    # as for Document.set_metadata_from_dict
+#       "cover": {...},       # as for Document.set_cover_from_dict
+#       "resources": [...],   # as for Document.add_resources_from_dict_list
+#       "chapters": [...],    # as for Document.add_chapters_from_dict_list
+#       "split_size": 262144, # optional, see Document.split_chapters
+#       "images": {...},      # optional, options for ImageOptimizer
+#       "subset_fonts": {...},# optional, options for FontSubsetter
+#       "reproducible": true, # optional, see jkEpubTools.reproducible
+#   }
+#
+# Instead of stylesheet, metadata, cover, resources and chapters, a manifest
+# may give the path of a book saved by Document.save_json as "book", see
+# jkEpubTools.catalog. Such book files can also be passed to the command line
+# tool directly.
+#
+# Relative src paths are resolved against base_path, if it is given.
+
+import json
+import sys
+import time
+import traceback
+
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from os.path import abspath, dirname, isabs, join
+
+from jkEpubTools.cache import DEFAULT_CACHE_SIZE, ResourceCache
+from jkEpubTools.catalog import load_document
+from jkEpubTools.document import Document
+from jkEpubTools.images import ImageOptimizer
+from jkEpubTools.subsetting import FontSubsetter
+from jkEpubTools.validation import validate_epub
+from jkEpubTools.profiling import BuildProfile
+
+
+# Resource cache of the current worker process, see init_worker
+_resource_cache = None
+
+
+class BookResult(object):
+    def __init__(self, book_id, output):
+        self.book_id = book_id
+        self.output = output
+        self.error = None
+        self.traceback = None
+        self.time = 0
+        self.profile_path = None
+    
+    def __repr__(self):
+        if self.error is None:
+            return "OK      %s (%0.2f s)" % (self.book_id, self.time)
+        return "FAILED  %s: %s" % (self.book_id, self.error)
+    
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def resolve_src(item_dict, base_path):
+    # Return a copy of a cover, resource or chapter dict with its src path
+    # made relative to base_path
+    item_dict = dict(item_dict)
+    src = item_dict.get("src", None)
+    if src is not None and base_path is not None and not isabs(src):
+        item_dict["src"] = join(base_path, src)
+    return item_dict
+
+
+def document_from_manifest(manifest):
+    base_path = manifest.get("base_path", None)
+    if manifest.get("book", None) is not None:
+        doc = load_document(resolve_src({"src": manifest["book"]}, base_path)["src"])
+    else:
+        doc = Document(manifest.get("id", "unknown"), manifest.get("title", ""))
+        doc.set_metadata_from_dict(manifest.get("metadata", {}))
+        doc.stylesheet = manifest.get("stylesheet", None)
+        if manifest.get("cover", None) is not None:
+            doc.set_cover_from_dict(resolve_src(manifest["cover"], base_path))
+        doc.add_resources_from_dict_list(
+            [resolve_src(r, base_path) for r in manifest.get("resources", [])]
+        )
+        doc.add_chapters_from_dict_list(
+            [resolve_src(c, base_path) for c in manifest.get("chapters", [])]
+        )
+    if manifest.get("split_size", None):
+        doc.split_chapters(manifest["split_size"])
+    if manifest.get("images", None) is not None:
+        doc.optimize_images(ImageOptimizer(**manifest["images"]))
+    if manifest.get("subset_fonts", None) is not None:
+        # Worker processes of build_many can't start a pool of their own, so
+        # fonts are subset one after the other unless configured otherwise
+        options = {"processes": 1}
+        options.update(manifest["subset_fonts"])
+        doc.subset_fonts(FontSubsetter(**options))
+    return doc
+
+
+def get_output_path(manifest):
+    return manifest.get("output", "%s.epub" % manifest.get("id", "unknown"))
+
+
+def build_book(manifest, profile_dir=None, validate=False):
+    # Build one book. Errors are recorded in the result instead of raised,
+    # so that one broken book does not stop the whole batch.
+    # If profile_dir is given, a JSON build profile of the book is saved
+    # there as <id>.profile.json. With validate=True, the finished epub is
+    # checked by jkEpubTools.validation, and validation errors count as
+    # build errors.
+    result = BookResult(manifest.get("id", "unknown"), get_output_path(manifest))
+    profile = None
+    if profile_dir is not None:
+        profile = BuildProfile()
+    start = time.time()
+    try:
+        doc = document_from_manifest(manifest)
+        missing = doc.get_missing_sources()
+        if missing:
+            result.error = "Source files not found: %s" % ", ".join(missing)
+        else:
+            doc.write_epub(
+                result.output,
+                cache=_resource_cache,
+                profile=profile,
+                reproducible=manifest.get("reproducible", False),
+            )
+            if validate:
+                report = validate_epub(result.output)
+                if not report.ok:
+                    result.error = "Validation failed: %s" % "; ".join(report.errors)
+        if profile is not None:
+            result.profile_path = join(profile_dir, "%s.profile.json" % result.book_id)
+            profile.save_json(result.profile_path)
+    except Exception as e:
+        result.error = "%s: %s" % (e.__class__.__name__, e)
+        result.traceback = traceback.format_exc()
+    result.time = time.time() - start
+    return result
+
+
+def init_worker(cache_size):
+    # Set up the resource cache that is shared by all books a worker builds
+    global _resource_cache
+    if cache_size:
+        _resource_cache = ResourceCache(cache_size)
+    else:
+        _resource_cache = None
+
+
+def _build_indexed(args):
+    i, manifest, profile_dir, validate = args
+    return i, build_book(manifest, profile_dir, validate)
+
+
+def build_many(manifests, workers=None, callback=None, cache_size=DEFAULT_CACHE_SIZE, profile_dir=None, validate=False):
+    # Build all manifests across a pool of worker processes and return a list
+    # of BookResult objects in the order of the manifests. If a callback is
+    # given, it is called with each result as soon as the book is finished.
+    # Each worker keeps a resource cache of up to cache_size bytes, so files
+    # shared between books are prepared only once per worker; use 0 to
+    # disable it.
+    # If profile_dir is given, a build profile of each book is saved there.
+    # With validate=True, each finished book is validated.
+    if workers is None:
+        workers = cpu_count()
+    manifests = list(manifests)
+    results = [None] * len(manifests)
+    jobs = [(i, manifest, profile_dir, validate) for i, manifest in enumerate(manifests)]
+    
+    if workers == 1:
+        init_worker(cache_size)
+        finished = (_build_indexed(args) for args in jobs)
+        pool = None
+    else:
+        pool = Pool(workers, init_worker, (cache_size,))
+        finished = pool.imap_unordered(_build_indexed, jobs)
+    
+    try:
+        for i, result in finished:
+            results[i] = result
+            if callback is not None:
+                callback(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
+
+
+def load_manifests(path):
+    # Read a JSON file holding one manifest or a list of manifests, or a book
+    # saved by Document.save_json. Relative src paths default to the
+    # directory of the JSON file.
+    with open(path, "rb") as f:
+        data = json.load(f)
+    if isinstance(data, dict) and "index" in data:
+        data = {
+            "id": data.get("id", "unknown"),
+            "output": get_output_path(data),
+            "book": abspath(path),
+        }
+    if isinstance(data, dict):
+        data = [data]
+    for manifest in data:
+        if "base_path" not in manifest:
+            manifest["base_path"] = dirname(abspath(path))
+    return data
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options] manifest.json [manifest.json ...]")
+    parser.add_option("-j", "--workers", type="int", default=None,
+        help="number of worker processes (default: number of CPUs)")
+    parser.add_option("--profile-dir", default=None,
+        help="save a JSON build profile of each book into this directory")
+    parser.add_option("--validate", action="store_true", default=False,
+        help="validate each finished book")
+    options, paths = parser.parse_args(args)
+    if not paths:
+        parser.error("No manifest files given.")
+    
+    manifests = []
+    for path in paths:
+        manifests.extend(load_manifests(path))
+    
+    def report(result):
+        print result
+        sys.stdout.flush()
+    
+    start = time.time()
+    results = build_many(
+        manifests,
+        options.workers,
+        report,
+        profile_dir=options.profile_dir,
+        validate=options.validate,
+    )
+    failed = [r for r in results if not r.ok]
+    print "Built %i of %i books in %0.2f s." % (
+        len(results) - len(failed),
+        len(results),
+        time.time() - start,
+    )
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# A content-addressed cache of prepared archive entries.
+#
+# Entries are keyed by the SHA-1 hash of the source file, the obfuscation key
+# (if the file is obfuscated) and the compression settings, so a font that is
+# embedded in many books is read, obfuscated and compressed only once per
+# unique key. The cache holds at most max_size bytes of compressed data and
+# evicts the least recently used entries first.
+
+from collections import OrderedDict
+from hashlib import sha1
+from os import stat
+
+from jkEpubTools.incremental import get_file_hash
+
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Number of file hashes remembered, keyed by path, size and mtime
+MAX_FILE_HASHES = 100000
+
+
+class ResourceCache(object):
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._hashes = OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __repr__(self):
+        return "<ResourceCache %i entries, %i bytes, %i hits, %i misses>" % (
+            len(self._entries),
+            self.size,
+            self.hits,
+            self.misses,
+        )
+    
+    def accepts(self, file_size):
+        # Files larger than the whole cache are not cached
+        return file_size <= self.max_size
+    
+    def has_file_hash(self, src, st):
+        # Whether the hash of a file is remembered
+        return (src, st.st_size, st.st_mtime) in self._hashes
+    
+    def get_file_hash(self, src, st=None, data=None):
+        # Hash a file, or return the remembered hash if the file did not
+        # change since it was hashed last. st is the result of stat(src), if
+        # known. If the contents of the file have been read already, pass
+        # them as data, so the file is not read again.
+        if st is None:
+            st = stat(src)
+        k = (src, st.st_size, st.st_mtime)
+        h = self._hashes.pop(k, None)
+        if h is None:
+            if data is None:
+                h = get_file_hash(src)
+            else:
+                h = sha1(data).hexdigest()
+            if len(self._hashes) >= MAX_FILE_HASHES:
+                self._hashes.popitem(last=False)
+        self._hashes[k] = h
+        return h
+    
+    def get_key(self, src, key, compress_type, level, st=None, data=None):
+        if key is not None:
+            key = str(key)
+        return (self.get_file_hash(src, st, data), key, compress_type, level)
+    
+    def get(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        # Move the entry to the most recently used end
+        self._entries[cache_key] = entry
+        self.hits += 1
+        return entry
+    
+    def put(self, cache_key, entry):
+        if len(entry) > self.max_size:
+            return
+        old = self._entries.pop(cache_key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[cache_key] = entry
+        self.size += len(entry)
+        while self.size > self.max_size:
+            old_key, old = self._entries.popitem(last=False)
+            self.size -= len(old)
+    
+    def clear(self):
+        self._entries.clear()
+        self._hashes.clear()
+        self.size = 0
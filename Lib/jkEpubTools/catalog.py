@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Books stored as JSON files in the layout of Document.as_dict, see
+# Document.save_json:
+#
+#   book.json         the as_dict of the Document, with "chapters" listing
+#                     the chapter files, and an "index" of the chapters
+#   001_<id>.json     the as_dict of each Chapter
+#
+# A chapter entry may also be a chapter dict instead of a file name. Relative
+# src paths are resolved against base_path, which is itself relative to the
+# directory of book.json.
+#
+# A BookDefinition keeps only what is needed to schedule the build of a book,
+# so that a catalog of many books can be held in memory. The Document is
+# loaded from the JSON files when the book is built. If book.json has an
+# index, the chapter files are only read when the sections of a chapter are
+# needed, i.e. when the chapter is rendered; chapters that are copied from
+# their src file don't need them at all.
+
+import json
+
+from os.path import dirname, isabs, join
+
+from jkEpubTools.document import Chapter, Document, Resource, Section
+
+
+class BookDefinition(object):
+    __slots__ = ["path", "id", "title", "output"]
+    
+    def __init__(self, path, book_id="unknown", title="", output=None):
+        self.path = path
+        self.id = book_id
+        self.title = title
+        self.output = output
+    
+    def __repr__(self):
+        return "<BookDefinition '%s' (%s)>" % (self.id, self.path)
+    
+    @classmethod
+    def from_json(cls, path):
+        with open(path, "rb") as f:
+            doc_dict = json.load(f)
+        return cls(
+            path,
+            doc_dict.get("id", "unknown"),
+            doc_dict.get("title", ""),
+            doc_dict.get("output", None),
+        )
+    
+    def get_output_path(self):
+        if self.output is None:
+            return "%s.epub" % self.id
+        return self.output
+    
+    def load(self, lazy=True):
+        return load_document(self.path, lazy)
+    
+    def load_index(self):
+        return load_index(self.path)
+
+
+class BookIndex(object):
+    # The chapters and resources of a book, by id and by uri, read from
+    # book.json without loading the chapter files
+    __slots__ = ["chapters", "chapter_ids", "resources", "base_path"]
+    
+    def __init__(self, doc_dict, base_path):
+        self.base_path = base_path
+        # Chapter entries with id, title, file and src, in reading order
+        self.chapters = doc_dict.get("index", {}).get("chapters", [])
+        self.chapter_ids = dict(
+            (entry["id"], i) for i, entry in enumerate(self.chapters)
+        )
+        self.resources = dict(
+            (r["uri"], Resource(_resolve_src(r, base_path)))
+            for r in doc_dict.get("resources", [])
+        )
+    
+    def get_chapter(self, chapter_id):
+        # Return the index entry of a chapter, or None
+        i = self.chapter_ids.get(chapter_id, None)
+        if i is None:
+            return None
+        return self.chapters[i]
+    
+    def get_resource(self, uri):
+        # Return the Resource for an uri, or None
+        return self.resources.get(uri, None)
+    
+    def get_source_paths(self):
+        # Return the src paths of the chapters and resources. Chapters built
+        # from sections have no src path.
+        paths = [
+            _resolve_src(entry, self.base_path)["src"]
+            for entry in self.chapters if entry.get("src", None) is not None
+        ]
+        paths.extend(res.src for res in self.resources.values() if res.src is not None)
+        return paths
+
+
+class LazyChapter(Chapter):
+    # A chapter whose sections are loaded from its JSON file when they are
+    # first needed
+    __slots__ = ["json_path", "_sections"]
+    
+    def __init__(self, json_path, chapter_id="", title="", src=None):
+        Chapter.__init__(self, chapter_id, title)
+        self.json_path = json_path
+        self.src = src
+        self._sections = None
+    
+    @property
+    def sections(self):
+        if self._sections is None:
+            with open(self.json_path, "rb") as f:
+                chapter_dict = json.load(f)
+            self._sections = [Section(s) for s in chapter_dict.get("sections", [])]
+        return self._sections
+    
+    @sections.setter
+    def sections(self, sections):
+        self._sections = sections
+
+
+def load_catalog(paths):
+    # Return a list of BookDefinitions for the JSON files at paths
+    return [BookDefinition.from_json(path) for path in paths]
+
+
+def _resolve_src(item_dict, base_path):
+    src = item_dict.get("src", None)
+    if src is not None and not isabs(src):
+        item_dict = dict(item_dict)
+        item_dict["src"] = join(base_path, src)
+    return item_dict
+
+
+def _load_json(path):
+    with open(path, "rb") as f:
+        doc_dict = json.load(f)
+    return doc_dict, join(dirname(path), doc_dict.get("base_path", ""))
+
+
+def load_index(path):
+    # Return the BookIndex of the book.json at path
+    doc_dict, base_path = _load_json(path)
+    return BookIndex(doc_dict, base_path)
+
+
+def load_document(path, lazy=True):
+    # Load a Document from the JSON files written by Document.save_json. With
+    # lazy=True, chapters that are listed in the index are created without
+    # reading their files.
+    doc_dict, base_path = _load_json(path)
+    base_dir = dirname(path)
+    
+    doc = Document(doc_dict.get("id", "unknown"), doc_dict.get("title", ""))
+    doc.set_metadata_from_dict(doc_dict.get("metadata", {}))
+    doc.stylesheet = doc_dict.get("stylesheet", None)
+    if doc_dict.get("cover", None) is not None:
+        doc.set_cover_from_dict(_resolve_src(doc_dict["cover"], base_path))
+    doc.add_resources_from_dict_list(
+        [_resolve_src(r, base_path) for r in doc_dict.get("resources", [])]
+    )
+    if lazy and "index" in doc_dict:
+        for entry in doc_dict["index"]["chapters"]:
+            entry = _resolve_src(entry, base_path)
+            doc.chapters.append(LazyChapter(
+                join(base_dir, entry["file"]),
+                entry["id"],
+                entry.get("title", "Untitled Chapter"),
+                entry.get("src", None),
+            ))
+        return doc
+    for chapter in doc_dict.get("chapters", []):
+        if not isinstance(chapter, dict):
+            with open(join(base_dir, chapter), "rb") as f:
+                chapter = json.load(f)
+        doc.add_chapter_from_dict(_resolve_src(chapter, base_path))
+    return doc
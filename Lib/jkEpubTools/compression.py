@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compression policies decide for each archive entry whether it is stored or
+# deflated, and at which level, based on its mime type.
+
+import zipfile
+import zlib
+
+from jkEpubTools.mime import guess_mime_type
+
+
+# Files in these formats are compressed already; deflating them again costs
+# time and saves next to nothing.
+COMPRESSED_MIME_TYPES = set([
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "application/font-woff",
+    "application/font-woff2",
+    "font/woff",
+    "font/woff2",
+])
+
+COMPRESSED_MIME_PREFIXES = ("audio/", "video/")
+
+# Font formats, e.g. for storing fonts uncompressed with
+# CompressionPolicy(stored_types=COMPRESSED_MIME_TYPES | FONT_MIME_TYPES)
+FONT_MIME_TYPES = set([
+    "application/font-sfnt",
+    "application/font-woff",
+    "application/vnd.ms-opentype",
+    "application/x-font-opentype",
+    "application/x-font-truetype",
+    "font/otf",
+    "font/ttf",
+    "font/woff",
+    "font/woff2",
+])
+
+
+class CompressionPolicy(object):
+    def __init__(self, deflate=True, level=zlib.Z_DEFAULT_COMPRESSION, stored_types=COMPRESSED_MIME_TYPES):
+        self.deflate = deflate
+        self.level = level
+        self.stored_types = stored_types
+    
+    def __repr__(self):
+        if not self.deflate:
+            return "<CompressionPolicy store all>"
+        return "<CompressionPolicy deflate level %i>" % self.level
+    
+    def get_compression(self, arcname, mime=None):
+        # Return the zipfile compression type and the zlib level for an entry
+        if arcname == "mimetype":
+            # OCF requires the mimetype file to be stored uncompressed
+            return zipfile.ZIP_STORED, None
+        if not self.deflate:
+            return zipfile.ZIP_STORED, None
+        if mime is None:
+            mime = guess_mime_type(arcname)
+        if mime in self.stored_types or mime.startswith(COMPRESSED_MIME_PREFIXES):
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+    
+    def get_settings(self):
+        # Settings that affect the archive contents, for incremental builds
+        return {
+            "deflate": self.deflate,
+            "level": self.level,
+            "stored_types": sorted(self.stored_types),
+        }
+
+
+# Store everything uncompressed, like earlier versions did
+STORE_ALL = CompressionPolicy(deflate=False)
+
+# Deflate text and uncompressed fonts, store images
+DEFAULT_POLICY = CompressionPolicy()
+
+FASTEST = CompressionPolicy(level=1)
+
+SMALLEST = CompressionPolicy(level=9)
@@ -3,16 +3,34 @@
 
 import codecs
 import errno
+import json
 
-from os import makedirs
-from os.path import dirname, exists, join
+from hashlib import sha1
+from os import getcwd, makedirs, remove, rename
+from os.path import abspath, dirname, exists, join, relpath, splitext
 from shutil import copyfile
 
+from jkEpubTools.archive import ArchiveGroup, EpubZipFile, iter_file_chunks
+from jkEpubTools.compression import DEFAULT_POLICY
 from jkEpubTools.files import ContainerXML, ContentOPF, EncryptionXML, EpubMimeType, IBooksDisplayOptions, NavXHTML, TocNCX, XHTMLFile
+from jkEpubTools.images import get_image_size
+from jkEpubTools.incremental import BUILD_MANIFEST_NAME, BuildManifest, open_incremental_archive
 from jkEpubTools.metadata import MetaData
+from jkEpubTools.mime import guess_mime_type, share_mime_type
+from jkEpubTools.obfuscation import get_key_from_identifiers
+from jkEpubTools.prefetch import Prefetcher
+from jkEpubTools.profiling import NULL_PROFILE
+from jkEpubTools.reproducible import get_build_timestamp, get_zip_date_time
+from jkEpubTools.splitting import DEFAULT_SPLIT_SIZE, LinkRewriter, split_xhtml
+from jkEpubTools.streaming import StreamingEpubZipFile
+from jkEpubTools.subsetting import get_document_codepoints
 
 
 class BaseDocument(object):
+    # The model classes keep their attributes in slots instead of an instance
+    # dict, so that a catalog can hold many documents in memory
+    __slots__ = ()
+    
     def get_id(self):
         return self._id
     
@@ -25,6 +43,8 @@ class BaseDocument(object):
 
 
 class Document(BaseDocument):
+    __slots__ = ["_id", "title", "chapters", "resources", "stylesheet", "cover", "metadata"]
+    
     def __init__(self, doc_id="unknown", title=""):
         self._id = doc_id
         self.title = title
@@ -45,15 +65,53 @@ class Document(BaseDocument):
         return r
     
     def as_dict(self):
-        return {
+        doc_dict = {
             "id": self.get_id(),
             "title": self.title,
+            "stylesheet": self.stylesheet,
+            "resources": [res.as_dict() for res in self.resources],
             "chapters": [
                 "%03i_%s.json" % (
                     i+1, self.chapters[i].get_id()
                 ) for i in range(len(self.chapters))
             ]
         }
+        if self.metadata is not None:
+            doc_dict["metadata"] = self.metadata.as_dict()
+        if self.cover is not None:
+            doc_dict["cover"] = self.cover.as_dict()
+        return doc_dict
+    
+    def get_index(self):
+        # Return the ids, titles and src paths of the chapters, so that they
+        # are known without reading the chapter files
+        index = []
+        for i, chapter in enumerate(self.chapters, 1):
+            entry = {
+                "id": chapter.get_id(),
+                "title": chapter.title,
+                "file": "%03i_%s.json" % (i, chapter.get_id()),
+            }
+            if chapter.src is not None:
+                entry["src"] = chapter.src
+            index.append(entry)
+        return {"chapters": index}
+    
+    def save_json(self, path):
+        # Save the as_dict of the document to path, and the as_dict of each
+        # chapter to the file it references, in the same directory. Relative
+        # src paths are relative to the current directory, which is stored
+        # as base_path, relative to the directory of path.
+        base_dir = dirname(abspath(path))
+        self.safe_makedirs(base_dir)
+        doc_dict = self.as_dict()
+        doc_dict["base_path"] = relpath(getcwd(), base_dir)
+        doc_dict["index"] = self.get_index()
+        with open(path, "wb") as f:
+            json.dump(doc_dict, f, indent=4, sort_keys=True)
+        for chapter, file_name in zip(self.chapters, doc_dict["chapters"]):
+            with open(join(base_dir, file_name), "wb") as f:
+                json.dump(chapter.as_dict(), f, indent=4, sort_keys=True)
     
     def set_metadata_from_dict(self, meta_dict):
         self.metadata = MetaData(meta_dict)
@@ -77,106 +135,556 @@ class Document(BaseDocument):
         for resource_dict in resource_list:
             self.add_resource_from_dict(resource_dict)
     
-    def save_epub(self, epub_root):
-        self.safe_makedirs(join(epub_root, "OEBPS"))
-        self.safe_makedirs(join(epub_root, "META-INF"))
-        
+    def get_chapter_file_names(self):
+        # File names of the chapters, or of their first parts if they are split
+        return ["%03i.xhtml" % (i+1) for i in range(len(self.chapters))]
+    
+    def get_spine_items(self):
+        # Return (id, file name) tuples of the chapter files, including the
+        # parts of split chapters, in reading order
+        items = []
+        for i, file_name in enumerate(self.get_chapter_file_names(), 1):
+            for k, name in enumerate(self.chapters[i-1].get_file_names(file_name)):
+                if k == 0:
+                    items.append(("x%i" % i, name))
+                else:
+                    items.append(("x%i_%i" % (i, k+1), name))
+        return items
+    
+    def split_chapters(self, max_size=DEFAULT_SPLIT_SIZE):
+        # Split chapter files that are bigger than max_size bytes into several
+        # spine items. Call this after all chapters have been added; the
+        # package documents and tables of contents follow the split, and
+        # links to fragments that move into another part are rewritten.
+        for chapter in self.chapters:
+            chapter.split(max_size)
+    
+    def get_link_rewriter(self):
+        # Return a LinkRewriter for the links to fragments of split chapters,
+        # or None if no chapter is split
+        targets = {}
+        for chapter, file_name in zip(self.chapters, self.get_chapter_file_names()):
+            if chapter.parts is not None:
+                names = chapter.get_file_names(file_name)
+                for element_id, k in chapter.parts.id_parts.items():
+                    targets[(file_name, element_id)] = names[k]
+        if not targets:
+            return None
+        return LinkRewriter(targets)
+    
+    def optimize_images(self, optimizer):
+        # Replace the src paths of the cover image and the image resources by
+        # optimized versions. optimizer is a jkEpubTools.images.ImageOptimizer.
+        for res in self.resources:
+            if res.src is not None and exists(res.src):
+                res.src = optimizer.optimize(res.src, res.mime)
+        cover = self.cover
+        if cover is not None and cover.src is not None and exists(cover.src):
+            src = optimizer.optimize(cover.src, cover.mime)
+            if src != cover.src:
+                # The cover page needs the size of the scaled image
+                cover.src = src
+                cover.read_size()
+    
+    def subset_fonts(self, subsetter):
+        # Subset the embedded fonts to the characters the book uses. subsetter
+        # is a jkEpubTools.subsetting.FontSubsetter. Call this after all
+        # chapters and resources have been added; the subset fonts are
+        # obfuscated when the epub is written.
+        fonts = [
+            res for res in self.resources
+            if subsetter.accepts(res.mime) and exists(res.src)
+        ]
+        if not fonts:
+            return
+        subsets = subsetter.subset_fonts(
+            [res.src for res in fonts],
+            get_document_codepoints(self),
+        )
+        for res in fonts:
+            res.src = subsets[res.src]
+    
+    def get_source_paths(self):
+        # Return the src paths of all parts of the document, in the order in
+        # which write_epub adds them to the archive
+        items = self.chapters + self.resources
+        if self.cover is not None:
+            items = [self.cover] + items
+        return [item.src for item in items if item.src is not None]
+    
+    def get_missing_sources(self):
+        # Return the src paths of all parts of the document that don't exist
+        return [src for src in self.get_source_paths() if not exists(src)]
+    
+    def make_reproducible(self, timestamp=None):
+        # Set a missing date and uuid of the metadata to values that are the
+        # same for each build, see jkEpubTools.reproducible. Returns the
+        # build timestamp.
+        if timestamp is None:
+            timestamp = get_build_timestamp()
+        self.metadata.make_reproducible(self.get_id(), timestamp)
+        return timestamp
+    
+    def save_epub(self, epub_root, incremental=False, profile=None, reproducible=False):
+        # With incremental=True, files whose inputs did not change since the
+        # last save into the same epub_root are not written again.
+        # profile is an optional jkEpubTools.profiling.BuildProfile.
+        # With reproducible=True, the generated files are the same for each
+        # build; pass reproducible=True to build as well.
+        profile = profile or NULL_PROFILE
+        if reproducible:
+            self.make_reproducible()
+        with profile.stage("save_epub"):
+            self.safe_makedirs(join(epub_root, "OEBPS"))
+            self.safe_makedirs(join(epub_root, "META-INF"))
+            
+            manifest = None
+            if incremental:
+                manifest = BuildManifest(join(epub_root, BUILD_MANIFEST_NAME))
+            
+            self._save_files(epub_root, manifest, profile)
+            
+            if manifest is not None:
+                manifest.remove_stale_files(epub_root)
+                manifest.save()
+    
+    def _save_file(self, epub_file, epub_root, manifest, profile):
+        with profile.stage("save %s" % epub_file.get_archive_name()):
+            epub_file.save(epub_root, manifest)
+    
+    def _save_files(self, epub_root, manifest, profile):
         # mimetype file
-        mimetype = EpubMimeType()
-        mimetype.save(epub_root)
+        self._save_file(EpubMimeType(), epub_root, manifest, profile)
         
-        content_opf = ContentOPF(self)
-        content_opf.save(epub_root)
+        self._save_file(ContentOPF(self), epub_root, manifest, profile)
         
         if self.cover is not None:
-            self.cover.save_epub(epub_root)
+            with profile.stage("save cover"):
+                self.cover.save_epub(epub_root, manifest)
         
-        toc_ncx = TocNCX(self)
-        toc_ncx.save(epub_root)
+        self._save_file(TocNCX(self), epub_root, manifest, profile)
         
         if self.metadata.version == "3.0":
-            nav_xhtml = NavXHTML(self)
-            nav_xhtml.save(epub_root)
+            self._save_file(NavXHTML(self), epub_root, manifest, profile)
         
-        for i in range(len(self.chapters)):
-            file_name = "%03i.xhtml" % (i+1)
-            self.chapters[i].save_epub(epub_root, file_name)
+        with profile.stage("save chapters"):
+            links = self.get_link_rewriter()
+            for chapter, file_name in zip(self.chapters, self.get_chapter_file_names()):
+                chapter.save_epub(epub_root, file_name, manifest, links)
         
-        for res in self.resources:
-            res.save_epub(epub_root)
+        with profile.stage("save resources"):
+            for res in self.resources:
+                res.save_epub(epub_root, manifest)
+        
+        # META-INF
+        
+        self._save_file(ContainerXML(), epub_root, manifest, profile)
+        self._save_file(EncryptionXML(self), epub_root, manifest, profile)
+        self._save_file(IBooksDisplayOptions(), epub_root, manifest, profile)
+    
+    def write_epub(self, out_file, incremental=False, compression=DEFAULT_POLICY, cache=None, prefetch=0, profile=None, reproducible=False):
+        # Write the epub directly into a zip file, without a staging
+        # directory. out_file may be a path or a file-like object.
+        # With incremental=True (only if out_file is a path), entries whose
+        # inputs did not change are copied from the previous out_file
+        # without recompressing them.
+        # compression is a CompressionPolicy from jkEpubTools.compression.
+        # cache is an optional jkEpubTools.cache.ResourceCache, which can be
+        # shared between books.
+        # With prefetch > 0, the source files are checked and read ahead by
+        # that many threads, which helps on high-latency file systems.
+        # profile is an optional jkEpubTools.profiling.BuildProfile.
+        # With reproducible=True, the archive is byte-identical for identical
+        # inputs, see jkEpubTools.reproducible.
+        profile = profile or NULL_PROFILE
+        date_time = None
+        if reproducible:
+            date_time = get_zip_date_time(self.make_reproducible())
+        with profile.stage("write_epub"):
+            with profile.stage("obfuscation key"):
+                key = get_key_from_identifiers([self.metadata.uuid])
+            
+            prefetcher = None
+            if prefetch > 0:
+                prefetcher = Prefetcher(self.get_source_paths(), prefetch)
+            
+            try:
+                if incremental:
+                    z = open_incremental_archive(out_file, compression, cache=cache, prefetcher=prefetcher, profile=profile, date_time=date_time)
+                else:
+                    z = EpubZipFile(out_file, "w", policy=compression, cache=cache, prefetcher=prefetcher, profile=profile, date_time=date_time)
+                try:
+                    self._write_entries(z, key, profile)
+                    with profile.stage("close archive"):
+                        z.close()
+                except:
+                    z.abort()
+                    raise
+            finally:
+                if prefetcher is not None:
+                    profile.count("prefetch_hits", prefetcher.hits)
+                    prefetcher.close()
+    
+    def write_epub_stream(self, out, compression=DEFAULT_POLICY, cache=None, profile=None, reproducible=False):
+        # Write the epub into a file-like object that can't seek, like a
+        # socket or a pipe; it only needs a write method. See
+        # jkEpubTools.streaming.iter_epub for a generator of the archive.
+        # The other arguments are as for write_epub.
+        profile = profile or NULL_PROFILE
+        date_time = None
+        if reproducible:
+            date_time = get_zip_date_time(self.make_reproducible())
+        with profile.stage("write_epub_stream"):
+            with profile.stage("obfuscation key"):
+                key = get_key_from_identifiers([self.metadata.uuid])
+            z = StreamingEpubZipFile(out, policy=compression, cache=cache, profile=profile, date_time=date_time)
+            try:
+                self._write_entries(z, key, profile)
+            except:
+                # The output can't be rewound, so the archive is left
+                # incomplete instead of closing it
+                z.fp = None
+                raise
+            with profile.stage("close archive"):
+                z.close()
+    
+    def _write_file(self, epub_file, z, profile):
+        with profile.stage("write %s" % epub_file.get_archive_name()):
+            epub_file.write_epub(z)
+    
+    def _write_entries(self, z, key, profile):
+        # The mimetype file must be the first entry of the archive
+        self._write_file(EpubMimeType(), z, profile)
+        
+        # META-INF
+        
+        self._write_file(ContainerXML(), z, profile)
+        self._write_file(EncryptionXML(self), z, profile)
+        self._write_file(IBooksDisplayOptions(), z, profile)
+        
+        # OEBPS
+        
+        self._write_file(ContentOPF(self), z, profile)
+        self._write_file(TocNCX(self), z, profile)
+        
+        if self.metadata.version == "3.0":
+            self._write_file(NavXHTML(self), z, profile)
+        
+        if self.cover is not None:
+            with profile.stage("write cover"):
+                self.cover.write_epub(z)
+        
+        with profile.stage("write chapters"):
+            links = self.get_link_rewriter()
+            for chapter, file_name in zip(self.chapters, self.get_chapter_file_names()):
+                chapter.write_epub(z, file_name, links)
+        
+        with profile.stage("write resources"):
+            for res in self.resources:
+                res.write_epub(z, key)
+    
+    def write_variants(self, variants, compression=DEFAULT_POLICY, cache=None, profile=None, reproducible=False):
+        # Write several variants of the epub in one pass. variants is a list
+        # of EpubVariants. Entries that are the same in several variants are
+        # rendered, read and compressed only once; only the package document,
+        # the navigation document, encryption.xml, the iBooks display options
+        # and the fonts can differ between variants.
+        # The other arguments are as for write_epub.
+        profile = profile or NULL_PROFILE
+        date_time = None
+        if reproducible:
+            date_time = get_zip_date_time(self.make_reproducible())
+        with profile.stage("write_variants"):
+            with profile.stage("obfuscation key"):
+                key = get_key_from_identifiers([self.metadata.uuid])
+            archives = []
+            try:
+                for v in variants:
+                    archives.append(EpubZipFile(v.out_file, "w", policy=compression, cache=cache, profile=profile, date_time=date_time))
+                self._write_variant_entries(archives, variants, key, profile)
+                with profile.stage("close archives"):
+                    for z in archives:
+                        z.close()
+            except:
+                # Don't leave incomplete epub files behind
+                for z, v in zip(archives, variants):
+                    z.abort()
+                    if isinstance(v.out_file, basestring) and exists(v.out_file):
+                        remove(v.out_file)
+                raise
+    
+    def _write_variant_entries(self, archives, variants, key, profile):
+        def group_by(get_setting):
+            # Return (setting, ArchiveGroup) tuples of the archives whose
+            # variants have the same setting
+            settings = []
+            grouped = {}
+            for z, variant in zip(archives, variants):
+                setting = get_setting(variant)
+                if setting not in grouped:
+                    settings.append(setting)
+                    grouped[setting] = []
+                grouped[setting].append(z)
+            return [(setting, ArchiveGroup(grouped[setting])) for setting in settings]
+        
+        shared = ArchiveGroup(archives)
+        
+        # The mimetype file must be the first entry of the archive
+        self._write_file(EpubMimeType(), shared, profile)
         
         # META-INF
         
-        container_xml = ContainerXML()
-        container_xml.save(epub_root)
+        self._write_file(ContainerXML(), shared, profile)
+        for obfuscate, group in group_by(lambda v: v.obfuscate_fonts):
+            self._write_file(EncryptionXML(self, obfuscate), group, profile)
+        for ibooks, group in group_by(lambda v: v.ibooks_options):
+            if ibooks:
+                self._write_file(IBooksDisplayOptions(), group, profile)
         
-        encryption_xml = EncryptionXML(self)
-        encryption_xml.save(epub_root)
+        # OEBPS
         
-        ibooks_options = IBooksDisplayOptions()
-        ibooks_options.save(epub_root)
+        for (version, nav), group in group_by(lambda v: (v.version, v.nav)):
+            self._write_file(ContentOPF(self, version, nav), group, profile)
+        self._write_file(TocNCX(self), shared, profile)
+        for nav, group in group_by(lambda v: v.nav):
+            if nav:
+                self._write_file(NavXHTML(self), group, profile)
+        
+        if self.cover is not None:
+            with profile.stage("write cover"):
+                self.cover.write_epub(shared)
+        
+        with profile.stage("write chapters"):
+            links = self.get_link_rewriter()
+            for chapter, file_name in zip(self.chapters, self.get_chapter_file_names()):
+                chapter.write_epub(shared, file_name, links)
+        
+        with profile.stage("write resources"):
+            obfuscation_groups = group_by(lambda v: v.obfuscate_fonts)
+            for res in self.resources:
+                if res.encrypt:
+                    for obfuscate, group in obfuscation_groups:
+                        res.write_epub(group, key if obfuscate else None)
+                else:
+                    res.write_epub(shared, key)
 
 
 class Chapter(BaseDocument):
+    __slots__ = ["_id", "title", "src", "sections", "parts"]
+    
     def __init__(self, chapter_id="", title=""):
         self._id = chapter_id
         self.title = title
         self.src = None
         self.sections = []
+        # ChapterSplit of the src file, if it has been split
+        self.parts = None
     
     def as_dict(self):
-        return {
+        chapter_dict = {
             "id": self.get_id(),
+            "title": self.title,
             "sections": [self.sections[i].as_dict() for i in range(len(self.sections))],
         }
+        if self.src is not None:
+            chapter_dict["src"] = self.src
+        return chapter_dict
     
     def from_dict(self, chapter_dict):
         self._id = chapter_dict.get("id", "")
         self.title = chapter_dict.get("title", "Untitled Chapter")
         self.src = chapter_dict.get("src", None)
+        self.sections = [Section(s) for s in chapter_dict.get("sections", [])]
     
     def as_html(self):
         #print "Chapter.as_html:", self.get_id()
+        return "".join(self.iter_html())
+    
+    def iter_html(self):
+        # Yield the chapter in chunks, one per section, so that only one
+        # section needs to be in memory at a time. Sections may supply their
+        # own iter_html generator; otherwise their as_html is used.
         x = XHTMLFile(title=self.title, stylesheet_path='style/stylesheet.css')
-        h = x.get_header()
-        h += '    <h1>%s</h1>\n' % self.title
-        for i in range(len(self.sections)):
-            s = self.sections[i]
-            h += s.as_html()
-        h += x.get_footer()
-        return h
+        return x.iter_html(self._iter_body())
+    
+    def _iter_body(self):
+        yield '    <h1>%s</h1>\n' % self.title
+        for s in self.sections:
+            if hasattr(s, "iter_html"):
+                for chunk in s.iter_html():
+                    yield chunk
+            else:
+                yield s.as_html()
+    
+    def iter_encoded(self):
+        for chunk in self.iter_html():
+            yield chunk.encode("utf-8")
+    
+    def split(self, max_size=DEFAULT_SPLIT_SIZE):
+        # Split the src file into parts of at most max_size bytes, if it is
+        # bigger. Chapters built from sections are not split.
+        self.parts = None
+        if self.src is not None and exists(self.src):
+            self.parts = split_xhtml(self.src, max_size)
+    
+    def get_file_names(self, file_name):
+        # File names of the parts of the chapter; the first part keeps
+        # file_name
+        if self.parts is None:
+            return [file_name]
+        base, ext = splitext(file_name)
+        return [file_name] + [
+            "%s_%i%s" % (base, k, ext) for k in range(2, len(self.parts) + 1)
+        ]
+    
+    def _save_chunks(self, target, arcname, chunks, manifest):
+        # Write the chunks to a temporary file, which replaces the target
+        # unless the contents are unchanged
+        temp = "%s.tmp" % target
+        h = sha1()
+        with open(temp, 'wb') as f:
+            for chunk in chunks:
+                h.update(chunk)
+                f.write(chunk)
+        if manifest is not None:
+            unchanged = manifest.update(arcname, {"sha1": h.hexdigest()})
+            if unchanged and exists(target):
+                remove(temp)
+                return
+        rename(temp, target)
+    
+    def _iter_part(self, k, file_name, part_name, links):
+        chunks = self.parts.iter_part(k)
+        if links is None:
+            return chunks
+        return links.iter_rewritten(chunks, file_name, part_name)
+    
+    def _iter_encoded(self, file_name, links):
+        if links is None:
+            return self.iter_encoded()
+        return links.iter_rewritten(self.iter_encoded(), file_name)
     
-    def save_epub(self, epub_root, file_name):
+    def _iter_src(self, file_name, links):
+        with open(self.src, "rb") as f:
+            for chunk in links.iter_rewritten(iter_file_chunks(f), file_name):
+                yield chunk
+    
+    def save_epub(self, epub_root, file_name, manifest=None, links=None):
+        # links is the LinkRewriter of the document, if chapters are split
         base_dir = join(epub_root, 'OEBPS')
         self.safe_makedirs(base_dir)
+        target = join(base_dir, file_name)
         if self.src is None:
-            # Chapter content has been built programmatically
-            c = self.as_html()
-            f = codecs.open(join(base_dir, file_name), 'wb', 'utf-8')
-            f.write(c)
-            f.close()
+            # Chapter content has been built programmatically. It is written
+            # section by section.
+            self._save_chunks(target, "OEBPS/%s" % file_name, self._iter_encoded(file_name, links), manifest)
+        elif self.parts is not None:
+            # Chapter content is copied from the src file in parts
+            for k, name in enumerate(self.get_file_names(file_name)):
+                self._save_chunks(join(base_dir, name), "OEBPS/%s" % name, self._iter_part(k, file_name, name, links), manifest)
         else:
             # Chapter content is copied verbatim from src file
             if exists(self.src):
-                copyfile(self.src, join(base_dir, file_name))
+                if links is not None and links.links_to_parts(self.src, file_name):
+                    # ... unless it links into parts of split chapters
+                    self._save_chunks(target, "OEBPS/%s" % file_name, self._iter_src(file_name, links), manifest)
+                    return
+                if manifest is not None:
+                    unchanged = manifest.file_unchanged("OEBPS/%s" % file_name, self.src)
+                    if unchanged and exists(target):
+                        return
+                copyfile(self.src, target)
             else:
                 print "ERROR: Chapter source not found: '%s'" % self.src
+    
+    def write_epub(self, z, file_name, links=None):
+        # links is the LinkRewriter of the document, if chapters are split
+        arcname = "OEBPS/%s" % file_name
+        if self.src is None:
+            # Chapter content has been built programmatically
+            z.write_content_chunks(
+                arcname,
+                lambda: self._iter_encoded(file_name, links),
+                "application/xhtml+xml",
+            )
+        elif self.parts is not None:
+            # Chapter content is copied from the src file in parts, the
+            # prefetched read of the whole file is not needed
+            z.skip_source(self.src)
+            for k, name in enumerate(self.get_file_names(file_name)):
+                z.write_content_chunks(
+                    "OEBPS/%s" % name,
+                    lambda k=k, name=name: self._iter_part(k, file_name, name, links),
+                    "application/xhtml+xml",
+                )
+        else:
+            # Chapter content is copied verbatim from src file
+            if not z.source_exists(self.src):
+                print "ERROR: Chapter source not found: '%s'" % self.src
+            elif links is not None and links.links_to_parts(self.src, file_name):
+                # ... unless it links into parts of split chapters
+                z.skip_source(self.src)
+                z.write_content_chunks(
+                    arcname,
+                    lambda: self._iter_src(file_name, links),
+                    "application/xhtml+xml",
+                )
+            else:
+                z.write_file(self.src, arcname, mime="application/xhtml+xml")
+
+
+class Section(BaseDocument):
+    # A section of a chapter, as a piece of XHTML. This is what sections are
+    # loaded as from the as_dict of a chapter; sections that are added
+    # programmatically may be any object with name, as_html and as_dict.
+    __slots__ = ["name", "html"]
+    
+    def __init__(self, section_dict={}):
+        self.name = section_dict.get("name", "")
+        self.html = section_dict.get("html", "")
+    
+    def as_dict(self):
+        return {"name": self.name, "html": self.html}
+    
+    def as_html(self):
+        return self.html
 
 
 class Cover(BaseDocument):
+    __slots__ = ["src", "uri", "mime", "encrypt", "width", "height"]
+    
     def __init__(self, cover_dict):
         self.src = cover_dict.get("src", None)
         self.uri = cover_dict.get("uri", None)
-        # TODO guess mime type if not supplied
         self.mime = cover_dict.get("mime", None)
         if self.mime is None:
-            from jkEpubTools.mime import guess_mime_type
             self.mime = guess_mime_type(self.uri)
+        self.mime = share_mime_type(self.mime)
         self.encrypt = cover_dict.get("encrypt", False)
         self.width = cover_dict.get("width", None)
         self.height = cover_dict.get("height", None)
         if None in (self.width, self.height):
+            self.read_size()
+    
+    def read_size(self):
+        # Read width and height from the image file
+        size = None
+        if self.src is not None and exists(self.src):
+            size = get_image_size(self.src)
+        if size is None:
             print "ERROR: width and height of cover image must be supplied, or resulting epub will be invalid."
+        else:
+            self.width, self.height = size
+    
+    def as_dict(self):
+        return {
+            "src": self.src,
+            "uri": self.uri,
+            "mime": self.mime,
+            "encrypt": self.encrypt,
+            "width": self.width,
+            "height": self.height,
+        }
     
     def as_html(self):
         #print "Cover.as_html:", self.get_id()
@@ -189,35 +697,91 @@ class Cover(BaseDocument):
         h += x.get_footer()
         return h
     
-    def save_epub(self, epub_root):
+    def save_epub(self, epub_root, manifest=None):
         base_dir = join(epub_root, 'OEBPS')
         self.safe_makedirs(base_dir)
         c = self.as_html()
-        f = codecs.open(join(base_dir, 'cover.xhtml'), 'wb', 'utf-8')
-        f.write(c)
-        f.close()
+        target = join(base_dir, 'cover.xhtml')
+        unchanged = False
+        if manifest is not None:
+            unchanged = manifest.contents_unchanged("OEBPS/cover.xhtml", c.encode("utf-8"))
+        if not (unchanged and exists(target)):
+            f = codecs.open(target, 'wb', 'utf-8')
+            f.write(c)
+            f.close()
         
         self.safe_makedirs(join(epub_root, "OEBPS", dirname(self.uri)))
         if exists(self.src):
-            copyfile(self.src, join(epub_root, "OEBPS", self.uri))
+            target = join(epub_root, "OEBPS", self.uri)
+            if manifest is not None:
+                unchanged = manifest.file_unchanged("OEBPS/%s" % self.uri, self.src)
+                if unchanged and exists(target):
+                    return
+            copyfile(self.src, target)
+        else:
+            print "ERROR: Cover image not found: '%s'" % self.src
+    
+    def write_epub(self, z):
+        z.write_contents("OEBPS/cover.xhtml", self.as_html().encode("utf-8"), "application/xhtml+xml")
+        if z.source_exists(self.src):
+            z.write_file(self.src, "OEBPS/%s" % self.uri, mime=self.mime)
         else:
             print "ERROR: Cover image not found: '%s'" % self.src
 
 
 class Resource(BaseDocument):
+    __slots__ = ["src", "uri", "mime", "encrypt"]
+    
     def __init__(self, resource_dict):
         self.src = resource_dict.get("src", None)
         self.uri = resource_dict.get("uri", None)
-        # TODO guess mime type if not supplied
         self.mime = resource_dict.get("mime", None)
         if self.mime is None:
-            from jkEpubTools.mime import guess_mime_type
             self.mime = guess_mime_type(self.uri)
+        self.mime = share_mime_type(self.mime)
         self.encrypt = resource_dict.get("encrypt", False)
     
-    def save_epub(self, epub_root):
+    def as_dict(self):
+        return {
+            "src": self.src,
+            "uri": self.uri,
+            "mime": self.mime,
+            "encrypt": self.encrypt,
+        }
+    
+    def save_epub(self, epub_root, manifest=None):
         self.safe_makedirs(join(epub_root, "OEBPS", dirname(self.uri)))
         if exists(self.src):
-            copyfile(self.src, join(epub_root, "OEBPS", self.uri))
+            target = join(epub_root, "OEBPS", self.uri)
+            if manifest is not None:
+                unchanged = manifest.file_unchanged("OEBPS/%s" % self.uri, self.src)
+                if unchanged and exists(target):
+                    return
+            copyfile(self.src, target)
+        else:
+            print "ERROR: Resource not found: '%s'" % self.src
+    
+    def write_epub(self, z, key=None):
+        if not z.source_exists(self.src):
+            print "ERROR: Resource not found: '%s'" % self.src
+            return
+        if self.encrypt and key is not None:
+            # Obfuscate the font while adding it to the archive
+            z.write_file(self.src, "OEBPS/%s" % self.uri, key, self.mime)
         else:
-            print "ERROR: Resource not found: '%s'" % self.src
\ No newline at end of file
+            z.write_file(self.src, "OEBPS/%s" % self.uri, mime=self.mime)
+
+
+class EpubVariant(object):
+    # Output settings of one variant for Document.write_variants
+    def __init__(self, out_file, version="3.0", nav=None, obfuscate_fonts=True, ibooks_options=True):
+        # nav is whether the navigation document is included, by default for
+        # version 3.0. With obfuscate_fonts=False, fonts are added as they
+        # are, regardless of the encrypt setting of the resources.
+        self.out_file = out_file
+        self.version = version
+        if nav is None:
+            nav = version == "3.0"
+        self.nav = nav
+        self.obfuscate_fonts = obfuscate_fonts
+        self.ibooks_options = ibooks_options
@@ -7,6 +7,67 @@ import time
 from os.path import join, exists, isdir
 
 
+def xml_escape(value):
+    # Escape a value for use in XML text or in a double-quoted attribute
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    else:
+        value = unicode(value)
+    return value.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;").replace(u'"', u"&quot;")
+
+
+# Templates for ContentOPF
+
+OPF_HEADER = u'<?xml version="1.0" encoding="UTF-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="%s" unique-identifier="uuid_id">\n'
+OPF_METADATA_START = u'  <metadata xmlns:opf="http://www.idpf.org/2007/opf" xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+OPF_PUBLISHER = u'    <dc:publisher>%s</dc:publisher>\n'
+OPF_RIGHTS = u'    <dc:rights>%s</dc:rights>\n'
+OPF_LANGUAGE = u'    <dc:language>%s</dc:language>\n'
+OPF_CREATOR = u'    <dc:creator opf:role="aut">%s</dc:creator>\n'
+OPF_CREATOR_FILE_AS = u'    <dc:creator opf:file-as="%s" opf:role="aut">%s</dc:creator>\n'
+OPF_TITLE = u'    <dc:title>%s</dc:title>\n'
+OPF_COVER_META = u'    <meta name="cover" content="cover-image"/>\n'
+OPF_DATE = u'    <dc:date>%s</dc:date>\n'
+OPF_IDENTIFIER = u'    <dc:identifier id="uuid_id" opf:scheme="uuid">%s</dc:identifier>\n'
+OPF_SUBJECT = u'    <dc:subject>%s</dc:subject>\n'
+OPF_METADATA_END = u'  </metadata>\n'
+OPF_MANIFEST_START = u'  <manifest>\n'
+OPF_COVER_IMAGE_ITEM = u'    <item href="%s" id="cover-image" media-type="%s"/>\n'
+OPF_NCX_ITEM = u'    <item id="ncx"\n          href="toc.ncx"\n          media-type="application/x-dtbncx+xml"/>\n'
+OPF_NAV_ITEM = u'    <item id="nav"\n          href="nav.xhtml"\n          media-type="application/xhtml+xml"\n          properties="nav"/>\n'
+OPF_COVER_ITEM = u'    <item id="cover"\n          href="cover.xhtml"\n          media-type="application/xhtml+xml"/>\n'
+OPF_CHAPTER_ITEM = u'    <item id="%s"\n          href="%s"\n          media-type="application/xhtml+xml"/>\n'
+OPF_RESOURCE_ITEM = u'    <item id="resource%i"\n          href="%s"\n          media-type="%s"/>\n'
+OPF_MANIFEST_END = u'  </manifest>\n'
+OPF_SPINE_START = u'  <spine toc="ncx">\n'
+OPF_NAV_ITEMREF = u'    <itemref idref="nav"/>\n'
+OPF_COVER_ITEMREF = u'    <itemref idref="cover"/>\n'
+OPF_CHAPTER_ITEMREF = u'    <itemref idref="%s"/>\n'
+OPF_SPINE_END = u'  </spine>\n'
+OPF_GUIDE = u'  <guide>\n    <reference href="cover.xhtml" title="Cover" type="cover" />\n  </guide>\n'
+OPF_FOOTER = u'</package>\n'
+
+# Templates for NavXHTML
+
+NAV_HEADER = u'<?xml version="1.0" encoding="UTF-8" ?>\n<html xmlns="http://www.w3.org/1999/xhtml"\n    xmlns:ops="http://www.idpf.org/2007/ops"\n    xml:lang="%s">\n    <head>\n        <title>Table of contents</title>\n'
+NAV_STYLESHEET = u'        <link rel="stylesheet" href="%s" type="text/css" />\n'
+NAV_BODY_START = u'    </head>\n    <body>\n        <nav ops:type="toc">\n            <h1>Table of contents</h1>\n            <ol>\n                <li><a href="nav.xhtml">Table of contents</a></li>\n'
+NAV_CHAPTER = u'                <li><a href="%s">%s</a></li>'
+NAV_FOOTER = u'            </ol>\n        </nav>\n     </body>\n</html>\n'
+
+# Templates for TocNCX
+
+NCX_HEADER = u'<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="%s">\n  <head>\n'
+NCX_UID = u'    <meta content="%s" name="dtb:uid"/>\n'
+NCX_HEAD_END = u'    <meta content="1" name="dtb:depth"/>\n    <meta content="0" name="dtb:totalPageCount"/>\n    <meta content="0" name="dtb:maxPageNumber"/>\n  </head>\n'
+NCX_TITLE = u'  <docTitle>\n    <text>%s</text>\n  </docTitle>\n'
+NCX_AUTHOR = u'  <docAuthor>\n    <text>%s</text>\n  </docAuthor>\n'
+NCX_NAVMAP_START = u'  <navMap>\n'
+NCX_NAVPOINT = u'    <navPoint class="chapter" id="navpoint-%i" playOrder="%i">\n        <navLabel>\n            <text>%s</text>\n        </navLabel>\n        <content src="%s"/>\n    </navPoint>\n'
+NCX_NAVMAP_END = u'  </navMap>\n'
+NCX_FOOTER = u'</ncx>\n'
+
+
 class XHTMLFile(object):
     def __init__(self, language="en", title="No Title", stylesheet_path=None):
         self.language = language
@@ -26,19 +87,43 @@ class XHTMLFile(object):
     
     def get_footer(self):
         return "  </body>\n</html>\n"
+    
+    def iter_html(self, body):
+        # Yield the file in chunks: the header, the chunks of body (any
+        # iterable of strings) and the footer
+        yield self.get_header()
+        for chunk in body:
+            yield chunk
+        yield self.get_footer()
 
 
 class EpubFile(object):
-    def save(self, epub_root):
+    def get_archive_name(self):
+        # Path of the file inside the epub archive, always with forward slashes
+        if self.path is not None:
+            return "%s/%s" % (self.path, self.name)
+        return self.name
+    
+    def save(self, epub_root, manifest=None):
         if self.path is not None:
             path = join(epub_root, self.path, self.name)
         else:
             path = join(epub_root, self.name)
         c = self.get_contents()
         if c is not None:
+            if manifest is not None:
+                unchanged = manifest.contents_unchanged(self.get_archive_name(), c.encode("utf-8"))
+                if unchanged and exists(path):
+                    return
             f = codecs.open(path, "wb", "utf-8")
             f.write(c)
             f.close()
+    
+    def write_epub(self, z):
+        # Write the file directly into an open EpubZipFile
+        c = self.get_contents()
+        if c is not None:
+            z.write_contents(self.get_archive_name(), c.encode("utf-8"))
 
 
 class ContainerXML(EpubFile):
@@ -51,109 +136,110 @@ class ContainerXML(EpubFile):
 
 
 class ContentOPF(EpubFile):
-    def __init__(self, document):
+    def __init__(self, document, version=None, nav=None):
+        # version overrides the version of the document metadata; nav is
+        # whether the navigation document is listed, by default for 3.0
         self.document = document
         self.path = "OEBPS"
         self.name = "content.opf"
+        self.version = version
+        self.nav = nav
     
     def get_contents(self):
+        d = self.document
+        m = d.metadata
+        version = self.version or m.version
+        nav = self.nav
+        if nav is None:
+            nav = version == "3.0"
+        spine_items = d.get_spine_items()
+        h = []
         
         # header
         
-        h = '<?xml version="1.0" encoding="UTF-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="%s" unique-identifier="uuid_id">\n' % self.document.metadata.version
+        h.append(OPF_HEADER % xml_escape(version))
         
         # Meta data element
         
-        h += '  <metadata xmlns:opf="http://www.idpf.org/2007/opf" xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
-        if self.document.metadata.publisher is not None:
-            h += "    <dc:publisher>%s</dc:publisher>\n" % self.document.metadata.publisher
-        if self.document.metadata.rights is not None:
-            h += "    <dc:rights>%s</dc:rights>\n" % self.document.metadata.rights
-        if self.document.metadata.language is not None:
-            h += "    <dc:language>%s</dc:language>\n" % self.document.metadata.language
+        h.append(OPF_METADATA_START)
+        if m.publisher is not None:
+            h.append(OPF_PUBLISHER % xml_escape(m.publisher))
+        if m.rights is not None:
+            h.append(OPF_RIGHTS % xml_escape(m.rights))
+        if m.language is not None:
+            h.append(OPF_LANGUAGE % xml_escape(m.language))
         else:
-            h += "    <dc:language>en</dc:language>\n"
-        if self.document.metadata.author is not None:
-            if self.document.metadata.author_sortname is None:
-                h += '    <dc:creator opf:role="aut">%s</dc:creator>\n' % self.document.metadata.author
+            h.append(OPF_LANGUAGE % "en")
+        if m.author is not None:
+            if m.author_sortname is None:
+                h.append(OPF_CREATOR % xml_escape(m.author))
             else:
-                h += '    <dc:creator opf:file-as="%s" opf:role="aut">%s</dc:creator>\n' % (
-                    self.document.metadata.author_sortname,
-                    self.document.metadata.author
-                )
-        if self.document.metadata.title is not None:
-            h += "    <dc:title>%s</dc:title>\n" % self.document.metadata.title
-        if self.document.cover is not None:
-            h += '    <meta name="cover" content="cover-image"/>\n'
-        if self.document.metadata.date is None:
-            h += '    <dc:date>%s</dc:date>\n' % time.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+                h.append(OPF_CREATOR_FILE_AS % (
+                    xml_escape(m.author_sortname),
+                    xml_escape(m.author),
+                ))
+        if m.title is not None:
+            h.append(OPF_TITLE % xml_escape(m.title))
+        if d.cover is not None:
+            h.append(OPF_COVER_META)
+        if m.date is None:
+            h.append(OPF_DATE % time.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
         else:
-            h += '    <dc:date>%s</dc:date>\n' % self.document.metadata.date
-        h += '    <dc:identifier id="uuid_id" opf:scheme="uuid">%s</dc:identifier>\n' % self.document.metadata.uuid
-        if self.document.metadata.subject is not None:
-            h += '    <dc:subject>%s</dc:subject>\n' % self.document.metadata.subject
-        h += '  </metadata>\n'
+            h.append(OPF_DATE % xml_escape(m.date))
+        h.append(OPF_IDENTIFIER % xml_escape(m.uuid))
+        if m.subject is not None:
+            h.append(OPF_SUBJECT % xml_escape(m.subject))
+        h.append(OPF_METADATA_END)
         
         # Manifest element
         
-        h += '  <manifest>\n'
-        if self.document.cover is not None:
-            h += '    <item href="%s" id="cover-image" media-type="%s"/>\n' % (self.document.cover.uri, self.document.cover.mime)
-        
-        h += '    <item id="ncx"\n          href="toc.ncx"\n          media-type="application/x-dtbncx+xml"/>\n'
-        
-        if self.document.metadata.version == "3.0":
-            h += '    <item id="nav"\n          href="nav.xhtml"\n          media-type="application/xhtml+xml"\n          properties="nav"/>\n'
-        
-        if self.document.cover is not None:
-            h += '    <item id="cover"\n          href="cover.xhtml"\n          media-type="application/xhtml+xml"/>\n'
-        
-        for i in range(len(self.document.chapters)):
-            h += '    <item id="x%i"\n          href="%03i.xhtml"\n          media-type="application/xhtml+xml"/>\n' % (i+1, i+1)
-        
-        for i in range(len(self.document.resources)):
-            r = self.document.resources[i]
-            h += '    <item id="resource%i"\n          href="%s"\n          media-type="%s"/>\n' % (i, r.uri, r.mime)
-            
-        
-        h += '  </manifest>\n'
+        h.append(OPF_MANIFEST_START)
+        if d.cover is not None:
+            h.append(OPF_COVER_IMAGE_ITEM % (xml_escape(d.cover.uri), xml_escape(d.cover.mime)))
+        h.append(OPF_NCX_ITEM)
+        if nav:
+            h.append(OPF_NAV_ITEM)
+        if d.cover is not None:
+            h.append(OPF_COVER_ITEM)
+        h.extend([OPF_CHAPTER_ITEM % (item_id, href) for item_id, href in spine_items])
+        h.extend([
+            OPF_RESOURCE_ITEM % (i, xml_escape(r.uri), xml_escape(r.mime))
+            for i, r in enumerate(d.resources)
+        ])
+        h.append(OPF_MANIFEST_END)
         
         # Spine element
         
-        h += '  <spine toc="ncx">\n'
-        
-        if self.document.metadata.version == "3.0":
-            h += '    <itemref idref="nav"/>\n'
-        
-        if self.document.cover is not None:
-            h += '    <itemref idref="cover"/>\n'
-        
-        for i in range(len(self.document.chapters)):
-            h += '    <itemref idref="x%i"/>\n' % (i+1)
-        h += '  </spine>\n'
+        h.append(OPF_SPINE_START)
+        if nav:
+            h.append(OPF_NAV_ITEMREF)
+        if d.cover is not None:
+            h.append(OPF_COVER_ITEMREF)
+        h.extend([OPF_CHAPTER_ITEMREF % item_id for item_id, href in spine_items])
+        h.append(OPF_SPINE_END)
         
         # Guide element
         
-        h += '  <guide>\n'
         # TODO?
-        h += '    <reference href="cover.xhtml" title="Cover" type="cover" />\n'
-        h += '  </guide>\n'
+        h.append(OPF_GUIDE)
         
-        h += "</package>\n"
-        return h
+        h.append(OPF_FOOTER)
+        return u"".join(h)
 
 
 class EncryptionXML(EpubFile):
-    def __init__(self, document):
+    def __init__(self, document, obfuscate=True):
+        # With obfuscate=False, no file is listed
         self.document = document
         self.path = "META-INF"
         self.name = "encryption.xml"
+        self.obfuscate = obfuscate
     
     def get_contents(self):
         num_encrypted_items = 0
         h = '<encryption\n    xmlns="urn:oasis:names:tc:opendocument:xmlns:container"\n    xmlns:enc="http://www.w3.org/2001/04/xmlenc#">\n'
         for r in self.document.resources:
-            if r.encrypt:
+            if r.encrypt and self.obfuscate:
                 num_encrypted_items += 1
                 h += '    <enc:EncryptedData>\n        <enc:EncryptionMethod Algorithm="http://www.idpf.org/2008/embedding"/>\n        <enc:CipherData>\n            <enc:CipherReference URI="OEBPS/%s" />\n        </enc:CipherData>\n    </enc:EncryptedData>\n' % r.uri
         h += '</encryption>\n'
@@ -169,25 +255,26 @@ class NavXHTML(EpubFile):
         self.name = "nav.xhtml"
     
     def get_contents(self):
-        
-        title = "Table of Contents"
+        d = self.document
+        h = []
         
         # header
         
-        h = u'<?xml version="1.0" encoding="UTF-8" ?>\n<html xmlns="http://www.w3.org/1999/xhtml"\n    xmlns:ops="http://www.idpf.org/2007/ops"\n    xml:lang="%s">\n    <head>\n        <title>Table of contents</title>\n' % self.document.metadata.language
-        if self.document.stylesheet is not None:
-            h += '        <link rel="stylesheet" href="%s" type="text/css" />\n' % self.document.stylesheet
-        h += '    </head>\n    <body>\n        <nav ops:type="toc">\n            <h1>Table of contents</h1>\n            <ol>\n                <li><a href="nav.xhtml">Table of contents</a></li>\n'
+        h.append(NAV_HEADER % xml_escape(d.metadata.language))
+        if d.stylesheet is not None:
+            h.append(NAV_STYLESHEET % xml_escape(d.stylesheet))
+        h.append(NAV_BODY_START)
         
-        for i in range(len(self.document.chapters)):
-            chapter = self.document.chapters[i]
-            h += '                <li><a href="%03i.xhtml">%s</a></li>' % (i+1, chapter.title)
+        h.extend([
+            NAV_CHAPTER % (href, xml_escape(chapter.title))
+            for href, chapter in zip(d.get_chapter_file_names(), d.chapters)
+        ])
         
         # footer
         
-        h += '            </ol>\n        </nav>\n     </body>\n</html>\n'
+        h.append(NAV_FOOTER)
         
-        return h
+        return u"".join(h)
 
 
 class TocNCX(EpubFile):
@@ -197,41 +284,38 @@ class TocNCX(EpubFile):
         self.name = "toc.ncx"
     
     def get_contents(self):
+        d = self.document
+        m = d.metadata
+        h = []
         
         # header
         
-        h = u'<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="%s">\n  <head>\n' % self.document.metadata.language
-        if self.document.metadata.uuid is not None:
-            h += '    <meta content="%s" name="dtb:uid"/>\n' % self.document.metadata.uuid
+        h.append(NCX_HEADER % xml_escape(m.language))
+        if m.uuid is not None:
+            h.append(NCX_UID % xml_escape(m.uuid))
         
         # FIXME
-        h += '    <meta content="1" name="dtb:depth"/>\n'
-        h += '    <meta content="0" name="dtb:totalPageCount"/>\n'
-        h += '    <meta content="0" name="dtb:maxPageNumber"/>\n'
-        h += '  </head>\n'
+        h.append(NCX_HEAD_END)
         
-        if self.document.metadata.title is not None:
-            h += '  <docTitle>\n    <text>%s</text>\n  </docTitle>\n' % self.document.metadata.title
-        if self.document.metadata.title is not None:
-            h += '  <docAuthor>\n    <text>%s</text>\n  </docAuthor>\n' % self.document.metadata.author
+        if m.title is not None:
+            h.append(NCX_TITLE % xml_escape(m.title))
+        if m.author is not None:
+            h.append(NCX_AUTHOR % xml_escape(m.author))
         
         # nav map
         
-        h += '  <navMap>\n'
-        for i in range(len(self.document.chapters)):
-            chapter = self.document.chapters[i]
-            h += '    <navPoint class="chapter" id="navpoint-%i" playOrder="%i">\n' % (i+1, i)
-            h += '        <navLabel>\n            <text>%s</text>\n' % chapter.title
-            h += '        </navLabel>\n'
-            h += '        <content src="%03i.xhtml"/>\n' % (i+1)
-            h += '    </navPoint>\n'
-        h += '  </navMap>\n'
+        h.append(NCX_NAVMAP_START)
+        h.extend([
+            NCX_NAVPOINT % (i + 1, i, xml_escape(chapter.title), href)
+            for i, (href, chapter) in enumerate(zip(d.get_chapter_file_names(), d.chapters))
+        ])
+        h.append(NCX_NAVMAP_END)
         
         # footer
         
-        h += '</ncx>\n'
+        h.append(NCX_FOOTER)
         
-        return h
+        return u"".join(h)
 
 
 class EpubMimeType(EpubFile):
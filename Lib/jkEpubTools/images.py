@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Image support: reading the pixel size of PNG, JPEG and GIF files, and an
+# optional optimization stage for image resources.
+#
+# The ImageOptimizer recompresses PNG files losslessly, optimizes the Huffman
+# tables of JPEG files and scales images down to a maximum pixel size. The
+# results are stored in a cache directory, keyed by the SHA-1 hash of the
+# input file and the settings, so each image is optimized only once.
+# Optimization needs PIL (or Pillow); without it, images are left as they are.
+
+import json
+import struct
+
+from hashlib import sha1
+from os import close, makedirs, remove, rename, stat
+from os.path import exists, expanduser, join, splitext
+from shutil import copyfile
+from tempfile import mkstemp
+
+from jkEpubTools.incremental import get_file_hash
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+DEFAULT_IMAGE_CACHE_DIR = join(expanduser("~"), ".cache", "jkEpubTools", "images")
+
+OPTIMIZED_MIME_TYPES = ("image/jpeg", "image/png")
+
+
+def _get_png_size(data):
+    if data[12:16] == "IHDR":
+        return struct.unpack(">II", data[16:24])
+    return None
+
+
+def _get_gif_size(data):
+    return struct.unpack("<HH", data[6:10])
+
+
+def _get_jpeg_size(f):
+    # Walk the marker segments up to the first start of frame marker
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != "\xff":
+            return None
+        code = ord(marker[1])
+        if code == 0xff:
+            # Fill byte
+            f.seek(-1, 1)
+            continue
+        if code in (0x01, 0xd0, 0xd1, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7):
+            # Markers without a length
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack(">H", length)[0]
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            segment = f.read(5)
+            if len(segment) < 5:
+                return None
+            height, width = struct.unpack(">HH", segment[1:5])
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def get_image_size(path):
+    # Return the (width, height) of a PNG, JPEG or GIF file in pixels, or None
+    # if the format is not recognized. Only the file header is read.
+    with open(path, "rb") as f:
+        data = f.read(32)
+        if data.startswith("\x89PNG\r\n\x1a\n"):
+            return _get_png_size(data)
+        if data[:6] in ("GIF87a", "GIF89a"):
+            return _get_gif_size(data)
+        if data.startswith("\xff\xd8"):
+            return _get_jpeg_size(f)
+    return None
+
+
+class ImageOptimizer(object):
+    def __init__(self, max_size=None, jpeg_quality=90, progressive=False, cache_dir=DEFAULT_IMAGE_CACHE_DIR):
+        # max_size is the maximum width and height in pixels for the target
+        # device; larger images are scaled down. jpeg_quality is used for
+        # JPEG files that are scaled; JPEG files that keep their size keep
+        # their quality. With progressive=True, JPEG files are written as
+        # progressive JPEGs, which some older reading systems can't display.
+        self.max_size = max_size
+        self.jpeg_quality = jpeg_quality
+        self.progressive = progressive
+        self.cache_dir = cache_dir
+        self.available = Image is not None
+        if not self.available:
+            print "WARNING: PIL is not installed, images will not be optimized."
+    
+    def get_settings(self):
+        return {
+            "max_size": self.max_size,
+            "jpeg_quality": self.jpeg_quality,
+            "progressive": self.progressive,
+        }
+    
+    def accepts(self, mime):
+        return self.available and mime in OPTIMIZED_MIME_TYPES
+    
+    def get_cache_path(self, src):
+        settings = sha1(json.dumps(self.get_settings(), sort_keys=True)).hexdigest()
+        return join(
+            self.cache_dir,
+            "%s-%s%s" % (get_file_hash(src), settings[:12], splitext(src)[1].lower()),
+        )
+    
+    def optimize(self, src, mime):
+        # Return the path of the optimized version of src. If it can't be made
+        # smaller without scaling, the cached file is a copy of src.
+        if not self.accepts(mime):
+            return src
+        path = self.get_cache_path(src)
+        if exists(path):
+            return path
+        if not exists(self.cache_dir):
+            makedirs(self.cache_dir)
+        fd, temp = mkstemp(suffix=".tmp", dir=self.cache_dir)
+        close(fd)
+        try:
+            scaled = self._optimize(src, temp, mime)
+            if not scaled and stat(temp).st_size >= stat(src).st_size:
+                copyfile(src, temp)
+            rename(temp, path)
+        except Exception as e:
+            print "WARNING: Image could not be optimized: '%s': %s" % (src, e)
+            if exists(temp):
+                remove(temp)
+            return src
+        return path
+    
+    def _optimize(self, src, target, mime):
+        # Returns True if the image has been scaled down
+        img = Image.open(src)
+        scaled = False
+        if self.max_size is not None and max(img.size) > self.max_size:
+            img.thumbnail((self.max_size, self.max_size), Image.ANTIALIAS)
+            scaled = True
+        if mime == "image/png":
+            img.save(target, "PNG", optimize=True)
+        elif scaled:
+            img.save(target, "JPEG", quality=self.jpeg_quality, optimize=True, progressive=self.progressive)
+        else:
+            img.save(target, "JPEG", quality="keep", optimize=True, progressive=self.progressive)
+        return scaled
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Support for incremental builds.
+#
+# A BuildManifest records a fingerprint of the inputs of every file that goes
+# into an epub: size, modification time and SHA-1 hash for files copied from
+# disk, the SHA-1 hash for generated contents. On the next build, files whose
+# source, key and hash did not change don't need to be written again; size and
+# modification time only save hashing files that were not touched.
+
+import json
+
+from binascii import hexlify
+from hashlib import sha1
+from os import remove, stat
+from os.path import exists, join
+
+from jkEpubTools.archive import CHUNK_SIZE, EpubZipFile, iter_file_chunks
+
+
+# Name of the manifest file inside a staging directory. It starts with a dot,
+# so build() does not add it to the epub.
+BUILD_MANIFEST_NAME = ".jkepubtools-build.json"
+
+# Bump this when the fingerprint format changes
+MANIFEST_VERSION = 1
+
+# The parts of a fingerprint that decide whether an entry is unchanged
+COMPARED_KEYS = ("src", "key", "sha1")
+
+
+def get_file_hash(src):
+    h = sha1()
+    with open(src, "rb") as in_file:
+        for chunk in iter_file_chunks(in_file, CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_archive_manifest_path(out_file):
+    # Path of the manifest that belongs to an epub file
+    return "%s.build.json" % out_file
+
+
+def open_incremental_archive(out_file, policy, **kwargs):
+    # Open an archive for an incremental build of out_file. The new archive
+    # is written next to the previous one and replaces it when it is closed.
+    # Additional keyword arguments are passed on to EpubZipFile.
+    manifest = BuildManifest(
+        get_archive_manifest_path(out_file),
+        {"compression": policy.get_settings()},
+    )
+    previous = None
+    if exists(out_file):
+        previous = EpubZipFile(out_file, "r")
+    else:
+        # Without the previous archive, nothing can be reused
+        manifest.previous = {}
+    return EpubZipFile(
+        "%s.tmp" % out_file,
+        "w",
+        policy=policy,
+        previous=previous,
+        manifest=manifest,
+        final_path=out_file,
+        **kwargs
+    )
+
+
+class BuildManifest(object):
+    def __init__(self, path, settings=None):
+        # settings is a dict of build options that affect all entries. If it
+        # differs from the settings of the previous build, nothing is reused.
+        self.path = path
+        self.settings = settings or {}
+        self.previous = {}
+        self.current = {}
+        self.load()
+    
+    def load(self):
+        if not exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = json.load(f)
+        except ValueError:
+            print "WARNING: Ignoring unreadable build manifest: '%s'" % self.path
+            return
+        if data.get("version", None) != MANIFEST_VERSION:
+            return
+        if data.get("settings", {}) != self.settings:
+            return
+        self.previous = data.get("entries", {})
+    
+    def save(self):
+        with open(self.path, "wb") as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "settings": self.settings,
+                    "entries": self.current,
+                },
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+    
+    def update(self, name, fingerprint):
+        # Record the fingerprint of an entry. Returns True if the entry is
+        # unchanged since the previous build. Size and modification time are
+        # not compared, a touched file with the same contents is unchanged.
+        self.current[name] = fingerprint
+        old = self.previous.get(name, None)
+        if old is None:
+            return False
+        return all(old.get(k, None) == fingerprint.get(k, None) for k in COMPARED_KEYS)
+    
+    def file_unchanged(self, name, src, key=None, st=None):
+        # Check a file that is copied from src, optionally obfuscated with key.
+        # The file is only hashed if its size or modification time differ
+        # from the previous build. st is the result of stat(src), if known.
+        if st is None:
+            st = stat(src)
+        fingerprint = {
+            "src": src,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "key": None if key is None else hexlify(key),
+        }
+        old = self.previous.get(name, None)
+        if old is not None and all(old.get(k, None) == v for k, v in fingerprint.items()):
+            # Same file, size and modification time: skip hashing it again
+            fingerprint["sha1"] = old.get("sha1", None)
+        else:
+            fingerprint["sha1"] = get_file_hash(src)
+        return self.update(name, fingerprint)
+    
+    def contents_unchanged(self, name, contents):
+        # Check generated contents, given as a byte string
+        return self.update(name, {"sha1": sha1(contents).hexdigest()})
+    
+    def get_removed(self):
+        # Names of entries from the previous build that were not written again
+        return sorted(set(self.previous) - set(self.current))
+    
+    def remove_stale_files(self, epub_root):
+        # Delete files of a staging directory that are not part of the
+        # current build any more
+        for name in self.get_removed():
+            path = join(epub_root, name)
+            if exists(path):
+                remove(path)
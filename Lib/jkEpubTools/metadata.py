@@ -3,8 +3,20 @@
 
 import uuid
 
+from jkEpubTools.reproducible import get_document_uuid, get_iso_date
+
+
+FIELDS = (
+    "version", "publisher", "rights", "language", "author", "author_sortname",
+    "title", "cover", "cover_type", "date", "subject",
+)
+
 
 class MetaData(object):
+    # Slots instead of an instance dict, as a catalog may hold the metadata
+    # of many books at once
+    __slots__ = FIELDS + ("_uuid",)
+    
     def __init__(self, md_dict={}):
         self.version = md_dict.get("version", "2.0")
         self.publisher = md_dict.get("publisher", None)
@@ -16,5 +28,33 @@ class MetaData(object):
         self.cover = md_dict.get("cover", None) # path to image file
         self.cover_type = md_dict.get("cover_type", None) # mime type of cover image file
         self.date = md_dict.get("date", None)
-        self.uuid = md_dict.get("uuid", uuid.uuid1())
+        # A time based uuid is only generated when none is supplied, and only
+        # when it is first needed
+        self._uuid = md_dict.get("uuid", None)
         self.subject = md_dict.get("subject", None)
+    
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            self._uuid = uuid.uuid1()
+        return self._uuid
+    
+    @uuid.setter
+    def uuid(self, value):
+        self._uuid = value
+    
+    def make_reproducible(self, doc_id, timestamp):
+        # Replace the values that would differ between builds by values
+        # derived from the document id and the build timestamp
+        if self._uuid is None:
+            self._uuid = get_document_uuid(doc_id)
+        if self.date is None:
+            self.date = get_iso_date(timestamp)
+    
+    def as_dict(self):
+        md_dict = dict(
+            (name, getattr(self, name)) for name in FIELDS
+            if getattr(self, name) is not None
+        )
+        md_dict["uuid"] = str(self.uuid)
+        return md_dict
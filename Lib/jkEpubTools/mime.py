@@ -5,15 +5,30 @@ from string import rsplit
 
 mime_types = {
     "css":   "text/css",
+    "gif":   "image/gif",
+    "jpeg":  "image/jpeg",
+    "jpg":   "image/jpeg",
+    "ncx":   "application/x-dtbncx+xml",
+    "opf":   "application/oebps-package+xml",
     "otf":   "application/x-font-opentype",
+    "png":   "image/png",
     "svg":   "image/svg+xml",
+    "ttf":   "application/x-font-truetype",
     "xhtml": "application/xhtml+xml",
     "xml":   "application/xhtml+xml",
     "woff":  "application/font-woff",
+    "woff2": "font/woff2",
 }
 
 def guess_mime_type(filename):
-    suffix = filename.rsplit(".")[-1]
+    suffix = filename.rsplit(".")[-1].lower()
     if suffix in mime_types:
         return mime_types[suffix]
-    return "application/octet-stream"
\ No newline at end of file
+    return "application/octet-stream"
+
+# One instance of each known mime type string, so that the resources of many
+# documents don't each hold their own copy
+_shared_mime_types = dict((m, m) for m in mime_types.values())
+
+def share_mime_type(mime):
+    return _shared_mime_types.setdefault(mime, mime)
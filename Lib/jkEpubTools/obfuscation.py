@@ -1,86 +1,109 @@
 #!/usr/bin/env python
 
+import warnings
+
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
 from hashlib import sha1
-from operator import xor
-from os.path import join, exists
+from os.path import join
+from re import compile, IGNORECASE
 from string import strip
-from re import compile, search, IGNORECASE
+
+from jkEpubTools.package import PackageError, get_package
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Number of leading bytes of a font that are obfuscated
+OBFUSCATION_LENGTH = 1040
+
+# Maximum number of key masks kept by get_obfuscation_mask
+MASK_CACHE_SIZE = 256
+
+_mask_cache = OrderedDict()
 
 
 def get_data_from_xml(xml_path, regex, one=True):
+    # Deprecated: return group 2 of the matches of regex in the lines of the
+    # file at xml_path. The control files of an epub are parsed properly by
+    # jkEpubTools.package.get_package; use its rootfiles, unique_identifier
+    # and cipher_references instead.
+    warnings.warn(
+        "get_data_from_xml is deprecated, use jkEpubTools.package.get_package",
+        DeprecationWarning,
+        stacklevel=2,
+    )
     c_regex = compile(regex, IGNORECASE)
-    xml = open(xml_path, "rb")
-    
     matches = []
-    for line in xml:
-        match = c_regex.search(line)
-        if match is not None:
-            try:
-                matches.append(match.group(2))
-            except:
-                print "  WARNING: Could not extract data from \"%s\"." % xml_path
-                print "    Line was:  %s" % line
-                print "    Regex was: %s" % regex
-            if one:
-                break
-    xml.close()
+    with open(xml_path, "rb") as xml:
+        for line in xml:
+            match = c_regex.search(line)
+            if match is not None:
+                try:
+                    matches.append(match.group(2))
+                except IndexError:
+                    print "  WARNING: Could not extract data from \"%s\"." % xml_path
+                    print "    Line was:  %s" % line
+                    print "    Regex was: %s" % regex
+                if one:
+                    break
     return matches
 
 
 def get_files_to_obfuscate(source_path):
     # Find and return the full paths of all files that should be encrypted
-    file_path = join(source_path, "META-INF", "encryption.xml")
-    if not exists(file_path):
+    try:
+        package = get_package(source_path)
+    except (PackageError, SyntaxError) as e:
+        # SyntaxError covers XML parse errors
+        print "  WARNING: Could not read the package in \"%s\": %s" % (source_path, e)
+        return []
+    if not package.has_encryption:
         # no hands, no cookies
         return []
-    
-    return get_data_from_xml(
-        file_path,
-        '(<enc:CipherReference.*uri ?= ?[\"\'])(.*)([\"\'])',
-        False,
-    )
+    return list(package.cipher_references)
 
 
 def get_obfuscation_key(source_path):
     print "Building obfuscation key ..."
-    print "  Looking for .opf paths in \"%s\" ..." % join(source_path, "META-INF", "container.xml")
-    opf_paths = get_data_from_xml(
-        join(source_path, "META-INF", "container.xml"),
-        '<rootfile.*full-path ?= ?([\"\'])(.*?)([\"\'])',
-        False,
-    )
-    if opf_paths == []:
+    print "  Reading package from \"%s\" ..." % join(source_path, "META-INF", "container.xml")
+    try:
+        package = get_package(source_path)
+    except (PackageError, SyntaxError) as e:
+        print "  ERROR: %s" % e
+        return None
+    return get_package_key(package)
+
+
+def get_package_key(package):
+    # Build the obfuscation key from a parsed Package
+    if package.rootfiles == []:
         print "  ERROR: Paths to content.opf could not be extracted from container.xml."
         return None
     
-    uid_id_regex = compile('(unique-identifier ?= ?[\"\'])(.*?)([\"\'])', IGNORECASE)
-    
-    uids = []
-    
-    for opf_path in opf_paths:
-        print "  Looking for unique identifier name in \"%s\" ..." % opf_path
-        uid_ids = get_data_from_xml(
-            join(source_path, opf_path),
-            '(unique-identifier ?= ?[\"\'])(.*?)([\"\'])',
-        )
-        
-        if uid_ids == []:
-            print "  ERROR: Unique identifier name could not be extracted from %s." % opf_path
-        
-        uid_id = uid_ids[0]
-        print "  Looking for unique identifier width name \"%s\" ..." % uid_id
-        
-        uids = get_data_from_xml(
-            join(source_path, opf_path),
-            '(<dc:identifier.*id ?= ?[\"\']%s[\"\'].*>)(.*)(</dc:identifier>)' % uid_id,
-        )
+    document = package.documents[0]
+    if document.unique_identifier_id is None:
+        print "  ERROR: Unique identifier name could not be extracted from %s." % document.path
+        return None
     
-    if uids == []:
+    uid = package.unique_identifier
+    if uid is None:
         print "  ERROR: No unique identifiers could be extracted."
         return None
     
+    uids = [uid]
     print "  Found uids: %s" % uids
     
+    key = get_key_from_identifiers(uids)
+    print "... done."
+    return key
+
+
+def get_key_from_identifiers(uids):
+    # Build the obfuscation key from a list of unique identifiers
     key = u""
     for uid in uids:
         # TODO: strip all possible whitespace: 
@@ -88,20 +111,54 @@ def get_obfuscation_key(source_path):
         #   Specifically the Unicode code points U+0020, U+0009, U+000D and U+000A
         #   must be stripped from each identifier before it is added to the
         #   concatenated space-delimited string.
-        key += "%s " % strip(uid)
+        key += "%s " % strip(unicode(uid))
     
     #   An SHA-1 digest of the UTF-8 representation of this string should be
     #   generated as specified by the Secure Hash Standard [SHA-1].
     key = sha1(strip(key).encode("utf-8"))
     #print "Key size:", key.digest_size
-    print "... done."
     return bytearray(key.digest())
 
 
+def iter_obfuscated(in_file, key, chunk_size):
+    # Yield the contents of an open file in chunks, with the obfuscated part
+    # (the first 1040 bytes) as the first chunk and the rest copied through
+    head = bytearray(in_file.read(1040))
+    yield str(xor_array(head, key))
+    while True:
+        chunk = in_file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def get_obfuscation_mask(key):
+    # Expand the key to a mask covering the whole obfuscated range. Returns
+    # the mask as a byte string and as an integer, cached per key.
+    key = str(key)
+    mask = _mask_cache.pop(key, None)
+    if mask is None:
+        if len(_mask_cache) >= MASK_CACHE_SIZE:
+            # Evict the least recently used mask
+            _mask_cache.popitem(last=False)
+        b = (key * (OBFUSCATION_LENGTH // len(key) + 1))[:OBFUSCATION_LENGTH]
+        mask = (b, int(hexlify(b), 16))
+    _mask_cache[key] = mask
+    return mask
+
+
 def xor_array(array, key):
-    for i in range(min(len(array), 1040)):
-        j = i % len(key)
-        #print u"XOR pos: %i, key: %i" % (i, j)
-        #print u"  %s xor\n  %s =\n  %s" % (bin(array[i]), bin(key[j]), bin(array[i] ^ key[j]))
-        array[i] = array[i] ^ key[j]
+    # XOR the first 1040 bytes of a bytearray with the key, in place
+    n = min(len(array), OBFUSCATION_LENGTH)
+    if n == 0:
+        return array
+    mask, mask_int = get_obfuscation_mask(key)
+    if numpy is not None:
+        a = numpy.frombuffer(array, numpy.uint8, n)
+        a ^= numpy.frombuffer(mask, numpy.uint8, n)
+    else:
+        if n < OBFUSCATION_LENGTH:
+            mask_int = int(hexlify(mask[:n]), 16)
+        value = int(hexlify(array[:n]), 16) ^ mask_int
+        array[:n] = unhexlify("%0*x" % (2 * n, value))
     return array
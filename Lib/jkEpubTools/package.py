@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Parsed model of the control files of an epub: META-INF/container.xml, the
+# package documents (.opf) it points to and META-INF/encryption.xml.
+#
+# Each file is read with a single streaming parse. The models of source
+# trees on disk are cached, so looking up the obfuscation key and the files
+# to obfuscate reads every control file only once.
+
+from collections import OrderedDict
+from hashlib import sha1
+from io import BytesIO
+from os import fstat, stat
+from os.path import abspath, exists, join
+from posixpath import dirname as url_dirname, join as url_join, normpath as url_normpath
+from urllib import unquote
+from xml.etree.cElementTree import iterparse
+
+
+CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+OPF_NS = "http://www.idpf.org/2007/opf"
+DC_NS = "http://purl.org/dc/elements/1.1/"
+ENC_NS = "http://www.w3.org/2001/04/xmlenc#"
+
+CONTAINER_PATH = "META-INF/container.xml"
+ENCRYPTION_PATH = "META-INF/encryption.xml"
+
+# Maximum number of source trees kept by get_package
+PACKAGE_CACHE_SIZE = 64
+
+_package_cache = OrderedDict()
+
+
+def _tag(ns, name):
+    return "{%s}%s" % (ns, name)
+
+
+CONTAINER_ROOTFILE = _tag(CONTAINER_NS, "rootfile")
+OPF_PACKAGE = _tag(OPF_NS, "package")
+OPF_METADATA = _tag(OPF_NS, "metadata")
+OPF_META = _tag(OPF_NS, "meta")
+OPF_SPINE = _tag(OPF_NS, "spine")
+OPF_ITEM = _tag(OPF_NS, "item")
+OPF_ITEMREF = _tag(OPF_NS, "itemref")
+DC_IDENTIFIER = _tag(DC_NS, "identifier")
+ENC_ENCRYPTED_DATA = _tag(ENC_NS, "EncryptedData")
+ENC_ENCRYPTION_METHOD = _tag(ENC_NS, "EncryptionMethod")
+ENC_CIPHER_REFERENCE = _tag(ENC_NS, "CipherReference")
+
+# Algorithm of the IDPF font obfuscation
+IDPF_OBFUSCATION = "http://www.idpf.org/2008/embedding"
+
+
+def resolve_href(base, href):
+    # Return the path inside the epub that href, relative to the directory
+    # base, points to, without a fragment identifier
+    href = unquote(href.split("#", 1)[0])
+    return url_normpath(url_join(base, href))
+
+
+class PackageError(Exception):
+    pass
+
+
+class ManifestItem(object):
+    __slots__ = ["id", "href", "media_type", "properties"]
+    
+    def __init__(self, id, href, media_type, properties=None):
+        self.id = id
+        # Path relative to the root of the epub
+        self.href = href
+        self.media_type = media_type
+        self.properties = properties
+    
+    def __repr__(self):
+        return "<ManifestItem %s: %s (%s)>" % (self.id, self.href, self.media_type)
+
+
+class PackageDocument(object):
+    def __init__(self, path, in_file):
+        # path is the full path of the .opf file inside the epub
+        self.path = path
+        self.version = None
+        self.unique_identifier_id = None
+        # List of (id, value) tuples of all dc:identifier elements
+        self.identifiers = []
+        # Values of the meta elements with a name attribute, by name
+        self.meta = {}
+        # Manifest items and spine idrefs, in document order
+        self.items = []
+        self.spine = []
+        # id of the NCX, given by the toc attribute of the spine
+        self.spine_toc = None
+        self.parse(in_file)
+    
+    def parse(self, in_file):
+        base = url_dirname(self.path)
+        for event, elem in iterparse(in_file, ("start", "end")):
+            if event == "start":
+                if elem.tag == OPF_PACKAGE:
+                    self.version = elem.get("version")
+                    self.unique_identifier_id = elem.get("unique-identifier")
+                elif elem.tag == OPF_SPINE:
+                    self.spine_toc = elem.get("toc")
+                continue
+            if elem.tag == DC_IDENTIFIER:
+                self.identifiers.append((elem.get("id"), (elem.text or u"").strip()))
+            elif elem.tag == OPF_ITEM:
+                href = elem.get("href")
+                if href is not None:
+                    href = resolve_href(base, href)
+                self.items.append(ManifestItem(
+                    elem.get("id"),
+                    href,
+                    elem.get("media-type"),
+                    elem.get("properties"),
+                ))
+            elif elem.tag == OPF_META:
+                if elem.get("name") is not None:
+                    self.meta[elem.get("name")] = elem.get("content")
+            elif elem.tag == OPF_ITEMREF:
+                self.spine.append(elem.get("idref"))
+            elif elem.tag == OPF_METADATA or elem.tag == OPF_PACKAGE:
+                continue
+            # Only the attributes and text of the element itself are needed
+            elem.clear()
+    
+    @property
+    def unique_identifier(self):
+        # The value of the dc:identifier referenced by unique-identifier
+        for uid_id, value in self.identifiers:
+            if uid_id == self.unique_identifier_id:
+                return value
+        return None
+    
+    def get_item(self, item_id):
+        for item in self.items:
+            if item.id == item_id:
+                return item
+        return None
+
+
+class Package(object):
+    def __init__(self, open_file):
+        # open_file is called with the path of a file inside the epub and
+        # must return an open file object, or None if the file is missing.
+        # Use Package.from_path or Package.from_archive to create one.
+        self.rootfiles = []
+        self.documents = []
+        self.cipher_references = []
+        # Encryption algorithm by cipher reference
+        self.cipher_algorithms = {}
+        self.has_encryption = False
+        self.parse(open_file)
+    
+    @classmethod
+    def from_path(cls, source_path):
+        # Read the control files of a source tree on disk
+        def open_file(name):
+            path = join(source_path, *name.split("/"))
+            if not exists(path):
+                return None
+            return open(path, "rb")
+        return cls(open_file)
+    
+    @classmethod
+    def from_archive(cls, z):
+        # Read the control files of an open zipfile.ZipFile
+        def open_file(name):
+            if name not in z.NameToInfo:
+                return None
+            return z.open(name)
+        return cls(open_file)
+    
+    def parse(self, open_file):
+        in_file = open_file(CONTAINER_PATH)
+        if in_file is None:
+            raise PackageError("%s not found." % CONTAINER_PATH)
+        try:
+            for event, elem in iterparse(in_file):
+                if elem.tag == CONTAINER_ROOTFILE:
+                    full_path = elem.get("full-path")
+                    if full_path:
+                        self.rootfiles.append(full_path)
+        finally:
+            in_file.close()
+        
+        for path in self.rootfiles:
+            in_file = open_file(path)
+            if in_file is None:
+                raise PackageError("Package document %s not found." % path)
+            try:
+                self.documents.append(PackageDocument(path, in_file))
+            finally:
+                in_file.close()
+        
+        in_file = open_file(ENCRYPTION_PATH)
+        if in_file is not None:
+            self.has_encryption = True
+            try:
+                algorithm = None
+                for event, elem in iterparse(in_file):
+                    if elem.tag == ENC_ENCRYPTION_METHOD:
+                        algorithm = elem.get("Algorithm")
+                    elif elem.tag == ENC_CIPHER_REFERENCE:
+                        uri = elem.get("URI", elem.get("uri"))
+                        if uri:
+                            self.cipher_references.append(uri)
+                            self.cipher_algorithms[uri] = algorithm
+                    elif elem.tag == ENC_ENCRYPTED_DATA:
+                        algorithm = None
+                    elem.clear()
+            finally:
+                in_file.close()
+    
+    @property
+    def unique_identifier(self):
+        # The unique identifier of the default rendition, i.e. of the first
+        # rootfile. The obfuscation key is derived from it.
+        if not self.documents:
+            return None
+        return self.documents[0].unique_identifier
+    
+    @property
+    def identifiers(self):
+        # All dc:identifier values of all package documents
+        return [value for doc in self.documents for uid_id, value in doc.identifiers]
+    
+    @property
+    def obfuscated_files(self):
+        # Cipher references that use the IDPF font obfuscation
+        return [
+            uri for uri in self.cipher_references
+            if self.cipher_algorithms[uri] == IDPF_OBFUSCATION
+        ]
+    
+    def get_paths(self):
+        # Paths of the control files that make up the package
+        paths = [CONTAINER_PATH] + self.rootfiles
+        if self.has_encryption:
+            paths.append(ENCRYPTION_PATH)
+        return paths
+
+
+def _read_control_file(source_path, name):
+    # Return the signature entry (name, size, mtime, SHA-1 hash) and the
+    # contents of a control file, or Nones if it does not exist
+    path = join(source_path, *name.split("/"))
+    try:
+        with open(path, "rb") as f:
+            st = fstat(f.fileno())
+            data = f.read()
+    except IOError:
+        return (name, None, None, None), None
+    return (name, st.st_size, st.st_mtime, sha1(data).hexdigest()), data
+
+
+def _stat_unchanged(source_path, signature):
+    # Whether all control files have the size and modification time they
+    # had when the signature was taken
+    for name, size, mtime, digest in signature:
+        try:
+            st = stat(join(source_path, *name.split("/")))
+        except OSError:
+            if size is not None:
+                return False
+            continue
+        if (st.st_size, st.st_mtime) != (size, mtime):
+            return False
+    return True
+
+
+def _cache_package(source_path, signature, package):
+    _package_cache.pop(source_path, None)
+    if len(_package_cache) >= PACKAGE_CACHE_SIZE:
+        # Evict the least recently used package
+        _package_cache.popitem(last=False)
+    _package_cache[source_path] = (signature, package)
+
+
+def get_package(source_path):
+    # Return the Package of a source tree on disk. The result is cached. The
+    # control files are only read again when their size or modification time
+    # changes, and only parsed again when their contents change. Each file is
+    # read once and parsed from the same bytes that are hashed.
+    source_path = abspath(source_path)
+    contents = {}
+    
+    def read(name):
+        if name not in contents:
+            contents[name] = _read_control_file(source_path, name)
+        return contents[name]
+    
+    cached = _package_cache.get(source_path)
+    if cached is not None:
+        signature, package = cached
+        if _stat_unchanged(source_path, signature):
+            _cache_package(source_path, signature, package)
+            return package
+        new_signature = tuple(read(entry[0])[0] for entry in signature)
+        if [entry[3] for entry in new_signature] == [entry[3] for entry in signature]:
+            # The files have been touched, but not changed
+            _cache_package(source_path, new_signature, package)
+            return package
+    
+    def open_file(name):
+        data = read(name)[1]
+        if data is None:
+            return None
+        return BytesIO(data)
+    
+    package = Package(open_file)
+    # encryption.xml is part of the signature even if it does not exist yet,
+    # so that adding it invalidates the cached package
+    names = package.get_paths()
+    if not package.has_encryption:
+        names.append(ENCRYPTION_PATH)
+    _cache_package(source_path, tuple(read(name)[0] for name in names), package)
+    return package
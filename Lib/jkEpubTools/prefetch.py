@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Concurrent prefetching of source files.
+#
+# On high-latency storage (NFS and the like), checking and reading the source
+# files of a book one after the other is dominated by round-trips. A
+# Prefetcher stats all source paths with a pool of threads and reads the
+# files ahead of the archive writer, a bounded window at a time, so the
+# writer can consume them in spine order.
+
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from os import stat
+
+
+DEFAULT_CONCURRENCY = 8
+
+# Larger files are not read into memory, they are streamed by the writer
+MAX_FILE_SIZE = 8 * 1024 * 1024
+
+
+def _stat(path):
+    try:
+        return stat(path)
+    except OSError:
+        return None
+
+
+def _read(path, max_file_size):
+    try:
+        if stat(path).st_size > max_file_size:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    except (IOError, OSError):
+        # The writer will report the error when it opens the file itself
+        return None
+
+
+class Prefetcher(object):
+    def __init__(self, paths, concurrency=DEFAULT_CONCURRENCY, window=None, max_file_size=MAX_FILE_SIZE):
+        # paths must be given in the order in which they will be opened.
+        # At most window files (default: twice the concurrency) are held in
+        # memory ahead of the writer.
+        self.paths = list(paths)
+        self.window = window or 2 * concurrency
+        self.max_file_size = max_file_size
+        self.hits = 0
+        self.misses = 0
+        self._pool = ThreadPool(concurrency)
+        self._stats = None
+        self._stat_result = self._pool.map_async(_stat, self.paths)
+        self._reads = {}
+        self._next = 0
+        self._fill()
+    
+    def _fill(self):
+        while len(self._reads) < self.window and self._next < len(self.paths):
+            path = self.paths[self._next]
+            self._next += 1
+            if path not in self._reads:
+                self._reads[path] = self._pool.apply_async(_read, (path, self.max_file_size))
+    
+    def stat(self, path):
+        # Like os.stat, but answered from the concurrent stat pass
+        if self._stats is None:
+            self._stats = dict(zip(self.paths, self._stat_result.get()))
+        if path not in self._stats:
+            return stat(path)
+        st = self._stats[path]
+        if st is None:
+            raise OSError("No such file: '%s'" % path)
+        return st
+    
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            # A missing file is never opened
+            self.skip(path)
+            return False
+        return True
+    
+    def open(self, path):
+        # Return a readable file object for path, from memory if the file
+        # has been prefetched
+        result = self._reads.pop(path, None)
+        self._fill()
+        if result is not None:
+            data = result.get()
+            if data is not None:
+                self.hits += 1
+                return BytesIO(data)
+        self.misses += 1
+        return open(path, "rb")
+    
+    def skip(self, path):
+        # Drop the read of a file that the writer will not open, e.g.
+        # because its entry is reused or cached, and move the window on
+        self._reads.pop(path, None)
+        self._fill()
+    
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        self._reads = {}
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Build instrumentation.
+#
+# A BuildProfile collects the wall and CPU time of build stages, the bytes
+# read and written for each archive entry and counters like cache hits or the
+# seconds spent on font obfuscation. Pass one as the profile argument of
+# Document.save_epub, Document.write_epub or build(). It can call a callback
+# for every record as it happens, and write a JSON report when the build is
+# done.
+
+import json
+import time
+
+from contextlib import contextmanager
+from os import times
+
+
+def get_cpu_time():
+    # User and system CPU time of the process in seconds
+    t = times()
+    return t[0] + t[1]
+
+
+class BuildProfile(object):
+    def __init__(self, callback=None):
+        # callback is called as callback(event, record) with event being one
+        # of "stage", "entry" or "count"
+        self.callback = callback
+        self.stages = []
+        self.entries = []
+        self.counters = {}
+        self._depth = 0
+    
+    def _notify(self, event, record):
+        if self.callback is not None:
+            self.callback(event, record)
+    
+    @contextmanager
+    def stage(self, name):
+        # Time a build stage. Stages can be nested.
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            record = {
+                "name": name,
+                "depth": self._depth,
+                "wall": time.time() - start_wall,
+                "cpu": get_cpu_time() - start_cpu,
+            }
+            self.stages.append(record)
+            self._notify("stage", record)
+    
+    def add_entry(self, name, source, bytes_read, bytes_written, wall, cpu):
+        # Record an archive entry. source is "disk" for files copied from
+        # disk, "generated" for generated contents, "cache" for entries from
+        # a ResourceCache and "previous" for entries copied from the previous
+        # build.
+        record = {
+            "name": name,
+            "source": source,
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "wall": wall,
+            "cpu": cpu,
+        }
+        self.entries.append(record)
+        self._notify("entry", record)
+    
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+        self._notify("count", {"name": name, "value": self.counters[name]})
+    
+    def as_dict(self):
+        return {
+            "stages": self.stages,
+            "entries": self.entries,
+            "counters": self.counters,
+            "totals": {
+                "wall": sum(s["wall"] for s in self.stages if s["depth"] == 0),
+                "cpu": sum(s["cpu"] for s in self.stages if s["depth"] == 0),
+                "bytes_read": sum(e["bytes_read"] for e in self.entries),
+                "bytes_written": sum(e["bytes_written"] for e in self.entries),
+            },
+        }
+    
+    def save_json(self, path):
+        with open(path, "wb") as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+    
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+class NullProfile(object):
+    # Does nothing; used when no profile is requested
+    _stage = _NullStage()
+    
+    def stage(self, name):
+        return self._stage
+    
+    def add_entry(self, name, source, bytes_read, bytes_written, wall, cpu):
+        pass
+    
+    def count(self, name, n=1):
+        pass
+
+
+NULL_PROFILE = NullProfile()
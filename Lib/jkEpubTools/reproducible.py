@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Support for reproducible builds.
+#
+# With reproducible=True, Document.save_epub, Document.write_epub and build
+# produce byte-identical archives for identical inputs:
+#
+# - All archive entries get the same timestamp and permissions, and the
+#   entries are added in a fixed order.
+# - A missing date in the metadata is set from the build timestamp, and a
+#   missing uuid is derived from the document id.
+#
+# The build timestamp is taken from the SOURCE_DATE_EPOCH environment
+# variable (see https://reproducible-builds.org/specs/source-date-epoch/).
+# Without it, the earliest date a zip file can store is used.
+
+import time
+import uuid
+
+from os import environ
+
+
+# 1980-01-01 00:00:00 UTC
+ZIP_EPOCH = 315532800
+
+
+def get_build_timestamp():
+    # Return the timestamp of a reproducible build, in seconds since the epoch
+    value = environ.get("SOURCE_DATE_EPOCH", None)
+    if value is None:
+        return ZIP_EPOCH
+    try:
+        return max(int(value), ZIP_EPOCH)
+    except ValueError:
+        print "WARNING: Invalid SOURCE_DATE_EPOCH '%s', using 1980-01-01." % value
+        return ZIP_EPOCH
+
+
+def get_zip_date_time(timestamp):
+    # Return the date_time tuple of the archive entries for a timestamp
+    return time.gmtime(timestamp)[:6]
+
+
+def get_iso_date(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(timestamp))
+
+
+def get_document_uuid(doc_id):
+    # Return a uuid that only depends on the document id
+    if isinstance(doc_id, unicode):
+        doc_id = doc_id.encode("utf-8")
+    return uuid.uuid5(uuid.NAMESPACE_URL, doc_id)
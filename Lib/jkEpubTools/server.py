@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# A long-running build server.
+#
+# The server keeps the modules imported and a ResourceCache of prepared
+# archive entries warm between builds, so that fonts and images shared
+# between books are read, obfuscated and compressed only once. Jobs are sent
+# over a local Unix socket, or a TCP port on localhost, as one JSON object per
+# line:
+#
+#   {"manifest": {...}}                   a manifest as for jkEpubTools.batch
+#   {"manifest": {...}, "data": true}     also return the epub as base64
+#   {"manifest": {...}, "validate": true} validate the finished epub
+#
+# Each job is answered with one JSON line:
+#
+#   {"id": "...", "output": "/path/to/book.epub", "ok": true, "error": null,
+#    "time": 0.01}
+#
+# Relative paths in the manifests are relative to the working directory of
+# the server. Connections are handled in threads, so clients can keep their
+# connection open for several jobs, but the builds run one at a time.
+
+import errno
+import json
+import socket
+import sys
+import threading
+
+from base64 import b64encode
+from optparse import OptionParser
+from os import remove, stat
+from os.path import abspath, exists
+from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn, UnixStreamServer
+from stat import S_ISSOCK
+
+from jkEpubTools.batch import build_book, init_worker
+from jkEpubTools.cache import DEFAULT_CACHE_SIZE
+
+
+DEFAULT_PORT = 8765
+
+
+class BuildService(object):
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        # The resource cache of jkEpubTools.batch is used for all builds
+        init_worker(cache_size)
+        self.lock = threading.Lock()
+        self.builds = 0
+    
+    def run(self, job):
+        # Build the book of a job and return the response dict
+        if not isinstance(job, dict):
+            return {"ok": False, "error": "The job must be a JSON object."}
+        manifest = job.get("manifest", None)
+        if not isinstance(manifest, dict):
+            return {"ok": False, "error": "The job has no manifest."}
+        with self.lock:
+            result = build_book(manifest, validate=job.get("validate", False))
+            self.builds += 1
+        response = {
+            "id": result.book_id,
+            "output": abspath(result.output),
+            "ok": result.ok,
+            "error": result.error,
+            "time": result.time,
+        }
+        if result.ok and job.get("data", False):
+            with open(result.output, "rb") as f:
+                response["data"] = b64encode(f.read())
+        return response
+
+
+class BuildRequestHandler(StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                response = {"ok": False, "error": "Invalid job: %s" % e}
+            else:
+                response = self.server.service.run(job)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+def _is_listening(path):
+    # Whether a server accepts connections on the Unix socket at path
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        s.close()
+    return True
+
+
+class UnixBuildServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    
+    def __init__(self, path, service):
+        # A socket file left over from a previous server is replaced. If a
+        # server still listens on it, or path is not a socket, an IOError is
+        # raised.
+        if exists(path):
+            if not S_ISSOCK(stat(path).st_mode):
+                raise IOError("Not a socket: '%s'" % path)
+            if _is_listening(path):
+                raise IOError("A server is already listening on '%s'" % path)
+            remove(path)
+        self.service = service
+        UnixStreamServer.__init__(self, path, BuildRequestHandler)
+    
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if exists(self.server_address):
+            remove(self.server_address)
+
+
+class TCPBuildServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, port, service):
+        # Only local connections are accepted
+        self.service = service
+        TCPServer.__init__(self, ("127.0.0.1", port), BuildRequestHandler)
+
+
+def submit(address, manifest, data=False, validate=False):
+    # Send one job to the build server at address (the path of a Unix
+    # socket, or a port on localhost) and return its response dict
+    if isinstance(address, int):
+        s = socket.create_connection(("127.0.0.1", address))
+    else:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(address)
+    try:
+        f = s.makefile("rwb")
+        f.write(json.dumps({"manifest": manifest, "data": data, "validate": validate}) + "\n")
+        f.flush()
+        response = f.readline()
+        f.close()
+    finally:
+        s.close()
+    if not response:
+        return {"ok": False, "error": "The server closed the connection."}
+    return json.loads(response)
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--socket", default=None,
+        help="listen on this Unix socket")
+    parser.add_option("-p", "--port", type="int", default=None,
+        help="listen on this TCP port on localhost (default: %i)" % DEFAULT_PORT)
+    parser.add_option("--cache-size", type="int", default=DEFAULT_CACHE_SIZE,
+        help="size of the resource cache in bytes (default: %i)" % DEFAULT_CACHE_SIZE)
+    options, args = parser.parse_args(args)
+    if options.socket is not None and options.port is not None:
+        parser.error("Use either a socket or a port.")
+    
+    service = BuildService(options.cache_size)
+    if options.socket is not None:
+        try:
+            server = UnixBuildServer(options.socket, service)
+        except IOError as e:
+            print "ERROR: %s" % e
+            return 1
+        print "Build server listening on %s" % options.socket
+    else:
+        server = TCPBuildServer(options.port or DEFAULT_PORT, service)
+        print "Build server listening on port %i" % server.server_address[1]
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Split oversized XHTML chapters into several spine items.
+#
+# A chapter file is parsed once, as a stream, to find the byte offsets of the
+# block elements directly inside <body>. Each part is the original header up
+# to and including the <body> tag, a run of complete block elements copied
+# byte for byte from the source, and the original closing tags. The parts
+# are read from the source file again when they are written, so a chapter
+# never needs to be in memory as a whole.
+#
+# The ids of the elements in the body are recorded with the part they end up
+# in. A LinkRewriter changes links to fragments that moved into another part,
+# like "002.xhtml#note3" or "#note3", to point to that part. The links are
+# rewritten as the chapters are streamed into the epub.
+
+import re
+
+from bisect import bisect_right
+from xml.parsers import expat
+
+from jkEpubTools.archive import CHUNK_SIZE, iter_file_chunks
+
+
+# Default maximum size of a spine item in bytes
+DEFAULT_SPLIT_SIZE = 256 * 1024
+
+HEADINGS = set(["h1", "h2", "h3", "h4", "h5", "h6"])
+
+# Block elements before which a chapter may be split
+SPLIT_ELEMENTS = HEADINGS | set([
+    "p", "div", "section", "article", "blockquote", "figure",
+    "ul", "ol", "dl", "table", "pre", "hr",
+])
+
+# Links with a fragment identifier. As "<" can't appear in attribute values,
+# no link spans a "<".
+FRAGMENT_LINK_RE = re.compile(r"""(\shref\s*=\s*)(["'])([^"'#<>]*)#([^"'<>]+)\2""")
+
+
+class ChapterSplit(object):
+    def __init__(self, src, offsets, tail_offset, ids=None):
+        # offsets are the start offsets of the parts, the first one being the
+        # end of the <body> tag; tail_offset is the offset of </body>. ids is
+        # a list of (offset, id) tuples of the elements in the body.
+        self.src = src
+        self.offsets = offsets
+        self.tail_offset = tail_offset
+        # Index of the part each id ends up in
+        self.id_parts = {}
+        for offset, element_id in ids or []:
+            self.id_parts[element_id] = max(bisect_right(offsets, offset) - 1, 0)
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def iter_part(self, index, chunk_size=CHUNK_SIZE):
+        # Yield the contents of a part as byte strings
+        with open(self.src, "rb") as f:
+            yield f.read(self.offsets[0])
+            if index + 1 < len(self.offsets):
+                end = self.offsets[index + 1]
+            else:
+                end = self.tail_offset
+            f.seek(self.offsets[index])
+            remaining = end - self.offsets[index]
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            f.seek(self.tail_offset)
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class _SplitFinder(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.parser = expat.ParserCreate()
+        # Treat the document as if it had an external DTD, so that named
+        # entities like &nbsp; are skipped instead of being errors
+        self.parser.UseForeignDTD(True)
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.other
+        self.parser.CommentHandler = self.other
+        self.parser.ProcessingInstructionHandler = self.other
+        self.depth = 0
+        self.body_depth = None
+        self.body_pending = False
+        self.offsets = []
+        self.candidate = None
+        self.tail_offset = None
+        self.ids = []
+    
+    def _mark_body_end(self):
+        if self.body_pending:
+            # The first event after the <body> tag is where its content starts
+            self.body_pending = False
+            self.offsets.append(self.parser.CurrentByteIndex)
+    
+    def other(self, *args):
+        self._mark_body_end()
+    
+    def start_element(self, name, attrs):
+        self._mark_body_end()
+        self.depth += 1
+        name = name.rsplit(":", 1)[-1].lower()
+        if self.body_depth is None:
+            if name == "body":
+                self.body_depth = self.depth
+                self.body_pending = True
+        elif self.tail_offset is None:
+            if self.depth == self.body_depth + 1 and name in SPLIT_ELEMENTS:
+                self.add_candidate(self.parser.CurrentByteIndex, name in HEADINGS)
+            if "id" in attrs:
+                self.ids.append((self.parser.CurrentByteIndex, attrs["id"]))
+    
+    def end_element(self, name):
+        if self.depth == self.body_depth and self.tail_offset is None:
+            self._mark_body_end()
+            self.tail_offset = self.parser.CurrentByteIndex
+            self.check_size(self.tail_offset)
+        self.depth -= 1
+    
+    def check_size(self, offset):
+        # Split at the last candidate if the current part would grow beyond
+        # the limit. The header counts towards the size of each part.
+        part_start = self.offsets[-1]
+        if offset - part_start + self.offsets[0] > self.max_size:
+            if self.candidate is not None and self.candidate > part_start:
+                self.offsets.append(self.candidate)
+    
+    def add_candidate(self, offset, heading):
+        if not self.offsets:
+            return
+        self.check_size(offset)
+        part_start = self.offsets[-1]
+        if heading and offset > part_start and 2 * (offset - part_start + self.offsets[0]) >= self.max_size:
+            # Prefer to start a new part with a heading, if the current part
+            # is at least half full
+            self.offsets.append(offset)
+        self.candidate = offset
+    
+    def feed(self, in_file, chunk_size=CHUNK_SIZE):
+        while True:
+            chunk = in_file.read(chunk_size)
+            if not chunk:
+                break
+            self.parser.Parse(chunk, False)
+        self.parser.Parse("", True)
+
+
+def split_xhtml(src, max_size=DEFAULT_SPLIT_SIZE):
+    # Find the parts of the XHTML file src so that each is at most max_size
+    # bytes, as far as the block elements allow. Returns a ChapterSplit, or
+    # None if the file is small enough or can't be split.
+    finder = _SplitFinder(max_size)
+    try:
+        with open(src, "rb") as in_file:
+            finder.feed(in_file)
+    except expat.ExpatError as e:
+        print "WARNING: Chapter can't be split, XML error in '%s': %s" % (src, e)
+        return None
+    if finder.tail_offset is None or len(finder.offsets) < 2:
+        return None
+    return ChapterSplit(src, finder.offsets, finder.tail_offset, finder.ids)
+
+
+def _iter_tag_aligned(chunks):
+    # Yield the chunks of an XML file cut before a "<", so that no tag is cut
+    # in two
+    rest = ""
+    for chunk in chunks:
+        data = rest + chunk
+        end = data.rfind("<")
+        if end <= 0:
+            rest = data
+            continue
+        rest = data[end:]
+        yield data[:end]
+    if rest:
+        yield rest
+
+
+class LinkRewriter(object):
+    # Rewrites links to fragments of split chapters, so that they point to
+    # the part that holds the fragment
+    def __init__(self, targets):
+        # targets maps (file name, id) tuples to the file name of the part
+        # that holds the id. The chapter files are in the same directory, so
+        # their links are plain file names.
+        self.targets = targets
+    
+    def _get_target(self, m, file_name, current):
+        # Return the part a link points to, or None if it needs no change.
+        # file_name is the chapter the link comes from, current the file it
+        # is written to.
+        target = self.targets.get((m.group(3) or file_name, m.group(4)), None)
+        if target is None or target == (m.group(3) or current):
+            return None
+        return target
+    
+    def iter_rewritten(self, chunks, file_name, current=None):
+        # Yield the chunks of an XHTML file with the links rewritten
+        if current is None:
+            current = file_name
+        
+        def replace(m):
+            target = self._get_target(m, file_name, current)
+            if target is None:
+                return m.group(0)
+            return "%s%s%s#%s%s" % (m.group(1), m.group(2), target, m.group(4), m.group(2))
+        
+        for chunk in _iter_tag_aligned(chunks):
+            yield FRAGMENT_LINK_RE.sub(replace, chunk)
+    
+    def links_to_parts(self, path, file_name):
+        # Whether the XHTML file at path, written as file_name, has links
+        # that need to be rewritten
+        with open(path, "rb") as f:
+            for chunk in _iter_tag_aligned(iter_file_chunks(f, CHUNK_SIZE)):
+                for m in FRAGMENT_LINK_RE.finditer(chunk):
+                    if self._get_target(m, file_name, file_name) is not None:
+                        return True
+        return False
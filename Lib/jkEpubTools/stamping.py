@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stamping of per-customer editions from a finished base epub.
+#
+# An edition gets its own unique identifier, and optionally its own rights
+# statement. Only the package document and the NCX are rewritten, and as the
+# font obfuscation key is derived from the unique identifier, the first 1040
+# bytes of each obfuscated font are XORed with the old and the new key. All
+# other entries are copied without recompressing them.
+#
+# The base epub is read and parsed once by BaseEdition, so that many
+# editions can be stamped from it quickly. Fonts that are deflated in the
+# base epub have to be recompressed for each edition; for the fastest
+# stamping, build the base epub with the fonts stored, e.g. with
+# CompressionPolicy(stored_types=COMPRESSED_MIME_TYPES | FONT_MIME_TYPES)
+# with both sets from jkEpubTools.compression.
+
+import re
+import sys
+import uuid
+import zipfile
+
+from itertools import chain
+from optparse import OptionParser
+from os import remove
+from os.path import exists
+
+from jkEpubTools.archive import EpubZipFile, iter_file_chunks
+from jkEpubTools.files import OPF_RIGHTS, xml_escape
+from jkEpubTools.obfuscation import OBFUSCATION_LENGTH, get_key_from_identifiers, xor_array
+from jkEpubTools.package import IDPF_OBFUSCATION, Package, PackageError
+
+
+NCX_MIME_TYPE = "application/x-dtbncx+xml"
+
+RIGHTS_RE = re.compile(r"(<(?:\w+:)?rights\b[^>]*>)(.*?)(</(?:\w+:)?rights>)", re.DOTALL)
+METADATA_END_RE = re.compile(r"[ \t]*</(?:\w+:)?metadata>")
+NCX_UID_RE = re.compile(r"""<meta\b[^>]*\bname\s*=\s*["']dtb:uid["'][^>]*>""")
+CONTENT_ATTRIBUTE_RE = re.compile(r"""(\bcontent\s*=\s*)(["']).*?\2""", re.DOTALL)
+
+
+def _get_identifier_re(uid_id):
+    return re.compile(
+        r"""(<(?:\w+:)?identifier\b[^>]*\bid\s*=\s*["']%s["'][^>]*>)(.*?)(</(?:\w+:)?identifier>)""" % re.escape(uid_id),
+        re.DOTALL,
+    )
+
+
+def _escape(value):
+    return xml_escape(value).encode("utf-8")
+
+
+class BaseEdition(object):
+    def __init__(self, path):
+        # Read the package of the base epub at path
+        self.path = path
+        self.source = EpubZipFile(path, "r")
+        try:
+            self._read_package()
+        except:
+            self.source.close()
+            raise
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        self.source.close()
+    
+    def _read_package(self):
+        package = Package.from_archive(self.source)
+        if not package.documents:
+            raise PackageError("container.xml does not list a package document.")
+        document = package.documents[0]
+        if package.unique_identifier is None:
+            raise PackageError("%s has no unique identifier." % document.path)
+        self.opf_path = document.path
+        self.opf = self.source.read(self.opf_path)
+        self.identifier_re = _get_identifier_re(document.unique_identifier_id)
+        if self.identifier_re.search(self.opf) is None:
+            raise PackageError("The unique identifier of %s could not be found." % document.path)
+        
+        self.ncx_path = None
+        self.ncx = None
+        ncx = document.get_item(document.spine_toc) if document.spine_toc else None
+        if ncx is None:
+            for item in document.items:
+                if item.media_type == NCX_MIME_TYPE:
+                    ncx = item
+        if ncx is not None and ncx.href in self.source.NameToInfo:
+            self.ncx_path = ncx.href
+            self.ncx = self.source.read(ncx.href)
+        
+        self.key = get_key_from_identifiers([package.unique_identifier])
+        self.fonts = set(
+            uri for uri in package.cipher_references
+            if package.cipher_algorithms[uri] == IDPF_OBFUSCATION
+        )
+    
+    def get_opf(self, identifier, rights=None):
+        # Return the package document with a new unique identifier and
+        # rights statement
+        opf = self.identifier_re.sub(
+            lambda m: m.group(1) + _escape(identifier) + m.group(3),
+            self.opf,
+            1,
+        )
+        if rights is not None:
+            rights = _escape(rights)
+            if RIGHTS_RE.search(opf) is not None:
+                opf = RIGHTS_RE.sub(lambda m: m.group(1) + rights + m.group(3), opf, 1)
+            else:
+                opf = METADATA_END_RE.sub(
+                    lambda m: OPF_RIGHTS.encode("utf-8") % rights + m.group(0),
+                    opf,
+                    1,
+                )
+        return opf
+    
+    def get_ncx(self, identifier):
+        # Return the NCX with a new dtb:uid
+        identifier = _escape(identifier)
+        return NCX_UID_RE.sub(
+            lambda m: CONTENT_ATTRIBUTE_RE.sub(
+                lambda a: "%s\"%s\"" % (a.group(1), identifier),
+                m.group(0),
+                1,
+            ),
+            self.ncx,
+            1,
+        )
+    
+    def stamp(self, out_file, metadata):
+        # Write an edition of the base epub to out_file (a path or a
+        # file-like object). metadata is a dict with the new "uuid" (a new
+        # random one if it is missing) and, optionally, the new "rights".
+        # Returns the unique identifier of the edition.
+        identifier = metadata.get("uuid", None)
+        if identifier is None:
+            identifier = uuid.uuid4()
+        identifier = unicode(identifier)
+        new_key = get_key_from_identifiers([identifier])
+        # XORing with the old key removes the old obfuscation
+        key = bytearray(a ^ b for a, b in zip(self.key, new_key))
+        
+        z = EpubZipFile(out_file, "w")
+        try:
+            for zinfo in self.source.infolist():
+                name = zinfo.filename
+                if name == self.opf_path:
+                    self._write_entry(z, zinfo, self.get_opf(identifier, metadata.get("rights", None)))
+                elif name == self.ncx_path:
+                    self._write_entry(z, zinfo, self.get_ncx(identifier))
+                elif name in self.fonts:
+                    self._write_font(z, zinfo, key)
+                else:
+                    z.copy_entry(self.source, name)
+            z.close()
+        except:
+            # Don't leave an incomplete edition behind
+            z.abort()
+            if isinstance(out_file, basestring) and exists(out_file):
+                remove(out_file)
+            raise
+        return identifier
+    
+    def _write_entry(self, z, zinfo, data):
+        info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+        info.external_attr = zinfo.external_attr
+        z.write_chunks(info, [data], zinfo.compress_type)
+    
+    def _write_font(self, z, zinfo, key):
+        with self.source.open(zinfo) as in_file:
+            head = bytearray(in_file.read(OBFUSCATION_LENGTH))
+            info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+            info.external_attr = zinfo.external_attr
+            z.write_chunks(
+                info,
+                chain([str(xor_array(head, key))], iter_file_chunks(in_file)),
+                zinfo.compress_type,
+            )
+
+
+def stamp_epub(base_path, out_file, metadata):
+    # Write an edition of the epub at base_path, see BaseEdition.stamp. To
+    # stamp many editions, use one BaseEdition instead.
+    with BaseEdition(base_path) as base:
+        return base.stamp(out_file, metadata)
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options] base.epub out.epub")
+    parser.add_option("-u", "--uuid", default=None,
+        help="unique identifier of the edition (default: a new random uuid)")
+    parser.add_option("-r", "--rights", default=None,
+        help="rights statement of the edition")
+    options, paths = parser.parse_args(args)
+    if len(paths) != 2:
+        parser.error("Expected a base and an output file.")
+    
+    metadata = {"uuid": options.uuid}
+    if options.rights is not None:
+        metadata["rights"] = options.rights.decode(sys.stdin.encoding or "utf-8")
+    try:
+        identifier = stamp_epub(paths[0], paths[1], metadata)
+    except (PackageError, SyntaxError) as e:
+        # SyntaxError covers XML parse errors
+        print "ERROR: %s" % e
+        return 1
+    print "Stamped \"%s\" with %s" % (paths[1], identifier)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Streaming of epub files to outputs that can't seek, like sockets, pipes or
+# WSGI responses.
+#
+# Entries whose contents are streamed are written with a data descriptor:
+# the local file header is written with a CRC and sizes of zero, and the real
+# values follow the data. Entries that are generated in memory, including
+# the mimetype entry, get a complete local header, so the mimetype entry
+# stays readable at its fixed offset.
+#
+# Document.write_epub_stream writes into a file-like object with a write
+# method. iter_epub yields the archive in chunks instead, for a WSGI
+# response; the archive is written by a thread into a bounded queue, so only
+# a few chunks are held in memory at a time.
+
+import struct
+import sys
+import threading
+import zipfile
+
+from Queue import Queue
+
+from jkEpubTools.archive import CHUNK_SIZE, EpubZipFile, prepare_entry
+
+
+DATA_DESCRIPTOR_SIGNATURE = "PK\x07\x08"
+
+
+class _CountingWriter(object):
+    # Keeps track of the position for zipfile, as the output can't tell
+    def __init__(self, out):
+        self.out = out
+        self.position = 0
+    
+    def write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        if hasattr(self.out, "flush"):
+            self.out.flush()
+
+
+class StreamingEpubZipFile(EpubZipFile):
+    def __init__(self, out, **kwargs):
+        # out is a file-like object that only needs a write method. The
+        # keyword arguments are passed on to EpubZipFile; incremental builds
+        # are not possible.
+        EpubZipFile.__init__(self, _CountingWriter(out), "w", **kwargs)
+    
+    def write_raw(self, zinfo, chunks):
+        EpubZipFile.write_raw(self, zinfo, chunks)
+        self.fp.flush()
+    
+    def _write_contents(self, arcname, data, mime):
+        zinfo = self.new_zinfo(arcname)
+        compress_type, level = self.get_compression(arcname, mime)
+        self.write_prepared(zinfo, prepare_entry([data], compress_type, level))
+        return "generated"
+    
+    def write_chunks(self, zinfo_or_arcname, chunks, compress_type=None, level=None):
+        # As EpubZipFile.write_chunks, but the CRC and sizes are written in a
+        # data descriptor after the data
+        if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo = zinfo_or_arcname
+        else:
+            zinfo = self.new_zinfo(zinfo_or_arcname)
+        
+        if compress_type is None:
+            compress_type, level = self.get_compression(zinfo.filename)
+        zinfo.compress_type = compress_type
+        zinfo.flag_bits = 0x08
+        zinfo.file_size = 0
+        zinfo.header_offset = self.fp.tell()
+        
+        self._writecheck(zinfo)
+        self._didModify = True
+        
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        self.fp.write(zinfo.FileHeader(False))
+        
+        self._write_compressed(zinfo, chunks, compress_type, level)
+        
+        self.fp.write(struct.pack(
+            "<4sLLL",
+            DATA_DESCRIPTOR_SIGNATURE,
+            zinfo.CRC,
+            zinfo.compress_size,
+            zinfo.file_size,
+        ))
+        self.fp.flush()
+        
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+
+class _QueueWriter(object):
+    # Collects the output into chunks of about chunk_size bytes, which are
+    # put into a queue
+    def __init__(self, queue, chunk_size):
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.cancelled = False
+        self._buf = []
+        self._size = 0
+    
+    def write(self, data):
+        if self.cancelled:
+            raise IOError("The stream has been closed.")
+        self._buf.append(data)
+        self._size += len(data)
+        if self._size >= self.chunk_size:
+            self.flush()
+    
+    def flush(self):
+        if self.cancelled:
+            raise IOError("The stream has been closed.")
+        if self._buf:
+            self.queue.put("".join(self._buf))
+            self._buf = []
+            self._size = 0
+
+
+def iter_epub(document, chunk_size=CHUNK_SIZE, queue_size=16, **kwargs):
+    # Yield the epub of a Document in chunks of about chunk_size bytes. At
+    # most queue_size chunks are buffered. The keyword arguments are passed
+    # on to Document.write_epub_stream.
+    queue = Queue(queue_size)
+    writer = _QueueWriter(queue, chunk_size)
+    errors = []
+    
+    def produce():
+        try:
+            document.write_epub_stream(writer, **kwargs)
+            writer.flush()
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            queue.put(None)
+    
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    finished = False
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                finished = True
+                break
+            yield chunk
+    finally:
+        if not finished:
+            # The consumer stopped early; stop the producer and unblock it
+            writer.cancelled = True
+            while queue.get() is not None:
+                pass
+        thread.join()
+    if errors and not writer.cancelled:
+        raise errors[0][0], errors[0][1], errors[0][2]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Subsetting of embedded fonts to the characters a book uses.
+#
+# The text of all chapters is scanned for the code points it uses, and every
+# embedded font is subset to them before it is obfuscated and added to the
+# archive. Which font a piece of text is rendered with depends on the style
+# sheets, so all fonts are subset to the code points of the whole book, in
+# upper and lower case.
+#
+# The fonts are subset in parallel by a pool of worker processes. Results are
+# stored in a cache directory, keyed by the SHA-1 hash of the font and of the
+# code point set. Subsetting needs fontTools; without it, fonts are left as
+# they are.
+
+import re
+
+from hashlib import sha1
+from htmlentitydefs import name2codepoint
+from multiprocessing import Pool, cpu_count
+from os import close, makedirs, remove, rename
+from os.path import exists, expanduser, join, splitext
+from tempfile import mkstemp
+from xml.parsers import expat
+
+from jkEpubTools.archive import CHUNK_SIZE, iter_file_chunks
+from jkEpubTools.compression import FONT_MIME_TYPES
+from jkEpubTools.incremental import get_file_hash
+
+try:
+    from fontTools import subset
+except ImportError:
+    subset = None
+
+
+DEFAULT_FONT_CACHE_DIR = join(expanduser("~"), ".cache", "jkEpubTools", "fonts")
+
+# Characters that are kept in every subset: printable ASCII, and characters
+# that reading systems may insert for justification and hyphenation
+ALWAYS_INCLUDED = set(range(0x20, 0x7f)) | set([0xa0, 0xad, 0x2010, 0x2011])
+
+# Quoted strings of generated content in style sheets
+CSS_CONTENT_RE = re.compile(r"""content\s*:\s*(["'])(.*?)\1""")
+
+
+class CodepointScanner(object):
+    # Collects the code points of the text and attribute values of XHTML
+    # documents, fed as byte strings
+    def __init__(self):
+        self.codepoints = set()
+    
+    def _create_parser(self):
+        parser = expat.ParserCreate()
+        # Named entities like &nbsp; are resolved by skipped_entity
+        parser.UseForeignDTD(True)
+        parser.CharacterDataHandler = self.add_text
+        parser.StartElementHandler = self.start_element
+        parser.SkippedEntityHandler = self.skipped_entity
+        return parser
+    
+    def add_text(self, text):
+        if isinstance(text, str):
+            text = text.decode("utf-8")
+        self.codepoints.update(ord(c) for c in text)
+    
+    def start_element(self, name, attrs):
+        # alt and title texts may be displayed, too
+        for key in ("alt", "title"):
+            if key in attrs:
+                self.add_text(attrs[key])
+    
+    def skipped_entity(self, name, is_parameter_entity):
+        if name in name2codepoint:
+            self.codepoints.add(name2codepoint[name])
+    
+    def scan_chunks(self, chunks, name="<generated>"):
+        parser = self._create_parser()
+        try:
+            for chunk in chunks:
+                parser.Parse(chunk, False)
+            parser.Parse("", True)
+        except expat.ExpatError as e:
+            print "WARNING: Text of '%s' could not be scanned completely: %s" % (name, e)
+    
+    def scan_file(self, path):
+        with open(path, "rb") as f:
+            self.scan_chunks(iter_file_chunks(f, CHUNK_SIZE), path)
+    
+    def scan_css(self, path):
+        with open(path, "rb") as f:
+            css = f.read().decode("utf-8", "replace")
+        for m in CSS_CONTENT_RE.finditer(css):
+            self.add_text(m.group(2))
+
+
+def get_case_variants(codepoints):
+    # Return the upper, lower and title case forms of the code points. Style
+    # sheets may change the case of the text with text-transform or
+    # font-variant: small-caps, so the subsets need both forms of each letter.
+    variants = set()
+    for c in codepoints:
+        try:
+            char = unichr(c)
+        except ValueError:
+            # Outside of the range of a narrow Python build
+            continue
+        for form in (char.upper(), char.lower(), char.title()):
+            variants.update(ord(v) for v in form)
+    return variants
+
+
+def get_document_codepoints(document):
+    # Return the set of code points used by the chapters, titles and
+    # generated content of a Document, in both cases
+    scanner = CodepointScanner()
+    scanner.codepoints.update(ALWAYS_INCLUDED)
+    for text in (document.title, document.metadata.title, document.metadata.author):
+        if text:
+            scanner.add_text(text)
+    for chapter in document.chapters:
+        if chapter.title:
+            scanner.add_text(chapter.title)
+        if chapter.src is None:
+            scanner.scan_chunks(chapter.iter_encoded())
+        elif exists(chapter.src):
+            scanner.scan_file(chapter.src)
+    for res in document.resources:
+        if res.mime == "text/css" and exists(res.src):
+            scanner.scan_css(res.src)
+    scanner.codepoints.update(get_case_variants(scanner.codepoints))
+    return scanner.codepoints
+
+
+def _subset_font(args):
+    # Worker: subset the font at src to the code points and save it as target
+    src, target, codepoints = args
+    try:
+        options = subset.Options()
+        # Keep all names, layout features and hinting of the font
+        options.name_IDs = ["*"]
+        options.name_legacy = True
+        options.name_languages = ["*"]
+        options.layout_features = ["*"]
+        options.notdef_outline = True
+        font = subset.load_font(src, options)
+        options.flavor = font.flavor
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=codepoints)
+        subsetter.subset(font)
+        subset.save_font(font, target, options)
+        font.close()
+    except Exception as e:
+        return "%s: %s" % (e.__class__.__name__, e)
+    return None
+
+
+class FontSubsetter(object):
+    def __init__(self, processes=None, cache_dir=DEFAULT_FONT_CACHE_DIR):
+        # processes is the number of worker processes (default: number of
+        # CPUs, but not more than there are fonts to subset)
+        self.processes = processes
+        self.cache_dir = cache_dir
+        self.available = subset is not None
+        if not self.available:
+            print "WARNING: fontTools is not installed, fonts will not be subset."
+    
+    def accepts(self, mime):
+        return self.available and mime in FONT_MIME_TYPES
+    
+    def get_cache_path(self, src, codepoints_hash):
+        return join(
+            self.cache_dir,
+            "%s-%s%s" % (get_file_hash(src), codepoints_hash[:12], splitext(src)[1].lower()),
+        )
+    
+    def subset_fonts(self, srcs, codepoints):
+        # Subset the fonts at the paths srcs to the code points. Returns a
+        # dict of the paths of the subset fonts by src; fonts that could not
+        # be subset map to their src.
+        result = dict((src, src) for src in srcs)
+        if not self.available or not srcs:
+            return result
+        codepoints = sorted(codepoints)
+        codepoints_hash = sha1(",".join("%x" % c for c in codepoints)).hexdigest()
+        if not exists(self.cache_dir):
+            makedirs(self.cache_dir)
+        
+        jobs = []
+        for src in set(srcs):
+            path = self.get_cache_path(src, codepoints_hash)
+            if exists(path):
+                result[src] = path
+            else:
+                fd, temp = mkstemp(suffix=".tmp", dir=self.cache_dir)
+                close(fd)
+                jobs.append((src, path, temp))
+        if not jobs:
+            return result
+        
+        processes = min(self.processes or cpu_count(), len(jobs))
+        args = [(src, temp, codepoints) for src, path, temp in jobs]
+        if processes == 1:
+            errors = map(_subset_font, args)
+        else:
+            pool = Pool(processes)
+            try:
+                errors = pool.map(_subset_font, args)
+            finally:
+                pool.close()
+                pool.join()
+        
+        for (src, path, temp), error in zip(jobs, errors):
+            if error is None:
+                rename(temp, path)
+                result[src] = path
+            else:
+                print "WARNING: Font could not be subset: '%s': %s" % (src, error)
+                remove(temp)
+        return result
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Obfuscate or deobfuscate the fonts of an existing epub file, without
+# extracting it.
+#
+# The package is read straight from the archive. Every entry is streamed into
+# a new archive; only the fonts listed in encryption.xml are transformed, all
+# other entries are copied without recompressing them.
+
+import sys
+import zipfile
+
+from itertools import chain
+from optparse import OptionParser
+
+from jkEpubTools.archive import EpubZipFile, iter_file_chunks
+from jkEpubTools.obfuscation import OBFUSCATION_LENGTH, get_package_key, xor_array
+from jkEpubTools.package import ENCRYPTION_PATH, Package
+from jkEpubTools.profiling import NULL_PROFILE
+
+
+# Leading bytes of unobfuscated font files: TrueType, OpenType/CFF, Apple
+# TrueType, TrueType collections, WOFF and WOFF2
+FONT_SIGNATURES = ("\x00\x01\x00\x00", "OTTO", "true", "ttcf", "wOFF", "wOF2")
+
+
+def is_plain_font(data):
+    return data[:4] in FONT_SIGNATURES
+
+
+def transform_epub(in_path, out_path=None, deobfuscate=False, profile=None):
+    # Obfuscate the fonts listed in encryption.xml of the epub at in_path, or
+    # deobfuscate them if deobfuscate is True. Fonts that are already in the
+    # requested state are copied unchanged. When deobfuscating, encryption.xml
+    # is left out of the new archive, as long as it only lists obfuscated
+    # fonts. If out_path is None, the epub is replaced.
+    # Returns the list of transformed entries, or None if the obfuscation key
+    # could not be built.
+    profile = profile or NULL_PROFILE
+    source = EpubZipFile(in_path, "r")
+    try:
+        with profile.stage("read package"):
+            package = Package.from_archive(source)
+            key = get_package_key(package)
+        if key is None:
+            return None
+        
+        fonts = set(package.obfuscated_files)
+        other = set(package.cipher_references) - fonts
+        for name in sorted(other):
+            print "  WARNING: Unsupported encryption of \"%s\" is left as is." % name
+        drop_encryption = deobfuscate and package.has_encryption and not other
+        
+        if out_path is None:
+            z = EpubZipFile("%s.tmp" % in_path, "w", profile=profile, final_path=in_path)
+        else:
+            z = EpubZipFile(out_path, "w", profile=profile)
+        
+        transformed = []
+        try:
+            with profile.stage("copy entries"):
+                for zinfo in source.infolist():
+                    name = zinfo.filename
+                    if name == ENCRYPTION_PATH and drop_encryption:
+                        continue
+                    if name in fonts and _transform_entry(source, z, zinfo, key, deobfuscate):
+                        profile.count("transformed")
+                        profile.count("obfuscated_bytes", min(zinfo.file_size, OBFUSCATION_LENGTH))
+                        transformed.append(name)
+                    else:
+                        z.copy_entry(source, name)
+                        profile.count("copied")
+            with profile.stage("close archive"):
+                z.close()
+        except:
+            z.abort()
+            raise
+    finally:
+        source.close()
+    return transformed
+
+
+def _transform_entry(source, z, zinfo, key, deobfuscate):
+    # Write the XORed font entry. Returns False without writing anything if
+    # the font is already in the requested state.
+    with source.open(zinfo) as in_file:
+        head = bytearray(in_file.read(OBFUSCATION_LENGTH))
+        if is_plain_font(str(head)) == deobfuscate:
+            print "  WARNING: \"%s\" is %s already, copied as is." % (
+                zinfo.filename,
+                "unobfuscated" if deobfuscate else "obfuscated",
+            )
+            return False
+        info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+        info.external_attr = zinfo.external_attr
+        z.write_chunks(
+            info,
+            chain([str(xor_array(head, key))], iter_file_chunks(in_file)),
+            zinfo.compress_type,
+        )
+    return True
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options] in.epub [out.epub]")
+    parser.add_option("-d", "--deobfuscate", action="store_true", default=False,
+        help="deobfuscate the fonts instead of obfuscating them")
+    options, paths = parser.parse_args(args)
+    if len(paths) not in (1, 2):
+        parser.error("Expected an input and an optional output file.")
+    
+    in_path = paths[0]
+    out_path = paths[1] if len(paths) == 2 else None
+    transformed = transform_epub(in_path, out_path, options.deobfuscate)
+    if transformed is None:
+        return 1
+    for name in transformed:
+        print "  %s: \"%s\"" % (
+            "Deobfuscated" if options.deobfuscate else "Obfuscated",
+            name,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
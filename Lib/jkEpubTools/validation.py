@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Structural validation of finished epub files.
+#
+# This checks the parts of an epub that jkEpubTools is responsible for, not
+# the content documents: the mimetype entry, the presence of all manifest
+# items, the consistency of spine, NCX and navigation document, the font
+# obfuscation and the cover size. The archive directory is read once, and
+# only the control files plus the first bytes of each obfuscated font are
+# read from the entries, so a book is validated in milliseconds.
+
+import struct
+import sys
+import zipfile
+
+from optparse import OptionParser
+from posixpath import dirname as url_dirname
+from xml.etree.cElementTree import iterparse
+
+from jkEpubTools.obfuscation import get_key_from_identifiers
+from jkEpubTools.package import IDPF_OBFUSCATION, Package, PackageError, resolve_href
+from jkEpubTools.transform import is_plain_font
+
+
+EPUB_MIME_TYPE = "application/epub+zip"
+NCX_MIME_TYPE = "application/x-dtbncx+xml"
+
+NCX_CONTENT = "{http://www.daisy.org/z3986/2005/ncx/}content"
+XHTML_NAV = "{http://www.w3.org/1999/xhtml}nav"
+XHTML_A = "{http://www.w3.org/1999/xhtml}a"
+SVG_SVG = "{http://www.w3.org/2000/svg}svg"
+SVG_IMAGE = "{http://www.w3.org/2000/svg}image"
+
+
+class ValidationReport(object):
+    def __init__(self, path):
+        self.path = path
+        self.errors = []
+        self.warnings = []
+    
+    def __repr__(self):
+        lines = ["%s: %s" % (self.path, "OK" if self.ok else "FAILED")]
+        lines.extend(["  ERROR: %s" % e for e in self.errors])
+        lines.extend(["  WARNING: %s" % w for w in self.warnings])
+        return "\n".join(lines)
+    
+    @property
+    def ok(self):
+        return not self.errors
+    
+    def error(self, message):
+        self.errors.append(message)
+    
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+def validate_epub(path):
+    # Validate the epub file at path (or an open file object) and return a
+    # ValidationReport
+    report = ValidationReport(getattr(path, "name", path))
+    try:
+        z = zipfile.ZipFile(path, "r")
+    except (IOError, zipfile.BadZipfile) as e:
+        report.error("Not a zip file: %s" % e)
+        return report
+    try:
+        _validate_archive(z, report)
+    finally:
+        z.close()
+    return report
+
+
+def _validate_archive(z, report):
+    names = set(z.NameToInfo)
+    
+    check_mimetype(z, report)
+    
+    try:
+        package = Package.from_archive(z)
+    except PackageError as e:
+        report.error(str(e))
+        return
+    except SyntaxError as e:
+        # XML parse errors
+        report.error("Package could not be parsed: %s" % e)
+        return
+    if not package.documents:
+        report.error("container.xml does not list a package document.")
+        return
+    
+    for document in package.documents:
+        check_package_document(z, names, document, report)
+    
+    listed = set(["mimetype"] + package.rootfiles)
+    for document in package.documents:
+        listed.update(item.href for item in document.items)
+    for name in sorted(names - listed):
+        if not name.startswith("META-INF/") and not name.endswith("/"):
+            report.warning("\"%s\" is not in the manifest." % name)
+    
+    check_encryption(z, names, package, report)
+
+
+def check_mimetype(z, report):
+    infos = z.infolist()
+    if not infos or infos[0].filename != "mimetype":
+        report.error("mimetype is not the first entry of the archive.")
+        return
+    info = infos[0]
+    if info.compress_type != zipfile.ZIP_STORED:
+        report.error("mimetype is compressed.")
+    # The local header must not have an extra field either, so that the
+    # contents are found at a fixed offset
+    z.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, z.fp.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_EXTRA_FIELD_LENGTH] != 0:
+        report.error("mimetype has an extra field.")
+    if z.read("mimetype") != EPUB_MIME_TYPE:
+        report.error("mimetype does not contain \"%s\"." % EPUB_MIME_TYPE)
+
+
+def check_package_document(z, names, document, report):
+    path = document.path
+    if document.unique_identifier is None:
+        report.error("%s: The unique identifier is missing." % path)
+    
+    items = {}
+    for item in document.items:
+        if item.id in items:
+            report.error("%s: Duplicate manifest id \"%s\"." % (path, item.id))
+        items[item.id] = item
+        if item.href is None:
+            report.error("%s: Manifest item \"%s\" has no href." % (path, item.id))
+        elif item.href not in names:
+            report.error("%s: Manifest item \"%s\" is missing from the archive." % (path, item.href))
+    hrefs = set(item.href for item in document.items)
+    
+    spine = set()
+    for idref in document.spine:
+        if idref not in items:
+            report.error("%s: Spine item \"%s\" is not in the manifest." % (path, idref))
+        else:
+            spine.add(items[idref].href)
+    if not document.spine:
+        report.error("%s: The spine is empty." % path)
+    
+    # NCX
+    ncx = None
+    if document.spine_toc is not None:
+        ncx = items.get(document.spine_toc)
+        if ncx is None:
+            report.error("%s: The NCX \"%s\" is not in the manifest." % (path, document.spine_toc))
+    else:
+        for item in document.items:
+            if item.media_type == NCX_MIME_TYPE:
+                ncx = item
+    if ncx is not None and ncx.href in names:
+        targets = _read_targets(z, ncx.href, _iter_ncx_targets, report)
+        _check_targets(ncx.href, targets, hrefs, spine, report)
+    elif document.version != "3.0" and ncx is None:
+        report.error("%s: There is no NCX." % path)
+    
+    # Navigation document
+    navs = [
+        item for item in document.items
+        if item.properties is not None and "nav" in item.properties.split()
+    ]
+    if document.version == "3.0" and not navs:
+        report.error("%s: There is no navigation document." % path)
+    for nav in navs:
+        if nav.href in names:
+            targets = _read_targets(z, nav.href, _iter_nav_targets, report)
+            _check_targets(nav.href, targets, hrefs, spine, report)
+    
+    # Cover
+    cover_id = document.meta.get("cover")
+    if cover_id is not None and cover_id not in items:
+        report.error("%s: The cover image \"%s\" is not in the manifest." % (path, cover_id))
+    cover = items.get("cover")
+    if cover is not None and cover.href in names:
+        check_cover(z, cover.href, report)
+
+
+def _read_targets(z, name, iter_targets, report):
+    try:
+        with z.open(name) as f:
+            return list(iter_targets(f, url_dirname(name)))
+    except SyntaxError as e:
+        report.error("%s could not be parsed: %s" % (name, e))
+        return []
+
+
+def _iter_ncx_targets(f, base):
+    for event, elem in iterparse(f):
+        if elem.tag == NCX_CONTENT and elem.get("src"):
+            yield resolve_href(base, elem.get("src"))
+        elem.clear()
+
+
+def _iter_nav_targets(f, base):
+    depth = 0
+    for event, elem in iterparse(f, ("start", "end")):
+        if elem.tag == XHTML_NAV:
+            depth += 1 if event == "start" else -1
+        elif event == "end" and elem.tag == XHTML_A and depth > 0:
+            if elem.get("href"):
+                yield resolve_href(base, elem.get("href"))
+
+
+def _check_targets(name, targets, hrefs, spine, report):
+    for target in targets:
+        if target not in hrefs:
+            report.error("%s: \"%s\" is not in the manifest." % (name, target))
+        elif target not in spine and target != name:
+            report.warning("%s: \"%s\" is not in the spine." % (name, target))
+
+
+def check_cover(z, name, report):
+    # The cover page needs the size of the image for its viewBox
+    try:
+        with z.open(name) as f:
+            for event, elem in iterparse(f):
+                if elem.tag == SVG_IMAGE or (elem.tag == SVG_SVG and elem.get("viewBox")):
+                    values = [elem.get("width"), elem.get("height")]
+                    if elem.tag == SVG_SVG:
+                        values = elem.get("viewBox").split()[2:]
+                    try:
+                        [float(v) for v in values]
+                    except (TypeError, ValueError):
+                        report.error("%s: The width and height of the cover image are not set." % name)
+                        return
+    except SyntaxError as e:
+        report.error("%s could not be parsed: %s" % (name, e))
+
+
+def check_encryption(z, names, package, report):
+    key = None
+    if package.unique_identifier is not None:
+        key = get_key_from_identifiers([package.unique_identifier])
+    for uri in package.cipher_references:
+        if uri not in names:
+            report.error("encryption.xml: \"%s\" is missing from the archive." % uri)
+            continue
+        if package.cipher_algorithms[uri] != IDPF_OBFUSCATION:
+            report.warning("encryption.xml: \"%s\" uses an unknown algorithm." % uri)
+            continue
+        with z.open(uri) as f:
+            head = bytearray(f.read(4))
+        if is_plain_font(str(head)):
+            report.error("encryption.xml: \"%s\" is not obfuscated." % uri)
+        elif key is not None:
+            plain = bytearray(h ^ k for h, k in zip(head, key))
+            if not is_plain_font(str(plain)):
+                report.error("encryption.xml: \"%s\" is not obfuscated with the key of the unique identifier." % uri)
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog book.epub [book.epub ...]")
+    options, paths = parser.parse_args(args)
+    if not paths:
+        parser.error("No epub files given.")
+    failed = 0
+    for path in paths:
+        report = validate_epub(path)
+        print report
+        if not report.ok:
+            failed += 1
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Build the example book with each compression policy and report the size of
+# the resulting epub and the build time.
+
+import sys
+import time
+
+from cStringIO import StringIO
+from os.path import abspath, dirname, join
+
+from jkEpubTools.batch import document_from_manifest, load_manifests
+from jkEpubTools.compression import CompressionPolicy, DEFAULT_POLICY, FASTEST, SMALLEST, STORE_ALL
+
+
+EXAMPLE = join(
+    dirname(dirname(abspath(__file__))),
+    "examples",
+    "The Haunter Of The Dark",
+    "book.json",
+)
+
+POLICIES = [
+    ("store all", STORE_ALL),
+    ("fastest", FASTEST),
+    ("default", DEFAULT_POLICY),
+    ("smallest", SMALLEST),
+    ("deflate everything", CompressionPolicy(stored_types=set())),
+]
+
+
+def bench(doc, policy, repeat=5):
+    best = None
+    for i in range(repeat):
+        out = StringIO()
+        start = time.time()
+        doc.write_epub(out, compression=policy)
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return len(out.getvalue()), best
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        manifest_path = sys.argv[1]
+    else:
+        manifest_path = EXAMPLE
+    doc = document_from_manifest(load_manifests(manifest_path)[0])
+    
+    print "%-20s %12s %10s" % ("Policy", "Size", "Time")
+    for name, policy in POLICIES:
+        size, t = bench(doc, policy)
+        print "%-20s %12i %8.1f ms" % (name, size, t * 1000)
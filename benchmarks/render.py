@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Time the rendering of the package documents (content.opf, toc.ncx and
+# nav.xhtml) for a book with many chapters and resources.
+
+import sys
+import time
+
+from jkEpubTools.document import Document
+from jkEpubTools.files import ContentOPF, NavXHTML, TocNCX
+
+
+def make_document(num_chapters, num_resources):
+    doc = Document("bench", "Benchmark")
+    doc.set_metadata_from_dict({
+        "version": "3.0",
+        "language": "en",
+        "title": "Omnibus & Co.",
+        "author": "Benchmark Author",
+        "uuid": "urn:uuid:00000000-0000-0000-0000-000000000000",
+    })
+    doc.stylesheet = "style/stylesheet.css"
+    doc.add_chapters_from_dict_list([
+        {"id": "c%i" % i, "title": "Chapter %i <%i>" % (i, i), "src": "%i.xhtml" % i}
+        for i in range(num_chapters)
+    ])
+    doc.add_resources_from_dict_list([
+        {"src": "image-%i.png" % i, "uri": "images/image-%i.png" % i, "mime": "image/png"}
+        for i in range(num_resources)
+    ])
+    return doc
+
+
+def bench(epub_file, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        c = epub_file.get_contents()
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return len(c), best
+
+
+if __name__ == "__main__":
+    num_chapters = 10000
+    num_resources = 2000
+    if len(sys.argv) > 1:
+        num_chapters = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_resources = int(sys.argv[2])
+    
+    doc = make_document(num_chapters, num_resources)
+    print "%i chapters, %i resources" % (num_chapters, num_resources)
+    for cls in (ContentOPF, TocNCX, NavXHTML):
+        size, t = bench(cls(doc))
+        print "%-12s %10i chars %8.1f ms" % (cls.__name__, size, t * 1000)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark suite with synthetic books at several scales.
+#
+# For each scenario, the source files of a book (chapters, images and fonts)
+# are generated into a temporary directory. Every operation is then run in a
+# fresh worker process, so that the memory high-water mark (ru_maxrss) can be
+# attributed to it. The results are written to a JSON file; with --compare,
+# they are checked against the results of an earlier run.
+#
+#   python benchmarks/suite.py -o results.json
+#   python benchmarks/suite.py -o new.json --compare results.json
+
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+from multiprocessing import Pool
+from optparse import OptionParser
+from os.path import join
+
+from jkEpubTools import build, package
+from jkEpubTools.document import Document
+from jkEpubTools.files import ContainerXML, ContentOPF, EncryptionXML, NavXHTML, TocNCX
+from jkEpubTools.obfuscation import get_obfuscation_key, xor_array
+from jkEpubTools.profiling import get_cpu_time
+
+
+SCENARIOS = [
+    ("baseline", {
+        "chapters": 10, "chapter_size": 20000,
+        "images": 5, "image_size": 256,
+        "fonts": 2, "font_size": 100000,
+    }),
+    ("many-chapters", {
+        "chapters": 2000, "chapter_size": 8000,
+        "images": 0, "image_size": 0,
+        "fonts": 1, "font_size": 100000,
+    }),
+    ("many-images", {
+        "chapters": 20, "chapter_size": 20000,
+        "images": 300, "image_size": 256,
+        "fonts": 1, "font_size": 100000,
+    }),
+    ("large-fonts", {
+        "chapters": 10, "chapter_size": 20000,
+        "images": 0, "image_size": 0,
+        "fonts": 4, "font_size": 8000000,
+    }),
+    ("many-fonts", {
+        "chapters": 10, "chapter_size": 20000,
+        "images": 0, "image_size": 0,
+        "fonts": 200, "font_size": 64000,
+    }),
+]
+
+OPERATIONS = [
+    "get_contents ContainerXML",
+    "get_contents ContentOPF",
+    "get_contents EncryptionXML",
+    "get_contents NavXHTML",
+    "get_contents TocNCX",
+    "xor_array",
+    "get_obfuscation_key",
+    "save_epub",
+    "build",
+    "write_epub",
+]
+
+# Factories of the generated files, called with the document
+EPUB_FILES = {
+    "ContainerXML": lambda doc: ContainerXML(),
+    "ContentOPF": ContentOPF,
+    "EncryptionXML": EncryptionXML,
+    "NavXHTML": NavXHTML,
+    "TocNCX": TocNCX,
+}
+
+# Number of calls per measurement of the fast operations
+XOR_ARRAY_CALLS = 1000
+GET_CONTENTS_CALLS = 20
+
+PARAGRAPH = (
+    "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+    "eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim "
+    "ad minim veniam, quis nostrud exercitation ullamco laboris.</p>\n"
+)
+
+
+# Generators of synthetic source files
+
+def write_chapter(path, title, size):
+    with open(path, "wb") as f:
+        f.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">\n'
+            '  <head>\n    <title>%s</title>\n  </head>\n  <body>\n'
+            '    <h1>%s</h1>\n' % (title, title)
+        )
+        for i in range(max(1, size // len(PARAGRAPH))):
+            f.write(PARAGRAPH)
+        f.write("  </body>\n</html>\n")
+
+
+def _png_chunk(tag, data):
+    chunk = tag + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+
+
+def write_png(path, size):
+    # A size x size RGB image of noise, which does not compress well, like
+    # photographs
+    rows = "".join("\x00" + os.urandom(3 * size) for y in range(size))
+    with open(path, "wb") as f:
+        f.write("\x89PNG\r\n\x1a\n")
+        f.write(_png_chunk("IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)))
+        f.write(_png_chunk("IDAT", zlib.compress(rows)))
+        f.write(_png_chunk("IEND", ""))
+
+
+def write_font(path, size):
+    # Random data behind a TrueType signature; it is only copied and
+    # obfuscated, never parsed
+    with open(path, "wb") as f:
+        f.write("\x00\x01\x00\x00")
+        f.write(os.urandom(size - 4))
+
+
+def generate_sources(params, data_dir):
+    for i in range(params["chapters"]):
+        write_chapter(join(data_dir, "chapter-%i.xhtml" % i), "Chapter %i" % (i + 1), params["chapter_size"])
+    for i in range(params["images"]):
+        write_png(join(data_dir, "image-%i.png" % i), params["image_size"])
+    for i in range(params["fonts"]):
+        write_font(join(data_dir, "font-%i.ttf" % i), params["font_size"])
+    with open(join(data_dir, "stylesheet.css"), "wb") as f:
+        f.write("body { font-family: serif; }\n")
+
+
+def make_document(params, data_dir):
+    doc = Document("benchmark", "Benchmark")
+    doc.set_metadata_from_dict({
+        "version": "3.0",
+        "language": "en",
+        "title": "Benchmark",
+        "author": "Benchmark Author",
+        "uuid": "00000000-0000-0000-0000-000000000000",
+    })
+    doc.stylesheet = "style/stylesheet.css"
+    doc.add_chapters_from_dict_list([
+        {
+            "id": "c%i" % i,
+            "title": "Chapter %i" % (i + 1),
+            "src": join(data_dir, "chapter-%i.xhtml" % i),
+        }
+        for i in range(params["chapters"])
+    ])
+    resources = [{
+        "src": join(data_dir, "stylesheet.css"),
+        "uri": "style/stylesheet.css",
+        "mime": "text/css",
+    }]
+    resources.extend([
+        {
+            "src": join(data_dir, "image-%i.png" % i),
+            "uri": "images/image-%i.png" % i,
+            "mime": "image/png",
+        }
+        for i in range(params["images"])
+    ])
+    resources.extend([
+        {
+            "src": join(data_dir, "font-%i.ttf" % i),
+            "uri": "fonts/font-%i.ttf" % i,
+            "mime": "application/x-font-truetype",
+            "encrypt": True,
+        }
+        for i in range(params["fonts"])
+    ])
+    doc.add_resources_from_dict_list(resources)
+    return doc
+
+
+# Operations; each one returns the number of calls it made
+
+def run_operation(operation, doc, data_dir, work_dir):
+    if operation.startswith("get_contents "):
+        epub_file = EPUB_FILES[operation.split(" ", 1)[1]](doc)
+        for i in xrange(GET_CONTENTS_CALLS):
+            epub_file.get_contents()
+        return GET_CONTENTS_CALLS
+    if operation == "xor_array":
+        key = bytearray(os.urandom(20))
+        data = os.urandom(2048)
+        for i in xrange(XOR_ARRAY_CALLS):
+            xor_array(bytearray(data), key)
+        return XOR_ARRAY_CALLS
+    if operation == "get_obfuscation_key":
+        # Measure a cold lookup, without the cached package model
+        package._package_cache.clear()
+        get_obfuscation_key(join(data_dir, "staging"))
+        return 1
+    if operation == "save_epub":
+        target = join(work_dir, "staging")
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        doc.save_epub(target)
+        return 1
+    if operation == "build":
+        build(join(data_dir, "staging"), join(work_dir, "build.epub"))
+        return 1
+    if operation == "write_epub":
+        doc.write_epub(join(work_dir, "write.epub"))
+        return 1
+    raise ValueError("Unknown operation: %s" % operation)
+
+
+def _measure(args):
+    # Worker: run one operation repeat times in this fresh process
+    operation, params, data_dir, repeat = args
+    doc = make_document(params, data_dir)
+    work_dir = tempfile.mkdtemp(prefix="jkepubtools-bench-")
+    stdout = sys.stdout
+    try:
+        # Silence the progress messages of build and friends
+        sys.stdout = open(os.devnull, "wb")
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best_wall = best_cpu = None
+        for i in range(repeat):
+            start_wall = time.time()
+            start_cpu = get_cpu_time()
+            calls = run_operation(operation, doc, data_dir, work_dir)
+            wall = time.time() - start_wall
+            cpu = get_cpu_time() - start_cpu
+            if best_wall is None or wall < best_wall:
+                best_wall = wall
+                best_cpu = cpu
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(work_dir)
+    return {
+        "wall": best_wall,
+        "cpu": best_cpu,
+        "calls": calls,
+        "wall_per_call": best_wall / calls,
+        "maxrss_kb": rss_after,
+        "maxrss_delta_kb": rss_after - rss_before,
+    }
+
+
+def measure(operation, params, data_dir, repeat):
+    pool = Pool(1)
+    try:
+        return pool.apply(_measure, ((operation, params, data_dir, repeat),))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_suite(scenarios, operations, repeat=3, scale=1.0, callback=None):
+    results = []
+    for name, params in scenarios:
+        params = dict(params)
+        for k in ("chapters", "images", "fonts"):
+            params[k] = int(round(params[k] * scale))
+        data_dir = tempfile.mkdtemp(prefix="jkepubtools-bench-")
+        try:
+            generate_sources(params, data_dir)
+            # The staging directory is the input of build and
+            # get_obfuscation_key
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "wb")
+            try:
+                make_document(params, data_dir).save_epub(join(data_dir, "staging"))
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            for operation in operations:
+                result = measure(operation, params, data_dir, repeat)
+                result["scenario"] = name
+                result["operation"] = operation
+                result["params"] = params
+                results.append(result)
+                if callback is not None:
+                    callback(result)
+        finally:
+            shutil.rmtree(data_dir)
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    # Print the change of each result against a baseline file. Returns the
+    # number of regressions beyond threshold (a factor, e.g. 0.1 for 10 %).
+    with open(baseline_path, "rb") as f:
+        baseline = json.load(f)
+    old = dict(
+        ((r["scenario"], r["operation"]), r) for r in baseline["results"]
+    )
+    regressions = 0
+    print
+    print "%-16s %-28s %10s %10s" % ("Scenario", "Operation", "Time", "Memory")
+    for r in results:
+        o = old.get((r["scenario"], r["operation"]))
+        if o is None:
+            continue
+        time_change = r["wall_per_call"] / max(o["wall_per_call"], 1e-9) - 1
+        mem_change = float(r["maxrss_kb"]) / max(o["maxrss_kb"], 1) - 1
+        flag = ""
+        if time_change > threshold or mem_change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print "%-16s %-28s %+9.1f%% %+9.1f%%%s" % (
+            r["scenario"],
+            r["operation"],
+            time_change * 100,
+            mem_change * 100,
+            flag,
+        )
+    return regressions
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", default="benchmark-results.json",
+        help="JSON file for the results (default: %default)")
+    parser.add_option("-s", "--scenario", action="append", default=None,
+        help="run only this scenario (repeatable)")
+    parser.add_option("-p", "--operation", action="append", default=None,
+        help="run only this operation (repeatable)")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+        help="number of runs per measurement; the fastest counts (default: %default)")
+    parser.add_option("--scale", type="float", default=1.0,
+        help="multiply the number of chapters, images and fonts (default: %default)")
+    parser.add_option("--compare", default=None,
+        help="compare the results against an earlier results file")
+    parser.add_option("--threshold", type="float", default=0.1,
+        help="relative slowdown that counts as a regression (default: %default)")
+    options, args = parser.parse_args(args)
+    
+    scenarios = SCENARIOS
+    if options.scenario:
+        scenarios = [s for s in SCENARIOS if s[0] in options.scenario]
+    operations = options.operation or OPERATIONS
+    
+    def report(result):
+        print "%-16s %-28s %10.3f ms %10i KB" % (
+            result["scenario"],
+            result["operation"],
+            result["wall_per_call"] * 1000,
+            result["maxrss_delta_kb"],
+        )
+        sys.stdout.flush()
+    
+    results = run_suite(scenarios, operations, options.repeat, options.scale, report)
+    with open(options.output, "wb") as f:
+        json.dump(
+            {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            },
+            f,
+            indent=1,
+            sort_keys=True,
+        )
+    print "Results written to %s" % options.output
+    
+    if options.compare is not None:
+        if compare(results, options.compare, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
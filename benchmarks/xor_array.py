@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compare the bulk xor_array implementation against the original per-byte
+# loop, and check that both produce identical output.
+
+import os
+import timeit
+
+from hashlib import sha1
+
+from jkEpubTools import obfuscation
+from jkEpubTools.obfuscation import xor_array
+
+
+def xor_array_loop(array, key):
+    # The original implementation, kept as a reference
+    for i in range(min(len(array), 1040)):
+        j = i % len(key)
+        array[i] = array[i] ^ key[j]
+    return array
+
+
+def check_identical():
+    for length in (0, 1, 19, 20, 21, 1039, 1040, 1041, 5000):
+        for seed in range(5):
+            key = bytearray(sha1("key %i" % seed).digest())
+            data = os.urandom(length)
+            a = xor_array_loop(bytearray(data), key)
+            b = xor_array(bytearray(data), key)
+            assert a == b, "Output differs for length %i" % length
+
+
+def bench(func, key, data, number):
+    return min(timeit.repeat(
+        lambda: func(bytearray(data), key),
+        repeat=5,
+        number=number,
+    )) / number
+
+
+if __name__ == "__main__":
+    check_identical()
+    print "Output is identical."
+    
+    key = bytearray(sha1("benchmark").digest())
+    data = os.urandom(4096)
+    number = 2000
+    
+    t_loop = bench(xor_array_loop, key, data, number)
+    t_bulk = bench(xor_array, key, data, number)
+    
+    if obfuscation.numpy is None:
+        method = "integer XOR"
+    else:
+        method = "NumPy"
+    print "Per-byte loop: %8.2f µs per call" % (t_loop * 1000000)
+    print "Bulk (%s): %8.2f µs per call" % (method, t_bulk * 1000000)
+    print "Speedup:       %8.1fx" % (t_loop / t_bulk)
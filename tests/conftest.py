@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import sys
+
+from os.path import abspath, dirname, join
+
+import pytest
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, "Lib"))
+
+from jkEpubTools.catalog import load_document
+
+
+EXAMPLE_DIR = join(ROOT, "examples", "The Haunter Of The Dark")
+
+
+@pytest.fixture
+def example_dir(tmpdir):
+    # A copy of the example book, so tests may touch its files
+    path = str(tmpdir.join("example"))
+    shutil.copytree(EXAMPLE_DIR, path)
+    return path
+
+
+@pytest.fixture
+def load_example(example_dir):
+    # Return a function that loads a new Document of the example book
+    def load():
+        return load_document(join(example_dir, "book.json"), lazy=False)
+    return load
+
+
+@pytest.fixture
+def document(load_example):
+    return load_example()
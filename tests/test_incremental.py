@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zipfile
+
+from os import utime
+from os.path import join
+
+from jkEpubTools import build
+from jkEpubTools.profiling import BuildProfile
+from jkEpubTools.validation import validate_epub
+
+
+def get_sources(profile):
+    return dict((entry["name"], entry["source"]) for entry in profile.entries)
+
+
+def touch(path):
+    now = time.time() + 10
+    utime(path, (now, now))
+
+
+def test_incremental_write_epub(document, tmpdir):
+    path = str(tmpdir.join("book.epub"))
+    document.write_epub(path, incremental=True)
+    assert validate_epub(path).ok
+    
+    # Touched files are reused, as their contents did not change
+    for src in document.get_source_paths():
+        touch(src)
+    profile = BuildProfile()
+    document.write_epub(path, incremental=True, profile=profile)
+    sources = get_sources(profile)
+    assert set(sources.values()) == set(["previous"])
+    assert validate_epub(path).ok
+    
+    # Only the changed chapter is written again
+    chapter = document.chapters[2]
+    with open(chapter.src, "ab") as f:
+        f.write("<!-- changed -->\n")
+    profile = BuildProfile()
+    document.write_epub(path, incremental=True, profile=profile)
+    sources = get_sources(profile)
+    assert sources.pop("OEBPS/003.xhtml") == "disk"
+    assert set(sources.values()) == set(["previous"])
+    assert validate_epub(path).ok
+    assert zipfile.ZipFile(path).read("OEBPS/003.xhtml").endswith("<!-- changed -->\n")
+    assert not tmpdir.join("book.epub.tmp").exists()
+
+
+def test_incremental_build(document, tmpdir):
+    epub_root = str(tmpdir.join("epub"))
+    path = str(tmpdir.join("book.epub"))
+    document.save_epub(epub_root, incremental=True)
+    build(epub_root, path, incremental=True)
+    assert validate_epub(path).ok
+    
+    touch(join(epub_root, "OEBPS", "001.xhtml"))
+    profile = BuildProfile()
+    build(epub_root, path, incremental=True, profile=profile)
+    sources = get_sources(profile)
+    # The mimetype entry is generated, the others come from the previous
+    # archive
+    sources.pop("mimetype")
+    assert set(sources.values()) == set(["previous"])
+    assert validate_epub(path).ok
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from os import utime
+from os.path import join
+
+from jkEpubTools import package
+from jkEpubTools.obfuscation import get_files_to_obfuscate, get_obfuscation_key
+
+
+def count_reads(monkeypatch):
+    reads = []
+    
+    def counting_open(path, *args):
+        reads.append(path)
+        return open(path, *args)
+    
+    monkeypatch.setattr(package, "open", counting_open, raising=False)
+    return reads
+
+
+def test_control_files_are_read_once(document, tmpdir, monkeypatch):
+    epub_root = str(tmpdir.join("epub"))
+    document.save_epub(epub_root)
+    reads = count_reads(monkeypatch)
+    
+    assert get_obfuscation_key(epub_root) is not None
+    assert get_files_to_obfuscate(epub_root)
+    assert len(reads) == len(set(reads)) == 3
+    
+    # Touched files are read again, but the package is not parsed again
+    p = package.get_package(epub_root)
+    now = time.time() + 10
+    utime(join(epub_root, "OEBPS", "content.opf"), (now, now))
+    assert package.get_package(epub_root) is p
+
+
+def test_changed_package_is_parsed_again(document, tmpdir):
+    epub_root = str(tmpdir.join("epub"))
+    document.save_epub(epub_root)
+    uid = package.get_package(epub_root).unique_identifier
+    
+    path = join(epub_root, "OEBPS", "content.opf")
+    with open(path, "rb") as f:
+        opf = f.read()
+    with open(path, "wb") as f:
+        f.write(opf.replace(uid.encode("utf-8"), "urn:uuid:changed"))
+    now = time.time() + 10
+    utime(path, (now, now))
+    assert package.get_package(epub_root).unique_identifier == "urn:uuid:changed"
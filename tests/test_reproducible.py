@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from os import utime
+
+from jkEpubTools import build
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def touch_sources(document):
+    # Give all source files a new modification time
+    now = time.time() + 10
+    for src in document.get_source_paths():
+        utime(src, (now, now))
+
+
+def test_write_epub_is_reproducible(load_example, tmpdir):
+    a = str(tmpdir.join("a.epub"))
+    b = str(tmpdir.join("b.epub"))
+    document = load_example()
+    document.metadata.date = None
+    document.metadata.uuid = None
+    document.write_epub(a, reproducible=True)
+    touch_sources(document)
+    
+    document = load_example()
+    document.metadata.date = None
+    document.metadata.uuid = None
+    document.write_epub(b, reproducible=True)
+    assert read(a) == read(b)
+
+
+def test_build_is_reproducible(load_example, tmpdir):
+    a = str(tmpdir.join("a.epub"))
+    b = str(tmpdir.join("b.epub"))
+    load_example().save_epub(str(tmpdir.join("a")), reproducible=True)
+    build(str(tmpdir.join("a")), a, reproducible=True)
+    
+    document = load_example()
+    touch_sources(document)
+    document.save_epub(str(tmpdir.join("b")), reproducible=True)
+    build(str(tmpdir.join("b")), b, reproducible=True)
+    assert read(a) == read(b)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+
+from os.path import exists
+
+import pytest
+
+from jkEpubTools.server import BuildService, UnixBuildServer
+
+
+def test_replace_stale_socket(tmpdir):
+    path = str(tmpdir.join("build.sock"))
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.close()
+    
+    server = UnixBuildServer(path, BuildService())
+    server.server_close()
+    assert not exists(path)
+
+
+def test_refuse_socket_in_use(tmpdir):
+    path = str(tmpdir.join("build.sock"))
+    server = UnixBuildServer(path, BuildService())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        with pytest.raises(IOError):
+            UnixBuildServer(path, BuildService())
+        assert exists(path)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_refuse_other_files(tmpdir):
+    path = tmpdir.join("build.sock")
+    path.write("data")
+    with pytest.raises(IOError):
+        UnixBuildServer(str(path), BuildService())
+    assert path.read() == "data"
+
+
+def test_reject_non_object_job():
+    response = BuildService().run([1])
+    assert not response["ok"]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import re
+import zipfile
+
+from jkEpubTools import build
+from jkEpubTools.validation import validate_epub
+
+
+def test_save_split_document(document, tmpdir):
+    document.split_chapters(20000)
+    assert any(chapter.parts is not None for chapter in document.chapters)
+    
+    epub_root = str(tmpdir.join("epub"))
+    path = str(tmpdir.join("split.epub"))
+    document.save_epub(epub_root)
+    build(epub_root, path)
+    
+    assert validate_epub(path).ok
+    names = zipfile.ZipFile(path).namelist()
+    for chapter, file_name in zip(document.chapters, document.get_chapter_file_names()):
+        for name in chapter.get_file_names(file_name):
+            assert "OEBPS/%s" % name in names
+
+
+CHAPTER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Notes</title></head>
+<body>
+<h1 id="top">Notes</h1>
+<p>See <a href="#note1">note 1</a> and <a href='002.xhtml#note2'>note 2</a>.</p>
+%s
+<p id="note1">Note 1, back to <a href="#top">the top</a>.</p>
+<p id="note2">Note 2.</p>
+</body>
+</html>
+"""
+
+LINKING_CHAPTER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Links</title></head>
+<body>
+<p>See <a href="002.xhtml#note2">note 2</a> and <a href="002.xhtml#top">the top</a>.</p>
+</body>
+</html>
+"""
+
+
+def make_linked_document(tmpdir):
+    from jkEpubTools.document import Document
+    
+    first = tmpdir.join("001.xhtml")
+    first.write(LINKING_CHAPTER)
+    second = tmpdir.join("002.xhtml")
+    second.write(CHAPTER % "\n".join("<p>Paragraph %i of filler text.</p>" % i for i in range(400)))
+    
+    document = Document("test.links", "Links")
+    document.set_metadata_from_dict({"title": "Links", "language": "en", "version": "3.0"})
+    document.add_chapters_from_dict_list([
+        {"id": "x1", "title": "Links", "src": str(first)},
+        {"id": "x2", "title": "Notes", "src": str(second)},
+    ])
+    document.split_chapters(4096)
+    return document
+
+
+def get_link_targets(names, read):
+    # Return the (file, id) targets of all fragment links, and all ids
+    targets = []
+    ids = set()
+    for name in names:
+        data = read("OEBPS/%s" % name)
+        for m in re.finditer(r"""href=["']([^"'#]*)#([^"']+)["']""", data):
+            targets.append((m.group(1) or name, m.group(2)))
+        for m in re.finditer(r"""\sid=["']([^"']+)["']""", data):
+            ids.add((name, m.group(1)))
+    return targets, ids
+
+
+def test_split_links(tmpdir):
+    document = make_linked_document(tmpdir)
+    names = [name for item_id, name in document.get_spine_items()]
+    assert len(names) > 3
+    
+    path = str(tmpdir.join("links.epub"))
+    document.write_epub(path)
+    assert validate_epub(path).ok
+    z = zipfile.ZipFile(path)
+    targets, ids = get_link_targets(names, z.read)
+    assert len(targets) == 5
+    for target in targets:
+        assert target in ids
+    
+    epub_root = tmpdir.join("epub")
+    document.save_epub(str(epub_root))
+    targets, ids = get_link_targets(names, lambda name: epub_root.join(name).read())
+    assert len(targets) == 5
+    for target in targets:
+        assert target in ids
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import zipfile
+
+import pytest
+
+from jkEpubTools.obfuscation import get_key_from_identifiers, xor_array
+from jkEpubTools.stamping import BaseEdition, stamp_epub
+from jkEpubTools.validation import validate_epub
+
+
+def test_stamp_epub(document, tmpdir):
+    base = str(tmpdir.join("base.epub"))
+    document.write_epub(base)
+    
+    path = str(tmpdir.join("edition.epub"))
+    identifier = stamp_epub(base, path, {"uuid": "urn:uuid:1234", "rights": u"Licensed to Jöhn <Doe>"})
+    assert identifier == u"urn:uuid:1234"
+    assert validate_epub(path).ok
+    
+    opf = zipfile.ZipFile(path).read("OEBPS/content.opf")
+    assert "urn:uuid:1234" in opf
+    assert "Licensed to J\xc3\xb6hn &lt;Doe&gt;" in opf
+
+
+def test_stamped_fonts_deobfuscate(document, tmpdir):
+    base = str(tmpdir.join("base.epub"))
+    document.write_epub(base)
+    fonts = [res for res in document.resources if res.encrypt]
+    assert fonts
+    
+    with BaseEdition(base) as edition:
+        for i in range(2):
+            path = str(tmpdir.join("edition-%i.epub" % i))
+            identifier = edition.stamp(path, {"uuid": "edition-%i" % i})
+            key = get_key_from_identifiers([identifier])
+            z = zipfile.ZipFile(path)
+            for res in fonts:
+                data = bytearray(z.read("OEBPS/%s" % res.uri))
+                with open(res.src, "rb") as f:
+                    assert str(xor_array(data, key)) == f.read()
+
+
+def test_failed_stamp_removes_edition(document, tmpdir, monkeypatch):
+    base = str(tmpdir.join("base.epub"))
+    document.write_epub(base)
+    
+    def fail(*args):
+        raise IOError("Disk full")
+    
+    path = tmpdir.join("edition.epub")
+    with BaseEdition(base) as edition:
+        monkeypatch.setattr(edition, "_write_font", fail)
+        with pytest.raises(IOError):
+            edition.stamp(str(path), {"uuid": "edition"})
+    assert not path.exists()
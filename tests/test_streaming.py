@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import threading
+import zipfile
+
+from jkEpubTools.profiling import BuildProfile
+from jkEpubTools.streaming import iter_epub
+from jkEpubTools.validation import validate_epub
+
+
+def assert_same_entries(path, reference):
+    a, b = zipfile.ZipFile(path), zipfile.ZipFile(reference)
+    assert a.testzip() is None
+    assert a.namelist() == b.namelist()
+    for name in a.namelist():
+        assert a.read(name) == b.read(name), name
+
+
+def test_stream_to_pipe(document, tmpdir):
+    reference = str(tmpdir.join("reference.epub"))
+    document.write_epub(reference, reproducible=True)
+    
+    path = str(tmpdir.join("piped.epub"))
+    with open(path, "wb") as out:
+        p = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=out)
+        document.write_epub_stream(p.stdin, reproducible=True)
+        p.stdin.close()
+        assert p.wait() == 0
+    
+    assert validate_epub(path).ok
+    assert_same_entries(path, reference)
+
+
+def test_iter_epub(document, tmpdir):
+    reference = str(tmpdir.join("reference.epub"))
+    document.write_epub(reference, reproducible=True)
+    
+    path = str(tmpdir.join("iter.epub"))
+    with open(path, "wb") as f:
+        for chunk in iter_epub(document, reproducible=True):
+            f.write(chunk)
+    
+    assert validate_epub(path).ok
+    assert_same_entries(path, reference)
+
+
+def test_iter_epub_close_stops_build(document):
+    full = BuildProfile()
+    "".join(iter_epub(document, profile=full))
+    
+    threads = threading.active_count()
+    profile = BuildProfile()
+    chunks = iter_epub(document, chunk_size=1024, queue_size=1, profile=profile)
+    next(chunks)
+    chunks.close()
+    # The producer thread has been joined, and it stopped writing entries
+    assert threading.active_count() == threads
+    assert len(profile.entries) < len(full.entries)
+
+
+def test_iter_epub_raises_build_errors(document):
+    document.metadata = None
+    try:
+        "".join(iter_epub(document))
+    except AttributeError:
+        pass
+    else:
+        assert False, "The error of the build was not raised"
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import zipfile
+
+from jkEpubTools.package import ENCRYPTION_PATH
+from jkEpubTools.transform import transform_epub
+from jkEpubTools.validation import validate_epub
+
+
+def get_fonts(document):
+    return dict(
+        ("OEBPS/%s" % res.uri, res.src) for res in document.resources if res.encrypt
+    )
+
+
+def test_deobfuscate(document, tmpdir):
+    base = str(tmpdir.join("base.epub"))
+    document.write_epub(base)
+    fonts = get_fonts(document)
+    assert fonts
+    
+    path = str(tmpdir.join("plain.epub"))
+    transformed = transform_epub(base, path, deobfuscate=True)
+    assert sorted(transformed) == sorted(fonts)
+    assert validate_epub(path).ok
+    
+    z = zipfile.ZipFile(path)
+    assert ENCRYPTION_PATH not in z.namelist()
+    for name, src in fonts.items():
+        with open(src, "rb") as f:
+            assert z.read(name) == f.read()
+    
+    # All other entries are copied as they are
+    b = zipfile.ZipFile(base)
+    names = [name for name in b.namelist() if name != ENCRYPTION_PATH]
+    assert z.namelist() == names
+    for name in names:
+        if name not in fonts:
+            assert z.read(name) == b.read(name)
+
+
+def test_obfuscated_fonts_are_kept(document, tmpdir):
+    path = str(tmpdir.join("book.epub"))
+    document.write_epub(path)
+    name = sorted(get_fonts(document))[0]
+    before = zipfile.ZipFile(path).read(name)
+    
+    # Fonts that are obfuscated already are copied unchanged, in place
+    assert transform_epub(path) == []
+    assert validate_epub(path).ok
+    assert zipfile.ZipFile(path).read(name) == before
+    assert not tmpdir.join("book.epub.tmp").exists()